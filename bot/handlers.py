@@ -2,13 +2,14 @@
 
 import asyncio
 import os
+import uuid
 from aiogram import Router, F, Bot
 from aiogram.filters import Command, CommandObject
 # --- ИЗМЕНЕНИЕ: Импортируем ParseMode ---
 from aiogram.enums import ParseMode
 from aiogram.types import Message, CallbackQuery, FSInputFile, InputFile, User, InlineKeyboardMarkup
 from aiogram.fsm.context import FSMContext
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from loguru import logger
 from typing import Optional, Dict, Tuple, Union
 from pathlib import Path
@@ -17,7 +18,11 @@ import re # Добавлен импорт re для fallback в help
 # Импортируем настройки и сервисы
 from config import settings
 from services import (
+    cpu_pool,
     gemini,
+    gemini_client,
+    result_cache,
+    table_cache,
     weather,
     speech,
     image_analyzer,
@@ -81,7 +86,7 @@ async def handle_start(message: Message):
         "<i>Настройки хранятся для каждого пользователя.</i>"
     )
     if is_admin(user_id):
-        help_text += "\n\n<b>Админ-команды:</b>\n<code>/admin</code> <code>/status</code> <code>/restart</code>"
+        help_text += "\n\n<b>Админ-команды:</b>\n<code>/admin</code> <code>/status</code> <code>/usage [дни]</code> <code>/restart</code>"
 
     try:
         await message.answer(help_text, parse_mode=ParseMode.HTML)
@@ -161,6 +166,60 @@ async def handle_admin(message: Message):
     auth_users_list = getattr(settings, 'AUTHORIZED_USERS', [])
     auth_users_str = ', '.join(map(str, auth_users_list)) if isinstance(auth_users_list, (list, tuple)) and auth_users_list else '<i>Список пуст или не задан</i>'
     admin_info += f"🔑 <b>Авторизованные пользователи:</b>\n<code>{escape_html(auth_users_str)}</code>\n\n"
+    settings_cache = database.get_settings_cache_stats()
+    hit_rate = f"{settings_cache['hit_rate']:.0%}" if settings_cache['hit_rate'] is not None else "—"
+    admin_info += (f"🗄️ <b>Кэш настроек:</b> {settings_cache['size']}/{settings_cache['maxsize']} записей, "
+                   f"попаданий {settings_cache['hits']}, промахов {settings_cache['misses']} ({hit_rate})\n")
+    history_cache = database.get_history_cache_stats()
+    hit_rate = f"{history_cache['hit_rate']:.0%}" if history_cache['hit_rate'] is not None else "—"
+    admin_info += (f"💬 <b>Кэш истории:</b> {history_cache['size']} польз., "
+                   f"{history_cache['weight'] / 1024 / 1024:.1f}/{history_cache['max_weight'] / 1024 / 1024:.0f} МБ, "
+                   f"попаданий {history_cache['hits']}, промахов {history_cache['misses']} ({hit_rate})\n")
+    gemini_stats = gemini_client.get_stats()
+    admin_info += (f"🤖 <b>Gemini:</b> выполняется {gemini_stats['in_flight']}/{gemini_stats['limit']}, "
+                   f"в очереди {gemini_stats['waiting']}, готово {gemini_stats['completed']}, "
+                   f"ошибок {gemini_stats['failed']}, таймаутов {gemini_stats['timed_out']} (в очереди {gemini_stats['queue_timeouts']}), "
+                   f"повторов {gemini_stats['retries']}, ждали квоту {gemini_stats['rate_limited']}, "
+                   f"отклонено {gemini_stats['rejected']} (breaker: {gemini_stats['breaker']})\n")
+    class_names = {'interactive': "диалог", 'analysis': "файлы/фото", 'background': "фон"}
+    for class_name, queue_stats in gemini_stats['scheduler']['classes'].items():
+        admin_info += (f"   ⏳ {class_names.get(class_name, class_name)}: в очереди {queue_stats['queued']}, "
+                       f"выполняется {queue_stats['running']}, ожидание ср. {queue_stats['wait_avg']:.1f}с / "
+                       f"p95 {queue_stats['wait_p95']:.1f}с / макс. {queue_stats['wait_max']:.1f}с\n")
+    for key_stats in gemini_stats['pool']['keys']:
+        key_state = "✅" if key_stats['healthy'] else "⛔"
+        admin_info += (f"   {key_state} ключ {escape_html(key_stats['label'])}: вес {key_stats['weight']}, "
+                       f"запросов {key_stats['requests']}, ошибок {key_stats['errors']}\n")
+    for model_name, model_healthy in gemini_stats['pool']['models'].items():
+        if not model_healthy:
+            admin_info += f"   ⛔ модель <code>{escape_html(model_name)}</code> исключена, запасная: <code>{escape_html(str(gemini_stats['pool']['fallback_model']))}</code>\n"
+    ai_cache = result_cache.get_stats()
+    hit_rate = f"{ai_cache['hit_rate']:.0%}" if ai_cache['hit_rate'] is not None else "—"
+    admin_info += (f"♻️ <b>Кэш ответов AI:</b> из памяти {ai_cache['memory_hits']}, из БД {ai_cache['disk_hits']}, "
+                   f"промахов {ai_cache['misses']} ({hit_rate}), в памяти {ai_cache['memory_entries']} записей, "
+                   f"{ai_cache['memory_weight'] / 1024 / 1024:.1f}/{ai_cache['memory_max_weight'] / 1024 / 1024:.0f} МБ\n")
+    cpu_stats = cpu_pool.get_stats()
+    if cpu_stats is None:
+        admin_info += "⚙️ <b>Разбор файлов:</b> в потоках (пул процессов выключен)\n"
+    else:
+        admin_info += (f"⚙️ <b>Разбор файлов:</b> процессов {cpu_stats['alive']}/{cpu_stats['workers']}, занято {cpu_stats['busy']}, "
+                       f"в очереди {cpu_stats['queued']}/{cpu_stats['max_queue']}, готово {cpu_stats['completed']}, "
+                       f"ошибок {cpu_stats['failed']}, прервано по таймауту {cpu_stats['timeouts']}, аварий {cpu_stats['crashed']}, "
+                       f"отклонено {cpu_stats['rejected']}, перезапусков {cpu_stats['recycled']}; "
+                       f"ожидание ср. {cpu_stats['wait_avg']:.1f}с / макс. {cpu_stats['wait_max']:.1f}с, "
+                       f"работа ср. {cpu_stats['run_avg']:.1f}с / макс. {cpu_stats['run_max']:.1f}с\n")
+    table_stats = await table_cache.get_stats()
+    if table_stats is None:
+        admin_info += "📊 <b>Кэш таблиц:</b> выключен\n"
+    else:
+        admin_info += (f"📊 <b>Кэш таблиц:</b> {table_stats['tables']} табл. у {table_stats['users']} польз., "
+                       f"{table_stats['bytes'] / 1024 / 1024:.1f}/{table_stats['max_bytes'] / 1024 / 1024:.0f} МБ, "
+                       f"сохранено {table_stats['stored']}, вытеснено {table_stats['evicted']}, "
+                       f"запросов {table_stats['queries']} (ошибок {table_stats['query_errors']})\n")
+    files_in_flight = file_handler.get_in_flight_stats()
+    images_in_flight = image_analyzer.get_in_flight_stats()
+    admin_info += (f"🔗 <b>Объединение повторов:</b> файлы {files_in_flight['coalesced']}/{files_in_flight['started']}, "
+                   f"фото {images_in_flight['coalesced']}/{images_in_flight['started']} (присоединились/запущено)\n\n")
     admin_info += "✅ Сервис бота активен. Для деталей используйте /status."
     try:
         await message.reply(admin_info, parse_mode=ParseMode.HTML)
@@ -211,6 +270,30 @@ async def handle_status(message: Message, bot: Bot):
         try: await bot.edit_message_text(plain_output, chat_id=processing_msg.chat.id, message_id=processing_msg.message_id, parse_mode=None, disable_web_page_preview=True)
         except Exception as fallback_e: logger.error(f"Failed to send plain status info: {fallback_e}")
 
+@router.message(Command("usage"))
+async def handle_usage(message: Message, command: CommandObject):
+    user_id = get_user_id(message=message)
+    if not user_id or not is_admin(user_id): return
+    days = int(command.args) if command.args and command.args.strip().isdigit() else 1
+    logger.info(f"Usage command executed by user {user_id} (days={days})")
+    try:
+        top_users = await database.get_top_usage(days=days, limit=10)
+    except Exception as e:
+        logger.error(f"Failed to load usage stats: {e}")
+        await message.reply("Ошибка при получении статистики расхода.")
+        return
+    period = "сегодня" if days == 1 else f"за {days} дн."
+    if not top_users:
+        await message.reply(f"📊 Обращений к AI {period} не было.")
+        return
+    quota = settings.USER_DAILY_TOKEN_QUOTA
+    lines = [f"📊 <b>Топ по расходу токенов {period}</b> (квота в день: {quota or 'нет'})\n"]
+    for position, usage in enumerate(top_users, start=1):
+        lines.append(f"{position}. <code>{usage['user_id']}</code>: {usage['total_tokens']} ток. "
+                     f"(вход {usage['prompt_tokens']}, выход {usage['completion_tokens']}), "
+                     f"{usage['calls']} вызовов, ~{usage['avg_latency_ms']} мс")
+    await message.reply("\n".join(lines), parse_mode=ParseMode.HTML)
+
 @router.message(Command("restart"))
 async def handle_restart(message: Message):
     user_id = get_user_id(message=message)
@@ -289,6 +372,13 @@ async def handle_voice_message(message: Message, bot: Bot):
 
         await database.add_message(user_id, 'user', recognized_text)
         await bot.send_chat_action(chat_id=message.chat.id, action="typing")
+
+        if settings.GEMINI_STREAMING and not await database.get_speak_enabled(user_id):
+            await reply_with_streaming(bot, message, user_id, recognized_text)
+            try: await bot.delete_message(chat_id=processing_msg.chat.id, message_id=processing_msg.message_id)
+            except Exception as del_e: logger.warning(f"Could not delete processing message after voice reply: {del_e}")
+            return
+
         response_text = await gemini.generate_text_response(user_id, recognized_text)
 
         if response_text:
@@ -335,8 +425,8 @@ async def handle_photo_message(message: Message, bot: Bot):
     processing_msg = await message.reply("<i>Анализирую изображение...</i>", parse_mode=ParseMode.HTML)
 
     photo = message.photo[-1]
-    temp_filename = f"{user_id}_{photo.file_unique_id}.jpg"
-    jpg_filepath = settings.TEMP_DIR / temp_filename
+    # Свой файл для каждого сообщения: одинаковые фото, присланные одновременно, не затирают друг друга
+    jpg_filepath = get_temp_filepath("jpg")
 
     try:
         await bot.download(photo, destination=str(jpg_filepath))
@@ -347,7 +437,7 @@ async def handle_photo_message(message: Message, bot: Bot):
         await cleanup_temp_file(jpg_filepath)
         return
 
-    analysis_result = await image_analyzer.analyze_image(jpg_filepath, user_id)
+    analysis_result = await image_analyzer.analyze_image(jpg_filepath, user_id, file_unique_id=photo.file_unique_id)
     ocr_text = analysis_result.get("ocr_text")
     vision_analysis = analysis_result.get("vision_analysis")
     ocr_useful = is_ocr_potentially_useful(ocr_text)
@@ -395,13 +485,13 @@ async def handle_document_message(message: Message, bot: Bot):
     filename = doc.file_name if doc.file_name else f"file_{doc.file_unique_id}"
     mime_type = doc.mime_type
     file_size = doc.file_size if doc.file_size else 0
-    file_id = doc.file_id
 
     logger.info(f"Received document '{filename}' from user {user_id} (Type: {mime_type}, Size: {file_size})")
     processing_msg = await message.reply(f"<i>Получил файл '{escape_html(filename)}'. Обрабатываю...</i>", parse_mode=ParseMode.HTML)
 
     safe_filename_part = "".join(c if c.isalnum() or c in ('_', '-') else '_' for c in filename)
-    temp_filename = f"{user_id}_{file_id}_{safe_filename_part}"; max_len = 150
+    # uuid: тот же файл (тот же file_id) в двух сообщениях скачивается в разные файлы
+    temp_filename = f"{user_id}_{uuid.uuid4().hex}_{safe_filename_part}"; max_len = 150
     if len(temp_filename) > max_len:
          name_part, ext_part = os.path.splitext(temp_filename); ext_len = len(ext_part)
          name_part = name_part[:max_len - ext_len - 1]; temp_filename = name_part + ext_part
@@ -420,11 +510,26 @@ async def handle_document_message(message: Message, bot: Bot):
         await bot.edit_message_text(f"<i>Анализирую содержимое файла '{escape_html(filename)}'...</i>", chat_id=processing_msg.chat.id, message_id=processing_msg.message_id, parse_mode=ParseMode.HTML)
     except TelegramBadRequest: pass
 
-    process_result = await file_handler.process_file(doc_filepath, filename, mime_type, file_size)
+    # Ход анализа большого файла по частям: правки заглушки прореживаются, как при потоковом ответе
+    loop = asyncio.get_running_loop()
+    next_edit_at = 0.0
+    async def report_progress(done: int, total: int):
+        nonlocal next_edit_at
+        if done < total and loop.time() < next_edit_at:
+            return
+        next_edit_at = loop.time() + settings.STREAM_EDIT_INTERVAL_SEC
+        progress_text = (f"<i>Анализирую файл '{escape_html(filename)}': часть {done} из {total}...</i>" if done < total
+                         else f"<i>Составляю итоговый анализ файла '{escape_html(filename)}'...</i>")
+        try:
+            await bot.edit_message_text(progress_text, chat_id=processing_msg.chat.id, message_id=processing_msg.message_id, parse_mode=ParseMode.HTML)
+        except Exception as edit_e:
+            logger.debug(f"Could not update file progress message: {edit_e}")
+
+    process_result = await file_handler.process_file(doc_filepath, filename, mime_type, file_size, user_id=user_id, progress=report_progress)
 
     if process_result:
-        status_message, analysis_result, extracted_content = process_result
-        logger.info(f"File processing result for '{filename}': Status='{status_message}', Analysis received={analysis_result is not None}")
+        status_message, analysis_result, extracted_content, doc_id = process_result
+        logger.info(f"File processing result for '{filename}': Status='{status_message}', Analysis received={analysis_result is not None}, Document={doc_id}")
 
         # --- ИЗМЕНЕНИЕ: Формируем HTML ответ ---
         response_parts_html = [
@@ -432,16 +537,10 @@ async def handle_document_message(message: Message, bot: Bot):
             f"<b>Статус:</b> {escape_html(status_message)}"
         ]
 
-        max_history_len = settings.MAX_HISTORY_FILE_CONTENT_LENGTH
-        history_content_info = ""
-        if extracted_content and not status_message.startswith("Файл") and not status_message.startswith("Не удалось"):
-             truncated_content = extracted_content[:max_history_len]
-             history_content_info = f" [Содержимое{' (урезанное)' if len(extracted_content) > max_history_len else ''}: {truncated_content}...]"
-        elif not extracted_content and status_message.startswith("Извлек"):
-             history_content_info = " [Содержимое: (пусто)]"
-
+        # Содержимое файла в историю не копируется: запись ссылается на документ (doc_id),
+        # а текст подставляется при сборке контекста, если помещается в бюджет токенов
         user_history_message = f"[Отправлен файл для анализа: {filename}]"
-        model_history_message = f"[Статус обработки: {status_message}]{history_content_info}"
+        model_history_message = f"[Статус обработки: {status_message}]"
 
         if analysis_result:
             # --- ИЗМЕНЕНИЕ: Форматируем анализ ---
@@ -451,7 +550,7 @@ async def handle_document_message(message: Message, bot: Bot):
 
         final_response_html = "\n\n".join(response_parts_html).strip()
         await database.add_message(user_id, 'user', user_history_message)
-        await database.add_message(user_id, 'model', model_history_message)
+        await database.add_message(user_id, 'model', model_history_message, doc_id=doc_id)
 
         # --- ИЗМЕНЕНИЕ: Отправляем с HTML ---
         await send_response(bot, message.chat.id, user_id, final_response_html, parse_mode=ParseMode.HTML)
@@ -515,6 +614,13 @@ async def handle_text_message(message: Message, bot: Bot):
         logger.info(f"Received text message from user {user_id} for Gemini: '{user_text[:100]}...'")
         await bot.send_chat_action(chat_id=message.chat.id, action="typing")
         await database.add_message(user_id, 'user', user_text)
+
+        # Потоковый режим: ответ появляется по мере генерации. При включенной озвучке
+        # текст все равно не показывается, поэтому ждем полный ответ как раньше.
+        if settings.GEMINI_STREAMING and not await database.get_speak_enabled(user_id):
+            await reply_with_streaming(bot, message, user_id, user_text)
+            return
+
         response_text = await gemini.generate_text_response(user_id, user_text)
 
         if response_text:
@@ -542,6 +648,103 @@ async def handle_text_message(message: Message, bot: Bot):
             await database.add_message(user_id, 'model', "[Ошибка генерации ответа AI]")
 
 
+# --- Потоковый ответ Gemini с прогрессивным редактированием сообщения ---
+TTS_MARKER_START = "[TTS:"
+TTS_MARKER_END = "]"
+
+def _may_be_tts_marker(text: str) -> bool:
+    """True while the streamed text is (or may still become) a [TTS:...] marker."""
+    stripped = text.lstrip()
+    return stripped.startswith(TTS_MARKER_START) or TTS_MARKER_START.startswith(stripped)
+
+async def reply_with_streaming(bot: Bot, message: Message, user_id: int, prompt: str):
+    """
+    Streams Gemini's answer into a placeholder message via throttled edits, then replaces it
+    with the final HTML rendering. Handles the [TTS:...] marker and stores the answer in history;
+    an answer that broke off midway is shown and stored with an "interrupted" note.
+    """
+    chat_id = message.chat.id
+    placeholder = await message.reply("<i>Думаю...</i>", parse_mode=ParseMode.HTML)
+    loop = asyncio.get_running_loop()
+    response_text = ""
+    shown_text = ""
+    next_edit_at = 0.0 # первый текст показываем сразу, троттлятся только следующие правки
+    max_preview_len = 4000
+    interrupted = False
+
+    try:
+        async for chunk in gemini.stream_text_response(user_id, prompt):
+            response_text += chunk
+            # Маркер озвучки пользователю не показываем - ждем конца ответа
+            if _may_be_tts_marker(response_text) or loop.time() < next_edit_at:
+                continue
+            preview = response_text.strip()[:max_preview_len]
+            if preview == shown_text:
+                continue
+            next_edit_at = loop.time() + settings.STREAM_EDIT_INTERVAL_SEC
+            try:
+                # Промежуточные правки - простым текстом: незакрытая разметка на полуслове ломает HTML
+                await bot.edit_message_text(preview + " ▌", chat_id=chat_id, message_id=placeholder.message_id, parse_mode=None, disable_web_page_preview=True)
+                shown_text = preview
+            except TelegramRetryAfter as e:
+                logger.warning(f"Telegram edit rate limit while streaming to chat {chat_id}, retry after {e.retry_after}s")
+                next_edit_at = loop.time() + e.retry_after
+            except TelegramBadRequest as e:
+                logger.debug(f"Skipped streaming edit for chat {chat_id}: {e}")
+    except gemini.StreamInterruptedError as e:
+        logger.warning(f"Gemini stream for user {user_id} was interrupted: {e}")
+        interrupted = True
+
+    response_text = response_text.strip()
+    if interrupted:
+        # Обрывок не выдаем за полный ответ: помечаем и в чате, и в истории
+        await database.add_message(user_id, 'model', f"{response_text}\n[Ответ был прерван]")
+        await _finalize_streamed_reply(bot, placeholder, user_id, format_response_html(response_text)
+                                       + "\n\n<i>⚠️ Ответ был прерван. Попробуйте спросить еще раз.</i>")
+        return
+
+    if not response_text:
+        logger.error(f"Failed to generate Gemini response for user {user_id}")
+        await bot.edit_message_text("Извините, не могу сейчас ответить. Попробуйте позже.", chat_id=chat_id, message_id=placeholder.message_id, parse_mode=None)
+        await database.add_message(user_id, 'model', "[Ошибка генерации ответа AI]")
+        return
+
+    if response_text.startswith(TTS_MARKER_START) and response_text.endswith(TTS_MARKER_END):
+        try: await bot.delete_message(chat_id=chat_id, message_id=placeholder.message_id)
+        except Exception as del_e: logger.warning(f"Could not delete streaming placeholder: {del_e}")
+        text_to_speak = response_text[len(TTS_MARKER_START):-len(TTS_MARKER_END)].strip()
+        if text_to_speak:
+            logger.info(f"Detected explicit TTS request from Gemini for user {user_id}. Text: '{text_to_speak[:50]}...'")
+            await database.add_message(user_id, 'model', f"[Запрошена озвучка текста: '{text_to_speak[:100]}...']")
+            await tts.speak_and_cleanup(bot, chat_id, text_to_speak)
+        else:
+            logger.warning(f"Gemini returned TTS marker but text was empty for user {user_id}")
+            await message.reply("Не могу озвучить пустой текст.", parse_mode=None)
+            await database.add_message(user_id, 'model', "[Ошибка: Gemini вернул пустой текст для озвучки]")
+        return
+
+    await database.add_message(user_id, 'model', response_text) # В историю кладем оригинал
+    await _finalize_streamed_reply(bot, placeholder, user_id, format_response_html(response_text))
+
+
+async def _finalize_streamed_reply(bot: Bot, placeholder: Message, user_id: int, formatted_response: str):
+    """Replaces the streaming placeholder with the final HTML answer (or sends it in parts if too long)."""
+    chat_id = placeholder.chat.id
+    if len(formatted_response) <= 4096:
+        try:
+            await bot.edit_message_text(formatted_response, chat_id=chat_id, message_id=placeholder.message_id, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+            return
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e): return
+            logger.error(f"Failed to finalize streamed message with HTML: {e}. Sending as a new message.")
+        except Exception as e:
+            logger.error(f"Unexpected error finalizing streamed message: {e}. Sending as a new message.")
+    # Длинный ответ (или ошибка разметки): отправляем обычным путем с разбиением на части
+    try: await bot.delete_message(chat_id=chat_id, message_id=placeholder.message_id)
+    except Exception as del_e: logger.warning(f"Could not delete streaming placeholder: {del_e}")
+    await send_response(bot, chat_id, user_id, formatted_response, parse_mode=ParseMode.HTML)
+
+
 # --- Вспомогательная функция для отправки ответа (с улучшенной обработкой ошибок) ---
 async def send_response(bot: Bot, chat_id: int, user_id: int, text: str, parse_mode: Optional[str] = None, keyboard: Optional[InlineKeyboardMarkup] = None):
     """Sends response as text or voice based on user settings, handling long messages and errors."""
@@ -21,12 +21,19 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 if not TELEGRAM_BOT_TOKEN:
     logger.error("TELEGRAM_BOT_TOKEN not found in .env or environment variables.")
     raise ValueError("Необходимо указать TELEGRAM_BOT_TOKEN")
+# Адрес Bot API (локальный telegram-bot-api или тестовый сервер loadtest/); пусто - api.telegram.org
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "").rstrip("/")
 
 # --- APIs ---
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# Несколько ключей для пула: GEMINI_API_KEYS="key1:2,key2" (после двоеточия - вес, по умолчанию 1).
+# Если не задан, используется единственный GEMINI_API_KEY.
+GEMINI_API_KEYS = os.getenv("GEMINI_API_KEYS", "")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or GEMINI_API_KEYS.split(",")[0].partition(":")[0].strip()
 if not GEMINI_API_KEY:
     logger.error("GEMINI_API_KEY not found in .env or environment variables.")
     raise ValueError("Необходимо указать GEMINI_API_KEY")
+if not GEMINI_API_KEYS:
+    GEMINI_API_KEYS = GEMINI_API_KEY
 
 OPENWEATHERMAP_API_KEY = os.getenv("OPENWEATHERMAP_API_KEY")
 if not OPENWEATHERMAP_API_KEY:
@@ -60,6 +67,8 @@ TEMP_DIR = BASE_DIR / os.getenv("TEMP_DIR", "temp")
 
 # --- Log Rotation ---
 LOG_ROTATION = os.getenv("LOG_ROTATION", "1 MB")
+# Уровень логов в консоли (и у процессов пула разбора файлов); в файл пишется все с DEBUG
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
 # --- Ensure directories exist ---
 LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
@@ -69,6 +78,41 @@ DATABASE_FILE.parent.mkdir(parents=True, exist_ok=True)
 # --- Models ---
 GEMINI_TEXT_MODEL = os.getenv("GEMINI_TEXT_MODEL", "gemini-1.5-flash")
 GEMINI_VISION_MODEL = os.getenv("GEMINI_VISION_MODEL", "gemini-1.5-flash")
+# Фабрика async-клиента Gemini API вместо GenerativeServiceAsyncClient ("модуль:функция",
+# получает ключ API), например loadtest.fake_gemini:create_client для нагрузочных тестов без обращения к API
+GEMINI_CLIENT_FACTORY = os.getenv("GEMINI_CLIENT_FACTORY", "")
+# Потоковая выдача ответов: сообщение-заглушка редактируется по мере генерации.
+# Telegram ограничивает частоту правок (~1 в секунду на чат), поэтому правки прореживаются.
+GEMINI_STREAMING = os.getenv("GEMINI_STREAMING", "true").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL_SEC = float(os.getenv("STREAM_EDIT_INTERVAL_SEC", 1.2))
+# Сколько запросов к Gemini может выполняться одновременно (остальные ждут в очереди)
+GEMINI_MAX_CONCURRENCY = max(1, int(os.getenv("GEMINI_MAX_CONCURRENCY", 8)))
+# Сколько из этих слотов держать только для диалога (анализ файлов/фото и сводки их не занимают)
+GEMINI_INTERACTIVE_RESERVED_SLOTS = max(0, int(os.getenv("GEMINI_INTERACTIVE_RESERVED_SLOTS", 2)))
+# Дедлайн одного запроса к Gemini (включая ожидание в очереди), секунд; у потокового ответа -
+# до первого фрагмента. Дальше поток прерывается, только если очередной фрагмент не пришел за
+# GEMINI_STREAM_IDLE_TIMEOUT_SEC или весь ответ идет дольше GEMINI_STREAM_MAX_SEC
+GEMINI_REQUEST_TIMEOUT_SEC = float(os.getenv("GEMINI_REQUEST_TIMEOUT_SEC", 60))
+GEMINI_STREAM_IDLE_TIMEOUT_SEC = float(os.getenv("GEMINI_STREAM_IDLE_TIMEOUT_SEC", 30))
+GEMINI_STREAM_MAX_SEC = float(os.getenv("GEMINI_STREAM_MAX_SEC", 600))
+# Квоты API на каждый ключ: запросов и (приблизительных) входных токенов в минуту; 0 - без ограничения.
+# Сверх квоты запросы ждут в очереди, а не получают 429.
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", 60))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", 1000000))
+# Повторы при временных ошибках (429/500/503/504): экспоненциальная задержка со случайным разбросом
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", 3))
+GEMINI_RETRY_BASE_SEC = float(os.getenv("GEMINI_RETRY_BASE_SEC", 1.0))
+GEMINI_RETRY_MAX_SEC = float(os.getenv("GEMINI_RETRY_MAX_SEC", 20))
+# Circuit breaker: после N неудачных вызовов подряд запросы сразу отклоняются на время паузы
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", 5))
+GEMINI_BREAKER_COOLDOWN_SEC = float(os.getenv("GEMINI_BREAKER_COOLDOWN_SEC", 30))
+# Пул ключей/моделей: ключ или модель после N ошибок подряд исключаются на GEMINI_EJECT_SEC;
+# при исключенной модели запросы идут в запасную (пусто - без запасной)
+GEMINI_EJECT_AFTER_ERRORS = max(1, int(os.getenv("GEMINI_EJECT_AFTER_ERRORS", 3)))
+GEMINI_EJECT_SEC = float(os.getenv("GEMINI_EJECT_SEC", 60))
+GEMINI_FALLBACK_MODEL = os.getenv("GEMINI_FALLBACK_MODEL", "")
+# Дневная квота токенов Gemini на пользователя (сумма prompt + completion); 0 - без ограничения
+USER_DAILY_TOKEN_QUOTA = int(os.getenv("USER_DAILY_TOKEN_QUOTA", 0))
 
 # --- TTS Settings (gTTS - Google Text-to-Speech library) ---
 # Настройки для gTTS обычно не требуются в .env,
@@ -87,19 +131,85 @@ GEMINI_VISION_MODEL = os.getenv("GEMINI_VISION_MODEL", "gemini-1.5-flash")
 
 # --- Other ---
 MAX_CONTEXT_MESSAGES = int(os.getenv("MAX_CONTEXT_MESSAGES", 20))
+# Бюджет (приблизительных) токенов на весь запрос к Gemini: инструкция + история + запрос
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 8000))
+# Сводка разговора: когда история пользователя превышает порог токенов (или лимит сообщений),
+# старые реплики в фоне сворачиваются в сводку, последние SUMMARY_KEEP_RECENT остаются дословно.
+# 0 - сводки выключены.
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("SUMMARY_TRIGGER_TOKENS", 3000))
+SUMMARY_KEEP_RECENT = max(2, int(os.getenv("SUMMARY_KEEP_RECENT", 6)))
+# Размер одного запроса анализа файла, символов: длинный документ делится на части такого размера
+# (по страницам и абзацам), части анализируются параллельно, и их заметки сводятся в итоговый анализ.
 MAX_FILE_CONTENT_LENGTH_FOR_GEMINI = int(os.getenv("MAX_FILE_CONTENT_LENGTH_FOR_GEMINI", 30000))
+# Предел стоимости анализа одного файла: не больше N частей (при большем числе берутся равномерно по документу)
+DOC_ANALYSIS_MAX_CHUNKS = int(os.getenv("DOC_ANALYSIS_MAX_CHUNKS", 12))
+# Пул процессов для разбора файлов (PDF, DOCX, таблицы, OCR): CPU_POOL_WORKERS процессов
+# (по умолчанию - по числу ядер; 0 - разбор в потоках, как раньше). Задача дольше
+# CPU_JOB_TIMEOUT_SEC прерывается вместе с процессом (в потоке - только перестаем ее ждать); процесс заменяется новым после
+# CPU_POOL_MAX_JOBS_PER_WORKER задач; больше CPU_POOL_MAX_QUEUE ожидающих задач не принимается.
+CPU_POOL_WORKERS = max(0, int(os.getenv("CPU_POOL_WORKERS", os.cpu_count() or 1)))
+CPU_JOB_TIMEOUT_SEC = float(os.getenv("CPU_JOB_TIMEOUT_SEC", 120))
+CPU_POOL_MAX_JOBS_PER_WORKER = int(os.getenv("CPU_POOL_MAX_JOBS_PER_WORKER", 100))
+CPU_POOL_MAX_QUEUE = int(os.getenv("CPU_POOL_MAX_QUEUE", 64))
+# Извлечение PDF: страницы читаются, пока не наберется текст на анализ (части x их число).
+# PDF от PDF_PARALLEL_MIN_PAGES страниц читаются несколькими процессами пула
+# кусками по PDF_PAGES_PER_TASK страниц (нужен PyMuPDF и хотя бы 2 процесса).
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", 100))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", 25))
+# Разобранные таблицы (CSV/Excel) хранятся на диске в формате Arrow (нужен pyarrow) в
+# TABLE_CACHE_DIR/<user_id>/ - для точных расчетов по ним при вопросах после анализа.
+# Давно не использованные удаляются, когда таблицы пользователя занимают больше
+# TABLE_CACHE_USER_MB или все вместе - больше TABLE_CACHE_MAX_MB (0 - кэш выключен).
+# К первому сообщению после загрузки и к вопросам, похожим на расчет по таблице, добавляется
+# список таблиц, использованных за TABLE_QUERY_CONTEXT_HOURS;
+# запрос к таблице выполняется в пуле процессов не дольше TABLE_QUERY_TIMEOUT_SEC,
+# на один ответ - не больше TABLE_QUERY_MAX_ROUNDS запросов.
+TABLE_CACHE_DIR = BASE_DIR / os.getenv("TABLE_CACHE_DIR", "data/tables")
+TABLE_CACHE_USER_MB = int(os.getenv("TABLE_CACHE_USER_MB", 200))
+TABLE_CACHE_MAX_MB = int(os.getenv("TABLE_CACHE_MAX_MB", 2000))
+TABLE_QUERY_CONTEXT_HOURS = float(os.getenv("TABLE_QUERY_CONTEXT_HOURS", 24))
+TABLE_QUERY_TIMEOUT_SEC = float(os.getenv("TABLE_QUERY_TIMEOUT_SEC", 30))
+TABLE_QUERY_MAX_ROUNDS = int(os.getenv("TABLE_QUERY_MAX_ROUNDS", 2))
 WEATHER_FORECAST_DEFAULT_DAYS = int(os.getenv("WEATHER_FORECAST_DEFAULT_DAYS", 5))
 # <<< НОВОЕ: Лимит символов файла для истории >>>
 # Половина от лимита Gemini - хорошее начало. Можно настроить.
 MAX_HISTORY_FILE_CONTENT_LENGTH = MAX_FILE_CONTENT_LENGTH_FOR_GEMINI // 2
 
+# --- Database ---
+# Одно соединение-писатель + небольшой пул читателей, открываются один раз при старте
+DB_READER_POOL_SIZE = max(1, int(os.getenv("DB_READER_POOL_SIZE", 3)))
+# Размер кэша подготовленных выражений sqlite3 на каждое соединение
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 128))
+# Write-behind для истории: сообщения копятся в памяти и пишутся одной транзакцией
+DB_FLUSH_INTERVAL_MS = int(os.getenv("DB_FLUSH_INTERVAL_MS", 50))
+DB_FLUSH_MAX_ROWS = max(1, int(os.getenv("DB_FLUSH_MAX_ROWS", 200)))
+# Период фоновой обрезки истории (вместо DELETE на каждую вставку)
+DB_COMPACT_INTERVAL_SEC = int(os.getenv("DB_COMPACT_INTERVAL_SEC", 60))
+# LRU-кэш настроек пользователей (mood, speak_enabled), записей
+USER_SETTINGS_CACHE_SIZE = int(os.getenv("USER_SETTINGS_CACHE_SIZE", 10000))
+# Кэш последних сообщений в памяти: лимит пользователей и бюджет памяти (МБ)
+HISTORY_CACHE_MAX_USERS = int(os.getenv("HISTORY_CACHE_MAX_USERS", 5000))
+HISTORY_CACHE_MAX_MB = int(os.getenv("HISTORY_CACHE_MAX_MB", 64))
+# Сообщения истории больше порога (байт UTF-8) хранятся сжатыми zlib
+HISTORY_COMPRESS_THRESHOLD = int(os.getenv("HISTORY_COMPRESS_THRESHOLD", 2048))
+HISTORY_COMPRESS_LEVEL = int(os.getenv("HISTORY_COMPRESS_LEVEL", 6))
+# Кэш текста документов, подставляемого в историю (МБ)
+DOCUMENT_CACHE_MAX_MB = int(os.getenv("DOCUMENT_CACHE_MAX_MB", 16))
+# Сколько дней хранить документы, на которые уже не ссылается история
+DOCUMENT_RETENTION_DAYS = int(os.getenv("DOCUMENT_RETENTION_DAYS", 30))
+# Кэш результатов Gemini для анализа файлов, изображений и переводов:
+# время жизни (часы, 0 - выключен), бюджет памяти (МБ) и лимит строк в SQLite
+AI_CACHE_TTL_HOURS = float(os.getenv("AI_CACHE_TTL_HOURS", 168))
+AI_CACHE_MEMORY_MB = int(os.getenv("AI_CACHE_MEMORY_MB", 16))
+AI_CACHE_MAX_ROWS = int(os.getenv("AI_CACHE_MAX_ROWS", 20000))
+
 
 # --- Configure Loguru Logger ---
 # (Логика настройки логгера остается без изменений)
 try:
     logger.remove(0)
 except ValueError: pass
-logger.add(lambda msg: print(msg, end=''), level="INFO", format="{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {message}")
+logger.add(lambda msg: print(msg, end=''), level=LOG_LEVEL, format="{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {message}")
 logger.add(LOG_FILE, rotation=LOG_ROTATION, compression="zip", level="DEBUG", format="{time:YYYY-MM-DD HH:mm:ss} | {level:<8} | {name}:{function}:{line} - {message}", encoding="utf-8")
 
 logger.info("Logger configured.")
@@ -109,11 +219,32 @@ logger.debug(f"Temp directory: {TEMP_DIR}")
 logger.debug(f"Database file: {DATABASE_FILE}")
 logger.debug(f"Log file: {LOG_FILE}")
 logger.debug(f"Text Model: {GEMINI_TEXT_MODEL}, Vision Model: {GEMINI_VISION_MODEL}")
+if GEMINI_CLIENT_FACTORY:
+    logger.warning(f"Gemini API clients are created by {GEMINI_CLIENT_FACTORY} instead of google.ai.generativelanguage")
+if TELEGRAM_API_BASE:
+    logger.debug(f"Telegram Bot API server: {TELEGRAM_API_BASE}")
+logger.debug(f"Streaming responses: {GEMINI_STREAMING} (edit interval {STREAM_EDIT_INTERVAL_SEC}s)")
+logger.debug(f"Gemini concurrency limit: {GEMINI_MAX_CONCURRENCY} ({GEMINI_INTERACTIVE_RESERVED_SLOTS} reserved for chat), request timeout: {GEMINI_REQUEST_TIMEOUT_SEC}s, stream idle timeout: {GEMINI_STREAM_IDLE_TIMEOUT_SEC}s (up to {GEMINI_STREAM_MAX_SEC}s per stream)")
+logger.debug(f"Gemini pool: {len(GEMINI_API_KEYS.split(','))} key(s), eject after {GEMINI_EJECT_AFTER_ERRORS} errors for {GEMINI_EJECT_SEC}s, fallback model: {GEMINI_FALLBACK_MODEL or 'none'}")
+logger.debug(f"User daily token quota: {USER_DAILY_TOKEN_QUOTA or 'unlimited'}")
+logger.debug(f"Gemini quota per key: {GEMINI_RPM} RPM, {GEMINI_TPM} TPM; retries: {GEMINI_MAX_RETRIES}; breaker: {GEMINI_BREAKER_THRESHOLD} failures / {GEMINI_BREAKER_COOLDOWN_SEC}s")
 logger.debug(f"Max context message pairs: {MAX_CONTEXT_MESSAGES}")
+logger.debug(f"Context token budget: {CONTEXT_TOKEN_BUDGET}")
+logger.debug(f"Conversation summary: trigger {SUMMARY_TRIGGER_TOKENS} tokens, keep {SUMMARY_KEEP_RECENT} recent messages")
 logger.debug(f"Default mood: {DEFAULT_MOOD}")
-logger.debug(f"Max file content length for Gemini: {MAX_FILE_CONTENT_LENGTH_FOR_GEMINI}")
+logger.debug(f"File analysis: {MAX_FILE_CONTENT_LENGTH_FOR_GEMINI} chars per part, up to {DOC_ANALYSIS_MAX_CHUNKS} parts")
+logger.debug(f"CPU process pool: {CPU_POOL_WORKERS or 'off (threads)'} worker(s), job timeout {CPU_JOB_TIMEOUT_SEC}s, recycle after {CPU_POOL_MAX_JOBS_PER_WORKER} jobs, queue limit {CPU_POOL_MAX_QUEUE}")
+logger.debug(f"PDF extraction: parallel for PDFs from {PDF_PARALLEL_MIN_PAGES} pages, {PDF_PAGES_PER_TASK} pages per task")
+logger.debug(f"Table cache: {TABLE_CACHE_DIR}, {TABLE_CACHE_USER_MB} MB per user, {TABLE_CACHE_MAX_MB} MB total; queries: {TABLE_QUERY_TIMEOUT_SEC}s timeout, up to {TABLE_QUERY_MAX_ROUNDS} per answer, tables used within {TABLE_QUERY_CONTEXT_HOURS}h")
 logger.debug(f"Max file content length for history: {MAX_HISTORY_FILE_CONTENT_LENGTH}")
 logger.debug(f"Default forecast days: {WEATHER_FORECAST_DEFAULT_DAYS}")
+logger.debug(f"DB reader pool size: {DB_READER_POOL_SIZE}, statement cache: {DB_STATEMENT_CACHE_SIZE}")
+logger.debug(f"DB write-behind: flush every {DB_FLUSH_INTERVAL_MS} ms or {DB_FLUSH_MAX_ROWS} rows")
+logger.debug(f"DB history compaction interval: {DB_COMPACT_INTERVAL_SEC}s")
+logger.debug(f"User settings cache size: {USER_SETTINGS_CACHE_SIZE}")
+logger.debug(f"History cache: up to {HISTORY_CACHE_MAX_USERS} users, {HISTORY_CACHE_MAX_MB} MB")
+logger.debug(f"History compression: >= {HISTORY_COMPRESS_THRESHOLD} bytes, zlib level {HISTORY_COMPRESS_LEVEL}")
+logger.debug(f"AI result cache: TTL {AI_CACHE_TTL_HOURS}h, {AI_CACHE_MEMORY_MB} MB in memory, {AI_CACHE_MAX_ROWS} rows on disk")
 logger.info("Using gTTS for Text-to-Speech.") # Указываем, что используется gTTS
 
 # --- END OF FILE config/settings.py ---
\ No newline at end of file
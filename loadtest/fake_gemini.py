@@ -0,0 +1,154 @@
+# --- START OF FILE loadtest/fake_gemini.py ---
+
+import asyncio
+import hashlib
+import math
+import os
+import random
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from google.ai import generativelanguage as glm
+from google.api_core import exceptions as google_exceptions
+
+# Детерминированная замена async-клиента Gemini API (GenerativeServiceAsyncClient)
+# для нагрузочных тестов. Подключается через GEMINI_CLIENT_FACTORY=loadtest.fake_gemini:create_client:
+# модели строит настоящий google.generativeai, так что пул ключей, запасная модель и
+# модели настроений работают как в бою, а в сеть не уходит ни один запрос.
+#
+# Задержка ответа - логнормальная (медиана и разброс настраиваются), часть запросов
+# завершается 503 или 429. Случайность выводится из seed, модели, текста запроса и номера
+# попытки, поэтому результат не зависит от того, в каком порядке запросы пришли.
+
+
+@dataclass
+class FakeGeminiConfig:
+    latency_median_ms: float = 800.0
+    latency_sigma: float = 0.5       # sigma логнормального распределения; 0 - постоянная задержка
+    error_rate: float = 0.0          # доля ответов 503 ServiceUnavailable
+    rate_limit_rate: float = 0.0     # доля ответов 429 ResourceExhausted
+    stream_chunks: int = 8
+    response_chars: int = 600
+    seed: int = 0
+
+    @classmethod
+    def from_env(cls) -> "FakeGeminiConfig":
+        return cls(
+            latency_median_ms=float(os.getenv("FAKE_GEMINI_LATENCY_MS", cls.latency_median_ms)),
+            latency_sigma=float(os.getenv("FAKE_GEMINI_LATENCY_SIGMA", cls.latency_sigma)),
+            error_rate=float(os.getenv("FAKE_GEMINI_ERROR_RATE", cls.error_rate)),
+            rate_limit_rate=float(os.getenv("FAKE_GEMINI_429_RATE", cls.rate_limit_rate)),
+            stream_chunks=max(1, int(os.getenv("FAKE_GEMINI_STREAM_CHUNKS", cls.stream_chunks))),
+            response_chars=max(1, int(os.getenv("FAKE_GEMINI_RESPONSE_CHARS", cls.response_chars))),
+            seed=int(os.getenv("FAKE_GEMINI_SEED", cls.seed)),
+        )
+
+
+# Драйвер (loadtest/run.py) может поменять настройки до начала нагрузки
+config = FakeGeminiConfig.from_env()
+
+stats: Dict[str, Any] = {"requests": 0, "streams": 0, "errors": 0, "rate_limited": 0, "keys": {}, "models": {}}
+
+# Сколько раз уже приходил запрос с таким текстом: повтор после ошибки получает новый исход
+_attempts: Dict[str, int] = {}
+
+
+def _response(text: str, prompt_tokens: int, finish: bool = True,
+              completion_text: Optional[str] = None) -> glm.GenerateContentResponse:
+    # Итоговые счетчики токенов, как у API, - в последнем чанке потока и за весь ответ
+    completion_text = text if completion_text is None else completion_text
+    completion_tokens = max(1, len(completion_text) // 4) if completion_text else 0
+    candidate = glm.Candidate(
+        index=0,
+        content=glm.Content(role="model", parts=[glm.Part(text=text)] if text else []),
+        finish_reason=glm.Candidate.FinishReason.STOP if finish else glm.Candidate.FinishReason.FINISH_REASON_UNSPECIFIED,
+    )
+    return glm.GenerateContentResponse(
+        candidates=[candidate],
+        usage_metadata=glm.GenerateContentResponse.UsageMetadata(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=completion_tokens,
+            total_token_count=prompt_tokens + completion_tokens,
+        ),
+    )
+
+
+def _prompt_text(request: glm.GenerateContentRequest) -> str:
+    """Flattens the system instruction and contents of a request into text for hashing (images by size)."""
+    lines: List[str] = []
+    for content in [request.system_instruction, *request.contents]:
+        for part in content.parts:
+            lines.append(part.text if part.text else f"<{part.inline_data.mime_type} {len(part.inline_data.data)}>")
+    return "\n".join(lines)
+
+
+class FakeGenerativeServiceClient:
+    """Stands in for GenerativeServiceAsyncClient of one API key: generate_content and stream_generate_content."""
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+
+    def _plan(self, model_name: str, prompt: str) -> "tuple[random.Random, float, Optional[Exception]]":
+        digest = hashlib.sha256(f"{config.seed}\x00{model_name}\x00{prompt}".encode("utf-8")).hexdigest()
+        attempt = _attempts.get(digest, 0)
+        _attempts[digest] = attempt + 1
+        rng = random.Random(f"{digest}:{attempt}")
+        latency = config.latency_median_ms / 1000.0 * math.exp(rng.gauss(0.0, config.latency_sigma))
+        roll = rng.random()
+        error: Optional[Exception] = None
+        if roll < config.rate_limit_rate:
+            error = google_exceptions.ResourceExhausted("fake Gemini: quota exceeded")
+        elif roll < config.rate_limit_rate + config.error_rate:
+            error = google_exceptions.ServiceUnavailable("fake Gemini: overloaded")
+        return rng, latency, error
+
+    @staticmethod
+    def _answer(rng: random.Random, model_name: str) -> str:
+        words = ["ответ", "модели", "для", "нагрузочного", "теста", "данные", "анализ", "итог", "пример", "текст"]
+        text = f"[{model_name}] "
+        while len(text) < config.response_chars:
+            text += rng.choice(words) + " "
+        return text.strip()
+
+    async def _start(self, request: glm.GenerateContentRequest) -> "tuple[str, int, float]":
+        """Counts the request, waits for the error latency and raises the planned error, if any."""
+        prompt = _prompt_text(request)
+        rng, latency, error = self._plan(request.model, prompt)
+        stats["requests"] += 1
+        stats["keys"][self.api_key] = stats["keys"].get(self.api_key, 0) + 1
+        stats["models"][request.model] = stats["models"].get(request.model, 0) + 1
+        if error is not None:
+            # Ошибка приходит быстрее полного ответа, как у настоящего API
+            await asyncio.sleep(latency / 4)
+            stats["rate_limited" if isinstance(error, google_exceptions.TooManyRequests) else "errors"] += 1
+            raise error
+        return self._answer(rng, request.model), max(1, len(prompt) // 4), latency
+
+    async def generate_content(self, request: glm.GenerateContentRequest, **kwargs) -> glm.GenerateContentResponse:
+        text, prompt_tokens, latency = await self._start(request)
+        await asyncio.sleep(latency)
+        return _response(text, prompt_tokens)
+
+    async def stream_generate_content(self, request: glm.GenerateContentRequest, **kwargs) -> AsyncIterator[glm.GenerateContentResponse]:
+        text, prompt_tokens, latency = await self._start(request)
+        stats["streams"] += 1
+        return _fake_stream(text, prompt_tokens, latency)
+
+
+async def _fake_stream(text: str, prompt_tokens: int, latency: float) -> AsyncIterator[glm.GenerateContentResponse]:
+    # Первый чанк - через треть задержки, остальные равномерно до конца
+    size = max(1, math.ceil(len(text) / config.stream_chunks))
+    parts = [text[i:i + size] for i in range(0, len(text), size)]
+    await asyncio.sleep(latency / 3)
+    for index, part in enumerate(parts):
+        if index:
+            await asyncio.sleep(latency * 2 / 3 / len(parts))
+        last = index == len(parts) - 1
+        yield _response(part, prompt_tokens, finish=last, completion_text=text if last else "")
+
+
+def create_client(api_key: str) -> FakeGenerativeServiceClient:
+    """Factory for GEMINI_CLIENT_FACTORY."""
+    return FakeGenerativeServiceClient(api_key)
+
+# --- END OF FILE loadtest/fake_gemini.py ---
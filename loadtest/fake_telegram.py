@@ -0,0 +1,135 @@
+# --- START OF FILE loadtest/fake_telegram.py ---
+
+import asyncio
+import itertools
+import time
+from aiohttp import web
+from loguru import logger
+from typing import Any, Callable, Dict, List, Optional
+
+# Локальный сервер Bot API для нагрузочных тестов: бот подключается к нему через
+# TELEGRAM_API_BASE. Сервер отдает боту апдейты, поставленные драйвером (getUpdates
+# с long polling), хранит "загруженные" файлы для getFile и скачивания, а ответы
+# бота (sendMessage, editMessageText, ...) записывает и передает подписчику.
+
+BOT_ID = 1000000
+
+
+class FakeTelegramServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.updates: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        self.files: Dict[str, bytes] = {}
+        self.calls: Dict[str, int] = {}
+        self.on_bot_call: Optional[Callable[[str, Dict[str, Any]], None]] = None
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self._handle_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._handle_file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # port=0: берем порт, который выбрала ОС
+        self.port = site._server.sockets[0].getsockname()[1]
+        logger.info(f"Fake Telegram Bot API listening on {self.base_url}")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    # --- Со стороны драйвера ---
+
+    def add_file(self, file_id: str, content: bytes):
+        self.files[file_id] = content
+
+    def push_message(self, user_id: int, **content) -> int:
+        """Queues a private-chat message update from user_id; returns its update_id."""
+        update_id = next(self._update_ids)
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+            **content,
+        }
+        self.updates.put_nowait({"update_id": update_id, "message": message})
+        return update_id
+
+    # --- Со стороны бота ---
+
+    async def _params(self, request: web.Request) -> Dict[str, Any]:
+        if request.content_type == "application/json":
+            return await request.json()
+        params: Dict[str, Any] = {}
+        for key, value in (await request.post()).items():
+            # Файлы (sendVoice и т.п.) не нужны - достаточно имени
+            params[key] = value.filename if isinstance(value, web.FileField) else value
+        return params
+
+    def _bot_message(self, params: Dict[str, Any], **content) -> Dict[str, Any]:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bot"},
+            **content,
+        }
+
+    async def _get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+        batch: List[Dict[str, Any]] = []
+        try:
+            batch.append(await asyncio.wait_for(self.updates.get(), timeout=timeout) if timeout else self.updates.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return []
+        while len(batch) < limit and not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        return batch
+
+    async def _handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._params(request)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        lowered = method.lower()
+
+        if lowered == "getupdates":
+            result: Any = await self._get_updates(params)
+        elif lowered == "getme":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "Load test bot", "username": "loadtest_bot"}
+        elif lowered == "getfile":
+            file_id = params.get("file_id")
+            if file_id not in self.files:
+                return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"})
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.files[file_id]),
+                      "file_path": f"files/{file_id}"}
+        elif lowered in ("sendmessage", "editmessagetext"):
+            result = self._bot_message(params, text=str(params.get("text", "")))
+        elif lowered.startswith("send") and lowered != "sendchataction":
+            result = self._bot_message(params)
+        else:
+            # deleteMessage, sendChatAction, setMyCommands, deleteWebhook, answerCallbackQuery, ...
+            result = True
+
+        if self.on_bot_call and lowered != "getupdates":
+            self.on_bot_call(method, params)
+        return web.json_response({"ok": True, "result": result})
+
+    async def _handle_file(self, request: web.Request) -> web.Response:
+        file_id = request.match_info["path"].rsplit("/", 1)[-1]
+        content = self.files.get(file_id)
+        if content is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=content, content_type="application/octet-stream")
+
+# --- END OF FILE loadtest/fake_telegram.py ---
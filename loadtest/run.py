@@ -0,0 +1,337 @@
+# --- START OF FILE loadtest/run.py ---
+
+"""
+Offline load test: the bot's real handlers against a fake Bot API server and a fake Gemini.
+
+    python -m loadtest.run --users 50 --messages 10 --mix text=6,photo=2,voice=1,document=1
+
+Each simulated user sends a message, waits until the bot has finished handling it,
+pauses for a random think time and sends the next one. Reports p50/p95/p99 latency
+and throughput per handler. Nothing leaves the machine: Gemini is replaced through
+GEMINI_CLIENT_FACTORY (the API client of each key: models, the key pool and
+model failover are the real ones), Telegram through TELEGRAM_API_BASE, and speech recognition
+and OCR (the only other external calls on these paths) are replaced in-process.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from loadtest.fake_telegram import FakeTelegramServer
+
+KINDS = ("text", "photo", "voice", "document")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m loadtest.run", description="Offline load test of the bot.")
+    parser.add_argument("--users", type=int, default=20, help="concurrent simulated users")
+    parser.add_argument("--messages", type=int, default=5, help="messages per user")
+    parser.add_argument("--mix", default="text=6,photo=2,voice=1,document=1", help="message kind weights")
+    parser.add_argument("--think-ms", type=float, default=500, help="mean pause between a user's messages")
+    parser.add_argument("--doc-kb", type=int, default=40, help="size of generated text documents")
+    parser.add_argument("--timeout", type=float, default=180, help="max seconds to wait for one message")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--gemini-latency-ms", type=float, default=800, help="median fake Gemini latency")
+    parser.add_argument("--gemini-sigma", type=float, default=0.5, help="lognormal sigma of the latency")
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0, help="share of 503 responses")
+    parser.add_argument("--gemini-429-rate", type=float, default=0.0, help="share of 429 responses")
+    parser.add_argument("--json", dest="json_path", help="also write the report to this file")
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args(argv)
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix: Dict[str, float] = {}
+    for item in (part.strip() for part in spec.split(",")):
+        if not item:
+            continue
+        kind, _, weight = item.partition("=")
+        if kind not in KINDS:
+            raise SystemExit(f"Unknown message kind '{kind}', expected one of {', '.join(KINDS)}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def prepare_environment(args: argparse.Namespace, workdir: Path, api_base: str):
+    """Settings are read at import: everything must be in the environment before config is imported."""
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "123456:LOADTEST",
+        "TELEGRAM_API_BASE": api_base,
+        "GEMINI_API_KEY": "loadtest",
+        # Два ключа и запасная модель: нагрузка идет через пул ключей и переключение моделей
+        "GEMINI_API_KEYS": "loadtest-key-1,loadtest-key-2",
+        "GEMINI_FALLBACK_MODEL": "gemini-loadtest-fallback",
+        "GEMINI_CLIENT_FACTORY": "loadtest.fake_gemini:create_client",
+        "AUTHORIZED_USERS": "",
+        "DATABASE_FILE": str(workdir / "loadtest.db"),
+        "TEMP_DIR": str(workdir / "temp"),
+        "TABLE_CACHE_DIR": str(workdir / "tables"),
+        "LOG_FILE": str(workdir / "bot.log"),
+        "LOG_LEVEL": args.log_level,
+        "FAKE_GEMINI_LATENCY_MS": str(args.gemini_latency_ms),
+        "FAKE_GEMINI_LATENCY_SIGMA": str(args.gemini_sigma),
+        "FAKE_GEMINI_ERROR_RATE": str(args.gemini_error_rate),
+        "FAKE_GEMINI_429_RATE": str(args.gemini_429_rate),
+        "FAKE_GEMINI_SEED": str(args.seed),
+    })
+    # Квоты ключа по умолчанию рассчитаны на настоящий API; их можно задать явно
+    os.environ.setdefault("GEMINI_RPM", "0")
+    os.environ.setdefault("GEMINI_TPM", "0")
+
+
+def install_offline_services():
+    """Replaces speech recognition and OCR (Google Web Speech, tesseract) with deterministic stand-ins."""
+    from services import image_analyzer, speech
+    from utils.helpers import cleanup_temp_file
+
+    async def fake_recognize_speech(ogg_filepath: Path) -> Optional[str]:
+        await asyncio.sleep(0.3)
+        await cleanup_temp_file(ogg_filepath)
+        return f"расскажи что-нибудь интересное про {ogg_filepath.stem[-6:]}"
+
+    async def fake_extract_text(image_path: Path) -> Optional[str]:
+        await asyncio.sleep(0.05)
+        return ""
+
+    speech.recognize_speech = fake_recognize_speech
+    image_analyzer.extract_text_from_image = fake_extract_text
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    rank = max(1, min(len(values), round(q / 100 * len(values) + 0.5)))
+    return values[rank - 1]
+
+
+class LatencyTracker:
+    """Dispatcher middlewares that time each update from enqueueing to the end of its handler."""
+
+    def __init__(self):
+        self.enqueued: Dict[int, float] = {}
+        self.waiters: Dict[int, asyncio.Future] = {}
+        self.handler_names: Dict[int, str] = {}
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def expect(self, update_id: int) -> asyncio.Future:
+        self.enqueued[update_id] = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[update_id] = future
+        return future
+
+    async def outer(self, handler, event, data):
+        failed = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._finish(event.update_id, failed)
+
+    async def inner(self, handler, event, data):
+        self.handler_names[data["event_update"].update_id] = data["handler"].callback.__name__
+        return await handler(event, data)
+
+    def _finish(self, update_id: int, failed: bool):
+        started = self.enqueued.pop(update_id, None)
+        name = self.handler_names.pop(update_id, "unhandled")
+        if started is not None:
+            self.samples.setdefault(name, []).append(time.monotonic() - started)
+        if failed:
+            self.errors[name] = self.errors.get(name, 0) + 1
+        future = self.waiters.pop(update_id, None)
+        if future and not future.done():
+            future.set_result(name)
+
+
+class Workload:
+    def __init__(self, args: argparse.Namespace, server: FakeTelegramServer, tracker: LatencyTracker):
+        self.args = args
+        self.server = server
+        self.tracker = tracker
+        self.mix = parse_mix(args.mix)
+        self.timeouts = 0
+        self._image = self._make_image()
+
+    @staticmethod
+    def _make_image() -> bytes:
+        from PIL import Image, ImageDraw
+        image = Image.new("RGB", (640, 480), "white")
+        ImageDraw.Draw(image).text((40, 200), "load test", fill="black")
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG")
+        return buffer.getvalue()
+
+    def _document(self, rng: random.Random, tag: str) -> bytes:
+        words = ["отчет", "продажи", "квартал", "рост", "план", "клиенты", "регион", "выручка", "расходы", "итоги"]
+        paragraphs, size = [], 0
+        while size < self.args.doc_kb * 1024:
+            paragraph = f"{tag} " + " ".join(rng.choice(words) for _ in range(80))
+            paragraphs.append(paragraph)
+            size += len(paragraph.encode("utf-8")) + 2
+        return "\n\n".join(paragraphs).encode("utf-8")
+
+    def push(self, user_id: int, kind: str, rng: random.Random, seq: int) -> int:
+        # Уникальные id и содержимое: иначе сработают кэш ответов и объединение одинаковых задач
+        tag = f"u{user_id}m{seq}s{self.args.seed}"
+        if kind == "text":
+            return self.server.push_message(user_id, text=f"Вопрос {tag}: объясни, как работает очередь задач?")
+        if kind == "photo":
+            file_id = f"photo_{tag}"
+            self.server.add_file(file_id, self._image)
+            return self.server.push_message(user_id, photo=[
+                {"file_id": file_id, "file_unique_id": file_id, "width": 640, "height": 480, "file_size": len(self._image)},
+            ])
+        if kind == "voice":
+            file_id = f"voice_{tag}"
+            self.server.add_file(file_id, b"OggS" + os.urandom(2048))
+            return self.server.push_message(user_id, voice={
+                "file_id": file_id, "file_unique_id": file_id, "duration": 3, "mime_type": "audio/ogg", "file_size": 2052,
+            })
+        file_id = f"doc_{tag}"
+        content = self._document(rng, tag)
+        self.server.add_file(file_id, content)
+        return self.server.push_message(user_id, document={
+            "file_id": file_id, "file_unique_id": file_id, "file_name": f"{file_id}.txt",
+            "mime_type": "text/plain", "file_size": len(content),
+        })
+
+    async def simulate_user(self, user_id: int):
+        rng = random.Random(f"{self.args.seed}:{user_id}")
+        kinds, weights = list(self.mix), list(self.mix.values())
+        # Пользователи начинают не одновременно
+        await asyncio.sleep(rng.uniform(0, self.args.think_ms / 1000))
+        for seq in range(self.args.messages):
+            kind = rng.choices(kinds, weights)[0]
+            update_id = self.push(user_id, kind, rng, seq)
+            try:
+                await asyncio.wait_for(self.tracker.expect(update_id), timeout=self.args.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                logger.error(f"User {user_id}: {kind} message (update {update_id}) not handled within {self.args.timeout:.0f}s")
+            if self.args.think_ms > 0:
+                await asyncio.sleep(rng.expovariate(1000 / self.args.think_ms))
+
+
+def build_report(tracker: LatencyTracker, elapsed: float, timeouts: int) -> Dict[str, Any]:
+    from loadtest import fake_gemini
+    from services import gemini_client
+
+    handlers = {}
+    for name, samples in sorted(tracker.samples.items()):
+        values = sorted(samples)
+        handlers[name] = {
+            "count": len(values),
+            "errors": tracker.errors.get(name, 0),
+            "throughput_per_sec": len(values) / elapsed if elapsed else 0.0,
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": values[-1],
+        }
+    total = sum(item["count"] for item in handlers.values())
+    gemini_stats = gemini_client.get_stats()
+    return {
+        "elapsed_sec": elapsed,
+        "messages": total,
+        "throughput_per_sec": total / elapsed if elapsed else 0.0,
+        "timeouts": timeouts,
+        "handlers": handlers,
+        "fake_gemini": dict(fake_gemini.stats),
+        "gemini_client": {key: value for key, value in gemini_stats.items() if key != "pool"},
+    }
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"\n{report['messages']} messages in {report['elapsed_sec']:.1f}s "
+          f"({report['throughput_per_sec']:.2f} msg/s), timeouts: {report['timeouts']}")
+    header = f"{'handler':<28}{'count':>7}{'errors':>8}{'msg/s':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, item in report["handlers"].items():
+        print(f"{name:<28}{item['count']:>7}{item['errors']:>8}{item['throughput_per_sec']:>8.2f}"
+              f"{item['p50']:>8.2f}s{item['p95']:>8.2f}s{item['p99']:>8.2f}s{item['max']:>8.2f}s")
+    print(f"\nfake Gemini: {report['fake_gemini']}")
+    scheduler = report["gemini_client"].get("scheduler", {})
+    for class_name, queue in scheduler.get("classes", {}).items():
+        print(f"scheduler {class_name}: dispatched {queue['dispatched']}, wait avg {queue['wait_avg']:.2f}s, "
+              f"p95 {queue['wait_p95']:.2f}s, max {queue['wait_max']:.2f}s")
+
+
+async def run(args: argparse.Namespace) -> int:
+    with tempfile.TemporaryDirectory(prefix="loadtest_") as workdir:
+        server = FakeTelegramServer()
+        await server.start()
+        prepare_environment(args, Path(workdir), server.base_url)
+
+        # Импорт приложения - только после того, как окружение готово
+        # (main.py не импортируем: он настраивает логирование под рабочий сервер)
+        from aiogram import Bot, Dispatcher
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+        from bot.handlers import router as main_router
+        from config import settings
+        from services import cpu_pool, database
+
+        # Импорт настроек переназначает обработчики loguru - возвращаем свои
+        logger.remove()
+        logger.add(sys.stderr, level=args.log_level.upper())
+        install_offline_services()
+        await database.init_db()
+        bot = Bot(token=settings.TELEGRAM_BOT_TOKEN,
+                  session=AiohttpSession(api=TelegramAPIServer.from_base(settings.TELEGRAM_API_BASE)))
+        tracker = LatencyTracker()
+        dp = Dispatcher()
+        dp.update.outer_middleware(tracker.outer)
+        dp.message.middleware(tracker.inner)
+        dp.include_router(main_router)
+        polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=True, polling_timeout=1))
+
+        workload = Workload(args, server, tracker)
+        started = time.monotonic()
+        try:
+            await asyncio.gather(*(workload.simulate_user(100000 + index) for index in range(args.users)))
+            elapsed = time.monotonic() - started
+        finally:
+            try:
+                await dp.stop_polling()
+            except RuntimeError:  # опрос еще не успел запуститься
+                polling.cancel()
+            await asyncio.gather(polling, return_exceptions=True)
+            await database.close_db()
+            await cpu_pool.shutdown()
+            await server.stop()
+
+        report = build_report(tracker, elapsed, workload.timeouts)
+        print_report(report)
+        if args.json_path:
+            Path(args.json_path).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        failed = workload.timeouts + sum(item["errors"] for item in report["handlers"].values())
+        return 1 if failed else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level.upper())
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# --- END OF FILE loadtest/run.py ---
@@ -6,6 +6,8 @@ import sys
 import google.generativeai as genai
 from loguru import logger
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
 from aiogram.types import BotCommand, BotCommandScopeDefault, BotCommandScopeChat
 from aiogram.exceptions import (
@@ -47,7 +49,7 @@ except Exception as e:
 
 # Импортируем остальные компоненты после настройки логгера
 try:
-    from services import database, gemini # Импортируем сервисы
+    from services import database, gemini, cpu_pool # Импортируем сервисы
     from bot.handlers import router as main_router
     from bot.middleware import AuthMiddleware
 except ImportError as e:
@@ -67,6 +69,7 @@ async def set_bot_commands(bot: Bot):
     admin_commands = commands_for_users + [
         BotCommand(command="admin", description="🛠️ Админ-панель"),
         BotCommand(command="status", description="📊 Статус сервиса"),
+        BotCommand(command="usage", description="📈 Расход токенов AI по пользователям"),
         BotCommand(command="restart", description="🔄 Перезапустить бота"),
     ]
 
@@ -108,6 +111,14 @@ async def set_bot_commands(bot: Bot):
     except Exception as e:
         logger.error(f"Failed to set bot commands: {e}")
 
+def create_bot() -> Bot:
+    """Bot bound to api.telegram.org or to TELEGRAM_API_BASE (local Bot API server, load-test fake)."""
+    session = None
+    if settings.TELEGRAM_API_BASE:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(settings.TELEGRAM_API_BASE))
+        logger.info(f"Using Telegram Bot API server at {settings.TELEGRAM_API_BASE}")
+    return Bot(token=settings.TELEGRAM_BOT_TOKEN, session=session)
+
 # --- Main Application Logic ---
 async def main():
     logger.info("Starting bot application...")
@@ -146,7 +157,7 @@ async def main():
 
     # --- Bot and Dispatcher Initialization ---
     logger.info("Initializing bot...")
-    bot = Bot(token=settings.TELEGRAM_BOT_TOKEN)
+    bot = create_bot()
     try:
         user = await bot.get_me()
         logger.info(f"Bot instance created and token verified for bot ID {user.id} (@{user.username})")
@@ -218,6 +229,15 @@ async def main():
         except Exception as close_err:
              logger.error(f"Error closing bot session: {close_err}")
 
+        # Закрываем пул соединений с базой данных
+        try:
+            await database.close_db()
+        except Exception as db_close_err:
+            logger.error(f"Error closing database connections: {db_close_err}")
+
+        # Останавливаем процессы разбора файлов
+        await cpu_pool.shutdown()
+
         logger.info(f"Bot shutdown {'complete' if session_closed_cleanly else 'finished with potential issues'}.")
 
 # --- Graceful Shutdown Handling ---
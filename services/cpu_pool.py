@@ -0,0 +1,67 @@
+# --- START OF FILE services/cpu_pool.py ---
+
+import asyncio
+from loguru import logger
+from typing import Any, Callable, Dict, Optional
+
+from config import settings
+from utils.process_pool import ProcessPool, ProcessPoolError, JobTimeoutError, PoolOverloadedError, WorkerCrashedError
+
+# Общий пул процессов для разбора файлов и OCR (функции из services/extractors.py).
+# Процессы запускаются при первой задаче; при CPU_POOL_WORKERS=0 задачи выполняются
+# в потоках через asyncio.to_thread - без изоляции, а дедлайн лишь перестает ждать поток.
+
+_pool: Optional[ProcessPool] = None
+
+
+def workers() -> int:
+    """Number of worker processes (0 - jobs run in threads)."""
+    return settings.CPU_POOL_WORKERS
+
+
+def _get_pool() -> ProcessPool:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPool(
+            settings.CPU_POOL_WORKERS,
+            max_jobs_per_worker=settings.CPU_POOL_MAX_JOBS_PER_WORKER,
+            max_queue=settings.CPU_POOL_MAX_QUEUE,
+            default_timeout=settings.CPU_JOB_TIMEOUT_SEC,
+            log_level=settings.LOG_LEVEL,
+        )
+        logger.info(f"CPU process pool: up to {settings.CPU_POOL_WORKERS} worker(s).")
+    return _pool
+
+
+async def run(fn: Callable[..., Any], *args: Any, timeout: Optional[float] = None) -> Any:
+    """
+    Runs a module-level blocking function in the process pool (or a thread if the pool is off).
+    Raises ProcessPoolError subclasses for deadline, overload and crashed workers.
+    """
+    if settings.CPU_POOL_WORKERS <= 0:
+        # Поток прервать нельзя: по дедлайну перестаем ждать, а сама задача доработает в фоне
+        effective_timeout = settings.CPU_JOB_TIMEOUT_SEC if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(asyncio.to_thread(fn, *args), effective_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{getattr(fn, '__name__', fn)} exceeded {effective_timeout}s in a thread; "
+                           f"it keeps running in the background.")
+            raise JobTimeoutError(f"Задача не завершилась за {effective_timeout} с") from None
+    return await _get_pool().run(fn, *args, timeout=timeout)
+
+
+def get_stats() -> Optional[Dict[str, Any]]:
+    """Pool counters, or None when jobs run in threads."""
+    if settings.CPU_POOL_WORKERS <= 0:
+        return None
+    return _get_pool().stats()
+
+
+async def shutdown():
+    """Stops the worker processes and waits for them to exit (on bot shutdown)."""
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+
+# --- END OF FILE services/cpu_pool.py ---
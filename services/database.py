@@ -1,13 +1,259 @@
+import asyncio
+import datetime
+import sys
+import time
+import zlib
 import aiosqlite
+from collections import deque
+from contextlib import asynccontextmanager
 from loguru import logger
 from config import settings
-from typing import List, Tuple, Optional, Dict
+from typing import Any, List, Tuple, Optional, Dict, AsyncIterator
+from utils.cache import LRUCache
+from utils.helpers import estimate_tokens
 
 DATABASE = settings.DATABASE_FILE
 
+# --- Connection pool ---
+# Соединения открываются один раз в init_db() и живут до close_db().
+# Писатель один (SQLite всё равно сериализует запись), читателей - небольшой пул.
+_writer: Optional[aiosqlite.Connection] = None
+_write_lock = asyncio.Lock()
+_readers: Optional[asyncio.Queue] = None
+_reader_connections: List[aiosqlite.Connection] = []
+
+# --- Write-behind message log ---
+# add_message() только ставит строку в очередь; фоновый flusher пишет накопленное
+# от всех пользователей одной транзакцией. _flush_epoch работает как seqlock:
+# нечетное значение - батч сейчас коммитится, читатели истории ждут и перечитывают.
+_pending_messages: List[Tuple[int, Dict[str, Any]]] = []  # (user_id, {"role", "content", "tokens"})
+_flush_lock = asyncio.Lock()
+_flush_wakeup = asyncio.Event()
+_flusher_stop = asyncio.Event()  # close_db(): flusher дописывает текущий батч и выходит
+_flush_epoch = 0
+_flusher_task: Optional[asyncio.Task] = None
+
+# --- History compaction ---
+# Обрезка старых сообщений вынесена из пути записи: flusher лишь помечает
+# пользователей, а компактор периодически удаляет всё ниже max(seq) - keep.
+# При включенных сводках удаляется только то, что уже вошло в сводку (summaries.covered_seq):
+# пока сводка отстает (медленная или неудачная), старые реплики ждут ее, но не больше
+# _HISTORY_BACKSTOP последних сообщений - иначе при постоянных ошибках история росла бы без предела.
+_HISTORY_KEEP = settings.MAX_CONTEXT_MESSAGES * 2  # *2 to roughly keep pairs
+_HISTORY_BACKSTOP = _HISTORY_KEEP * 10
+_dirty_users: set = set()
+_compactor_task: Optional[asyncio.Task] = None
+
+# --- Usage accounting ---
+# Счетчики расхода токенов копятся в памяти и пишутся тем же flusher'ом одним upsert
+# на (user_id, day, call_type). Дневной расход пользователя держится в памяти для
+# проверки квоты перед вызовом.
+_pending_usage: Dict[Tuple[int, str, str], List[int]] = {}  # -> [calls, prompt, completion, total, latency_ms]
+_usage_today: Dict[int, int] = {}  # user_id -> total_tokens за _usage_day
+_usage_day = ""
+
+# --- User settings cache ---
+# Настройки читаются на каждое сообщение, а меняются редко: держим их в LRU,
+# заполняем при первом чтении и обновляем write-through в update_user_mood/toggle_speak_mode.
+_settings_cache = LRUCache(settings.USER_SETTINGS_CACHE_SIZE)
+
+# --- Recent history cache ---
+# Последние _HISTORY_KEEP сообщений активных пользователей в deque. Кэш поддерживается
+# синхронно с add_message() (включая еще не записанные строки), гидратируется из SQLite
+# при промахе и вытесняет простаивающих пользователей по LRU при превышении бюджета памяти.
+_history_cache = LRUCache(
+    settings.HISTORY_CACHE_MAX_USERS,
+    max_weight=settings.HISTORY_CACHE_MAX_MB * 1024 * 1024,
+)
+
+# Сводки разговоров читаются на каждый запрос к Gemini; "" - сводки нет
+_summary_cache = LRUCache(settings.USER_SETTINGS_CACHE_SIZE)
+
+# Документы неизменяемы: их текст для истории и оценку токенов можно кэшировать без инвалидации
+_document_text_cache = LRUCache(1000, max_weight=settings.DOCUMENT_CACHE_MAX_MB * 1024 * 1024)
+_document_tokens = LRUCache(10000)
+
+def _message_weight(message: Dict[str, str]) -> int:
+    return sys.getsizeof(message["content"])
+
+# --- Content compression ---
+# Большие значения (в основном текст файлов) хранятся как BLOB: маркер + zlib.
+# Обычные реплики остаются TEXT и на общем пути ничего не стоят.
+_COMPRESSED_MARKER = b"\x01"
+
+def _encode_content(content: str):
+    """Compresses content above HISTORY_COMPRESS_THRESHOLD bytes; returns str or marked bytes."""
+    if content is None or len(content) < settings.HISTORY_COMPRESS_THRESHOLD // 4:
+        return content  # быстрый выход: заведомо короче порога даже в 4-байтовом UTF-8
+    raw = content.encode("utf-8")
+    if len(raw) < settings.HISTORY_COMPRESS_THRESHOLD:
+        return content
+    packed = _COMPRESSED_MARKER + zlib.compress(raw, settings.HISTORY_COMPRESS_LEVEL)
+    return packed if len(packed) < len(raw) else content
+
+def _decode_content(value) -> Optional[str]:
+    """Reverses _encode_content(); plain TEXT values pass through untouched."""
+    if isinstance(value, bytes):
+        if value[:1] == _COMPRESSED_MARKER:
+            return zlib.decompress(value[1:]).decode("utf-8")
+        return value.decode("utf-8", errors="replace")
+    return value
+
+async def _open_connection() -> aiosqlite.Connection:
+    """Opens a connection with WAL journal and statement cache enabled."""
+    # cached_statements передается в sqlite3.connect: подготовленные выражения переиспользуются
+    db = await aiosqlite.connect(DATABASE, cached_statements=settings.DB_STATEMENT_CACHE_SIZE)
+    await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("PRAGMA busy_timeout=5000")
+    return db
+
+@asynccontextmanager
+async def _write_connection() -> AsyncIterator[aiosqlite.Connection]:
+    """Yields the shared writer connection, serializing writers."""
+    if _writer is None:
+        raise RuntimeError("Database is not initialized. Call init_db() first.")
+    async with _write_lock:
+        yield _writer
+
+@asynccontextmanager
+async def _read_connection() -> AsyncIterator[aiosqlite.Connection]:
+    """Borrows a reader connection from the pool and returns it afterwards."""
+    if _readers is None:
+        raise RuntimeError("Database is not initialized. Call init_db() first.")
+    db = await _readers.get()
+    try:
+        yield db
+    finally:
+        _readers.put_nowait(db)
+
+# --- Schema migrations ---
+# Версия схемы хранится в PRAGMA user_version. Новая БД создается в исходной
+# форме (v0) и проходит те же миграции, что и существующие файлы bot.db.
+
+async def _column_exists(db: aiosqlite.Connection, table: str, column: str) -> bool:
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        return any(row[1] == column for row in await cursor.fetchall())
+
+async def _migrate_v1_message_seq(db: aiosqlite.Connection):
+    """v1: per-user monotonically increasing seq with a (user_id, seq) index."""
+    if not await _column_exists(db, "messages", "seq"):
+        await db.execute("ALTER TABLE messages ADD COLUMN seq INTEGER")
+    # Нумеруем существующие строки в порядке вставки (id), а не по timestamp с точностью до секунды
+    await db.execute('''
+        UPDATE messages SET seq = (
+            SELECT COUNT(*) FROM messages AS m2
+            WHERE m2.user_id = messages.user_id AND m2.id <= messages.id
+        )
+        WHERE seq IS NULL
+    ''')
+    await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_user_seq ON messages (user_id, seq)")
+    await db.execute("DROP INDEX IF EXISTS idx_user_timestamp")
+
+async def _migrate_v2_message_tokens(db: aiosqlite.Connection):
+    """v2: precomputed approximate token count per message."""
+    if not await _column_exists(db, "messages", "tokens"):
+        await db.execute("ALTER TABLE messages ADD COLUMN tokens INTEGER")
+    # Та же оценка, что и estimate_tokens(): ~4 байта UTF-8 на токен
+    await db.execute('''
+        UPDATE messages SET tokens = MAX(1, (LENGTH(CAST(content AS BLOB)) + 3) / 4)
+        WHERE tokens IS NULL
+    ''')
+
+async def _migrate_v3_documents(db: aiosqlite.Connection):
+    """v3: content-addressed documents table referenced from messages.doc_id."""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS documents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            content_hash TEXT NOT NULL UNIQUE, -- sha256 исходного файла
+            filename TEXT,
+            mime_type TEXT,
+            status TEXT,
+            extracted_text BLOB, -- через _encode_content(), может быть сжат
+            analysis TEXT,
+            tokens INTEGER, -- оценка токенов фрагмента, подставляемого в историю
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    if not await _column_exists(db, "messages", "doc_id"):
+        await db.execute("ALTER TABLE messages ADD COLUMN doc_id INTEGER REFERENCES documents(id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_messages_doc_id ON messages (doc_id) WHERE doc_id IS NOT NULL")
+
+async def _migrate_v4_ai_cache(db: aiosqlite.Connection):
+    """v4: persistent tier of the Gemini result cache."""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS ai_cache (
+            cache_key TEXT PRIMARY KEY, -- sha256(call_type, model, prompt, content hash)
+            call_type TEXT,
+            value BLOB, -- через _encode_content(), может быть сжат
+            expires_at REAL NOT NULL, -- unix time
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_ai_cache_expires ON ai_cache (expires_at)")
+
+async def _migrate_v5_summaries(db: aiosqlite.Connection):
+    """v5: rolling per-user conversation summaries."""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            covered_seq INTEGER NOT NULL, -- последнее сообщение, вошедшее в summary
+            tokens INTEGER,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+async def _migrate_v6_usage_stats(db: aiosqlite.Connection):
+    """v6: aggregated Gemini usage counters per user, day and call type."""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS usage_stats (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL, -- YYYY-MM-DD (локальная дата)
+            call_type TEXT NOT NULL, -- text, stream, vision, file, translate, summary
+            calls INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            total_tokens INTEGER NOT NULL DEFAULT 0,
+            latency_ms INTEGER NOT NULL DEFAULT 0, -- сумма, среднее = latency_ms / calls
+            PRIMARY KEY (user_id, day, call_type)
+        )
+    ''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_usage_stats_day ON usage_stats (day)")
+
+_MIGRATIONS = [
+    _migrate_v1_message_seq,
+    _migrate_v2_message_tokens,
+    _migrate_v3_documents,
+    _migrate_v4_ai_cache,
+    _migrate_v5_summaries,
+    _migrate_v6_usage_stats,
+]
+SCHEMA_VERSION = len(_MIGRATIONS)
+
+async def _apply_migrations(db: aiosqlite.Connection):
+    """Brings the schema up to SCHEMA_VERSION, one committed step at a time."""
+    async with db.execute("PRAGMA user_version") as cursor:
+        current_version = (await cursor.fetchone())[0]
+    if current_version > SCHEMA_VERSION:
+        logger.warning(f"Database schema version {current_version} is newer than supported ({SCHEMA_VERSION}).")
+        return
+    for version in range(current_version + 1, SCHEMA_VERSION + 1):
+        migration = _MIGRATIONS[version - 1]
+        logger.info(f"Applying database migration v{version}: {migration.__doc__}")
+        await migration(db)
+        # PRAGMA не принимает плейсхолдеры; version - наше собственное число
+        await db.execute(f"PRAGMA user_version = {version}")
+        await db.commit()
+
 async def init_db():
-    """Initializes the database and creates tables if they don't exist."""
-    async with aiosqlite.connect(DATABASE) as db:
+    """Opens the connection pool and creates tables if they don't exist."""
+    global _writer, _readers, _flusher_task, _compactor_task
+    if _writer is not None:
+        logger.warning("init_db() called twice, connection pool is already open.")
+        return
+    _writer = await _open_connection()
+    async with _write_connection() as db:
         # Table for user settings
         # Встраиваем значение DEFAULT напрямую, т.к. плейсхолдеры здесь не работают
         # Экранируем одинарные кавычки на всякий случай (хотя для 'friendly' и т.д. не нужно)
@@ -31,113 +277,670 @@ async def init_db():
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        await db.execute('''
-            CREATE INDEX IF NOT EXISTS idx_user_timestamp ON messages (user_id, timestamp);
-        ''')
         await db.commit()
-    logger.info(f"Database initialized successfully at {DATABASE}")
+        await _apply_migrations(db)
+
+    # Читатели открываются после создания схемы, чтобы сразу видеть таблицы
+    _readers = asyncio.Queue()
+    for _ in range(settings.DB_READER_POOL_SIZE):
+        reader = await _open_connection()
+        _reader_connections.append(reader)
+        _readers.put_nowait(reader)
+    _flusher_task = asyncio.create_task(_flusher_loop(), name="db-message-flusher")
+    _compactor_task = asyncio.create_task(_compactor_loop(), name="db-history-compactor")
+    logger.info(f"Database initialized successfully at {DATABASE} (1 writer, {settings.DB_READER_POOL_SIZE} readers, WAL)")
+
+async def close_db():
+    """Flushes pending writes and closes all pooled connections. Safe to call more than once."""
+    global _writer, _readers, _flusher_task, _compactor_task
+    if _compactor_task is not None:
+        _compactor_task.cancel()
+        try:
+            await _compactor_task
+        except asyncio.CancelledError:
+            pass
+    if _flusher_task is not None:
+        # Не отменяем: отмена посреди транзакции потеряла бы уже снятый с очереди батч
+        _flusher_stop.set()
+        _flush_wakeup.set()
+        try:
+            await _flusher_task
+        except Exception as e:
+            logger.error(f"Message flusher stopped with an error: {e}")
+        _flusher_stop.clear()
+    _flusher_task = None
+    _compactor_task = None
+    if _writer is not None:
+        # Гарантированный сброс очереди перед закрытием соединений
+        await flush_pending_messages()
+        if _pending_messages:
+            logger.error(f"{len(_pending_messages)} history message(s) could not be written on shutdown.")
+        try:
+            await flush_usage()
+        except Exception as e:
+            logger.error(f"Usage counters could not be written on shutdown: {e}")
+    async with _write_lock:
+        for reader in _reader_connections:
+            try:
+                await reader.close()
+            except Exception as e:
+                logger.error(f"Error closing reader connection: {e}")
+        _reader_connections.clear()
+        _readers = None
+        if _writer is not None:
+            try:
+                await _writer.close()
+            except Exception as e:
+                logger.error(f"Error closing writer connection: {e}")
+            _writer = None
+    logger.info("Database connections closed.")
+
+async def _flusher_loop():
+    """Background task: flushes queued history writes every few milliseconds or N rows."""
+    interval = settings.DB_FLUSH_INTERVAL_MS / 1000
+    while not _flusher_stop.is_set():
+        try:
+            await asyncio.wait_for(_flush_wakeup.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        _flush_wakeup.clear()
+        if _flusher_stop.is_set():
+            break  # остаток очереди сбросит close_db()
+        try:
+            await flush_pending_messages()
+        except Exception as e:
+            # Строки остаются в очереди и будут записаны на следующей итерации
+            logger.error(f"Error flushing message history batch: {e}")
+        try:
+            await flush_usage()
+        except Exception as e:
+            logger.error(f"Error flushing usage counters: {e}")
+
+async def flush_pending_messages():
+    """Writes all queued history messages in a single transaction."""
+    global _flush_epoch
+    async with _flush_lock:
+        if not _pending_messages:
+            return
+        batch = _pending_messages[:]
+        del _pending_messages[:]
+        _flush_epoch += 1  # нечетное: батч в полете
+        # Запись и commit - отдельной задачей под shield: отмена вызывающего не прерывает
+        # транзакцию на середине, а дожидается ее исхода
+        write = asyncio.ensure_future(_write_batch(batch))
+        try:
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                await asyncio.wait([write])
+                raise
+        except BaseException:
+            if write.cancelled() or write.exception() is not None:
+                # Возвращаем батч в начало очереди, сохраняя порядок
+                _pending_messages[:0] = batch
+            else:
+                _dirty_users.update(row[0] for row in batch)
+            raise
+        finally:
+            _flush_epoch += 1  # снова четное: батч либо в БД, либо снова в очереди
+        _dirty_users.update(row[0] for row in batch)
+        logger.debug(f"Flushed {len(batch)} history message(s) in one transaction.")
+
+async def _write_batch(batch: List[Tuple[int, Dict[str, Any]]]):
+    async with _write_connection() as db:
+        # seq = MAX(seq) + 1 для пользователя: поиск по индексу (user_id, seq), O(log n)
+        await db.executemany(
+            "INSERT INTO messages (user_id, seq, role, content, tokens, doc_id) VALUES "
+            "(?, COALESCE((SELECT MAX(seq) FROM messages WHERE user_id = ?), 0) + 1, ?, ?, ?, ?)",
+            [(user_id, user_id, m["role"], _encode_content(m["content"]), m["tokens"], m.get("doc_id"))
+             for user_id, m in batch]
+        )
+        await db.commit()
+
+async def _compactor_loop():
+    """Background task: periodically trims history of users who wrote since the last pass."""
+    # Первый проход - по всем пользователям (подчищает хвосты после миграции или сбоя)
+    all_users = True
+    while True:
+        try:
+            await compact_history(all_users=all_users)
+            all_users = False
+        except Exception as e:
+            logger.error(f"Error compacting message history: {e}")
+        try:
+            await purge_ai_cache()
+        except Exception as e:
+            logger.error(f"Error purging AI result cache: {e}")
+        await asyncio.sleep(settings.DB_COMPACT_INTERVAL_SEC)
 
-async def add_message(user_id: int, role: str, content: str):
-    """Adds a message to the history and prunes old messages."""
-    async with aiosqlite.connect(DATABASE) as db:
+def _trim_bound_sql(user_id_sql: str) -> str:
+    """SQL expression for the highest seq compaction may delete for the user given by user_id_sql."""
+    max_seq = f"(SELECT MAX(seq) FROM messages AS m2 WHERE m2.user_id = {user_id_sql})"
+    if settings.SUMMARY_TRIGGER_TOKENS <= 0:
+        return f"{max_seq} - :keep"
+    covered = f"COALESCE((SELECT covered_seq FROM summaries WHERE summaries.user_id = {user_id_sql}), 0)"
+    return f"MAX(MIN({max_seq} - :keep, {covered}), {max_seq} - :backstop)"
+
+async def compact_history(all_users: bool = False):
+    """
+    Deletes messages below max(seq) - keep for dirty users (or everyone if all_users),
+    but with summaries on only those already folded into the user's summary.
+    """
+    limits = {"keep": _HISTORY_KEEP, "backstop": _HISTORY_BACKSTOP}
+    if all_users:
+        async with _write_connection() as db:
+            cursor = await db.execute(f'''
+                DELETE FROM messages
+                WHERE seq <= {_trim_bound_sql("messages.user_id")}
+            ''', limits)
+            removed_messages = cursor.rowcount
+            # Документы, на которые больше не ссылается история, живут DOCUMENT_RETENTION_DAYS
+            # (пока живы - повторная отправка того же файла берет готовый анализ)
+            cursor = await db.execute('''
+                DELETE FROM documents
+                WHERE created_at < datetime('now', ?)
+                  AND NOT EXISTS (SELECT 1 FROM messages WHERE messages.doc_id = documents.id)
+            ''', (f"-{settings.DOCUMENT_RETENTION_DAYS} days",))
+            await db.commit()
+        _dirty_users.clear()
+        logger.info(f"Full history compaction removed {removed_messages} message(s) and {cursor.rowcount} stale document(s).")
+        return
+    if not _dirty_users:
+        return
+    users = list(_dirty_users)
+    _dirty_users.clear()
+    try:
+        async with _write_connection() as db:
+            # Один range delete по индексу на пользователя, без сортировки и NOT IN
+            await db.executemany(f'''
+                DELETE FROM messages
+                WHERE user_id = :user_id AND seq <= {_trim_bound_sql(":user_id")}
+            ''', [dict(limits, user_id=user_id) for user_id in users])
+            await db.commit()
+    except Exception:
+        _dirty_users.update(users)
+        raise
+    logger.debug(f"Compacted history for {len(users)} user(s).")
+
+async def add_message(user_id: int, role: str, content: str, doc_id: Optional[int] = None):
+    """
+    Queues a message for the history; it is written by the background flusher.
+    doc_id references a stored document whose text is expanded lazily on read.
+    """
+    # Приблизительное число токенов считается один раз при записи и хранится рядом с сообщением
+    message = {"role": role, "content": content, "tokens": estimate_tokens(content)}
+    if doc_id is not None:
+        message["doc_id"] = doc_id
+        message["doc_tokens"] = _document_tokens.peek(doc_id)
+    _pending_messages.append((user_id, message))
+    cached = _history_cache.peek(user_id)
+    if cached is not None:
+        dropped_weight = _message_weight(cached[0]) if len(cached) == cached.maxlen else 0
+        cached.append(dict(message))
+        _history_cache.add_weight(user_id, _message_weight(message) - dropped_weight)
+    if len(_pending_messages) >= settings.DB_FLUSH_MAX_ROWS or _flusher_task is None:
+        _flush_wakeup.set()
+        if _flusher_task is None:
+            # Flusher не запущен (например, во время остановки) - пишем сразу
+            await flush_pending_messages()
+
+async def get_message_history(user_id: int, limit: Optional[int] = None, token_budget: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Retrieves recent messages for a user (oldest first), including writes not yet flushed.
+    Each message carries its precomputed 'tokens'. limit=None returns everything retained
+    (up to MAX_CONTEXT_MESSAGES * 2).
+
+    With token_budget, messages are picked newest-first until the budget is exhausted, and
+    document references are expanded into their stored text only while the budget allows.
+    """
+    cached = _history_cache.get(user_id)
+    if cached is None:
+        cached = await _hydrate_history(user_id)
+    messages = list(cached)
+    if limit is not None:
+        messages = messages[-max(1, limit):] # Запрашиваем хотя бы 1 сообщение
+    if token_budget is None:
+        return [dict(message) for message in messages]
+    return await _select_within_budget(messages, token_budget)
+
+def get_history_size(user_id: int) -> Tuple[int, int]:
+    """(messages, tokens) of the cached history, without document expansions; (0, 0) if not cached."""
+    cached = _history_cache.peek(user_id)
+    if cached is None:
+        return 0, 0
+    return len(cached), sum(message.get("tokens") or 0 for message in cached)
+
+async def _select_within_budget(messages: List[Dict[str, Any]], token_budget: int) -> List[Dict[str, Any]]:
+    """Newest-first selection under a token budget with lazy document expansion."""
+    selected: List[Dict[str, Any]] = []
+    remaining = token_budget
+    for message in reversed(messages):
+        if not message.get("content"):
+            continue
+        tokens = message.get("tokens") or estimate_tokens(message["content"])
+        if tokens > remaining:
+            break
+        message = dict(message)
+        doc_id = message.get("doc_id")
+        doc_tokens = message.get("doc_tokens")
+        # Текст документа подгружается, только если он целиком помещается в остаток бюджета
+        if doc_id is not None and doc_tokens is not None and tokens + doc_tokens <= remaining:
+            expansion = await get_document_history_text(doc_id)
+            if expansion:
+                message["content"] = f"{message['content']}{expansion}"
+                tokens += doc_tokens
+        message["tokens"] = tokens
+        selected.append(message)
+        remaining -= tokens
+    selected.reverse()
+    return selected
+
+async def _hydrate_history(user_id: int) -> deque:
+    """Loads a user's recent history from SQLite into the cache (cold miss)."""
+    while True:
+        epoch = _flush_epoch
+        if epoch % 2:
+            # Батч коммитится прямо сейчас - дожидаемся и читаем заново
+            async with _flush_lock:
+                pass
+            continue
+        async with _read_connection() as db:
+            async with db.execute(
+                "SELECT m.role, m.content, m.tokens, m.doc_id, d.tokens FROM messages AS m "
+                "LEFT JOIN documents AS d ON d.id = m.doc_id "
+                "WHERE m.user_id = ? ORDER BY m.seq DESC LIMIT ?",
+                (user_id, _HISTORY_KEEP) # Используем DESC для получения последних, затем развернем
+            ) as cursor:
+                rows = await cursor.fetchall()
+        if epoch == _flush_epoch:
+            break
+        # Пока мы читали, батч успел записаться: читаем еще раз, чтобы не задвоить строки
+    # Эпоха не изменилась: ни одна строка из очереди не попала в БД во время чтения,
+    # поэтому БД + текущая очередь дают точную картину (read-your-writes).
+    # Всё ниже выполняется без await, так что add_message() не может вклиниться.
+    history = deque(maxlen=max(1, _HISTORY_KEEP))
+    # Разворачиваем результат, чтобы порядок был от старых к новым
+    for row in reversed(rows):
+        message = {"role": row[0], "content": _decode_content(row[1]), "tokens": row[2]}
+        if row[3] is not None:
+            message["doc_id"] = row[3]
+            message["doc_tokens"] = row[4]
+        history.append(message)
+    history.extend(
+        dict(message)
+        for pending_user_id, message in _pending_messages
+        if pending_user_id == user_id
+    )
+    _history_cache.put(user_id, history, weight=sum(_message_weight(m) for m in history))
+    return history
+
+# --- Conversation summaries ---
+# Старые реплики сворачиваются в сводку (services/gemini.py) и удаляются из messages;
+# в запрос к Gemini уходят сводка + последние реплики.
+
+async def get_summary(user_id: int) -> Optional[Dict[str, Any]]:
+    """Returns {"summary", "tokens"} of the user's conversation summary, or None."""
+    cached = _summary_cache.get(user_id)
+    if cached is None:
+        async with _read_connection() as db:
+            async with db.execute("SELECT summary, tokens FROM summaries WHERE user_id = ?", (user_id,)) as cursor:
+                row = await cursor.fetchone()
+        cached = {"summary": row[0], "tokens": row[1]} if row else ""
+        _summary_cache.put(user_id, cached)
+    return dict(cached) if cached else None
+
+async def get_messages_for_summary(user_id: int) -> List[Dict[str, Any]]:
+    """Flushes pending writes and returns the user's stored messages with their seq (oldest first)."""
+    await flush_pending_messages()
+    async with _read_connection() as db:
+        async with db.execute(
+            "SELECT seq, role, content FROM messages WHERE user_id = ? ORDER BY seq",
+            (user_id,)
+        ) as cursor:
+            rows = await cursor.fetchall()
+    return [{"seq": row[0], "role": row[1], "content": _decode_content(row[2])} for row in rows]
+
+async def save_summary(user_id: int, summary: str, covered_seq: int):
+    """Stores a new summary and deletes the messages it covers (seq <= covered_seq) in one transaction."""
+    global _flush_epoch
+    tokens = estimate_tokens(summary)
+    # Та же seqlock-схема, что у flush: параллельная гидратация истории не закэширует удаленные строки
+    async with _flush_lock:
+        _flush_epoch += 1
+        try:
+            async with _write_connection() as db:
+                await db.execute(
+                    "INSERT INTO summaries (user_id, summary, covered_seq, tokens) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET summary = excluded.summary, "
+                    "covered_seq = excluded.covered_seq, tokens = excluded.tokens, updated_at = CURRENT_TIMESTAMP",
+                    (user_id, summary, covered_seq, tokens)
+                )
+                cursor = await db.execute("DELETE FROM messages WHERE user_id = ? AND seq <= ?", (user_id, covered_seq))
+                await db.commit()
+        finally:
+            _flush_epoch += 1
+        _summary_cache.put(user_id, {"summary": summary, "tokens": tokens})
+        _history_cache.pop(user_id)
+    logger.info(f"Summary for user {user_id} updated (~{tokens} tokens), {cursor.rowcount} message(s) folded into it.")
+
+# --- Documents ---
+# Извлеченный текст файлов хранится один раз на уникальное содержимое (sha256),
+# история ссылается на документ через doc_id.
+
+def _document_from_row(row) -> Dict[str, Any]:
+    return {"id": row[0], "filename": row[1], "status": row[2], "analysis": row[3], "tokens": row[4]}
+
+async def find_document(content_hash: str) -> Optional[Dict[str, Any]]:
+    """Finds a previously processed document by content hash (without its text)."""
+    async with _read_connection() as db:
+        async with db.execute(
+            "SELECT id, filename, status, analysis, tokens FROM documents WHERE content_hash = ?",
+            (content_hash,)
+        ) as cursor:
+            row = await cursor.fetchone()
+    if not row:
+        return None
+    document = _document_from_row(row)
+    _document_tokens.put(document["id"], document["tokens"])
+    return document
+
+async def save_document(content_hash: str, filename: str, mime_type: Optional[str], status: str,
+                        extracted_text: Optional[str], analysis: Optional[str]) -> int:
+    """Stores a processed document (deduplicated by content hash) and returns its id."""
+    history_text = (extracted_text or "")[:settings.MAX_HISTORY_FILE_CONTENT_LENGTH]
+    tokens = estimate_tokens(history_text)
+    async with _write_connection() as db:
+        # Повторная отправка того же файла не плодит копии; анализ сохраняем, если его еще не было
+        async with db.execute(
+            "INSERT INTO documents (content_hash, filename, mime_type, status, extracted_text, analysis, tokens) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(content_hash) DO UPDATE SET analysis = COALESCE(documents.analysis, excluded.analysis) "
+            "RETURNING id, tokens",
+            (content_hash, filename, mime_type, status, _encode_content(extracted_text), analysis, tokens)
+        ) as cursor:
+            row = await cursor.fetchone()
+        await db.commit()
+    doc_id, stored_tokens = row
+    _document_tokens.put(doc_id, stored_tokens)
+    logger.debug(f"Document '{filename}' stored as #{doc_id} ({content_hash[:12]}...)")
+    return doc_id
+
+async def get_document_history_text(doc_id: int) -> Optional[str]:
+    """Returns the history expansion of a document: its (truncated) extracted text."""
+    cached = _document_text_cache.get(doc_id)
+    if cached is not None:
+        return cached
+    async with _read_connection() as db:
+        async with db.execute("SELECT status, extracted_text FROM documents WHERE id = ?", (doc_id,)) as cursor:
+            row = await cursor.fetchone()
+    if not row:
+        return None
+    status, extracted_text = row[0] or "", _decode_content(row[1])
+    max_history_len = settings.MAX_HISTORY_FILE_CONTENT_LENGTH
+    if extracted_text:
+        truncated_content = extracted_text[:max_history_len]
+        expansion = f" [Содержимое{' (урезанное)' if len(extracted_text) > max_history_len else ''}: {truncated_content}...]"
+    elif status.startswith("Извлек"):
+        expansion = " [Содержимое: (пусто)]"
+    else:
+        expansion = ""
+    _document_text_cache.put(doc_id, expansion, weight=sys.getsizeof(expansion))
+    return expansion
+
+# --- AI result cache (persistent tier) ---
+# Память процесса - первый уровень (services/result_cache.py), эта таблица - второй:
+# переживает перезапуск и не ограничена бюджетом памяти.
+
+async def get_ai_cache(cache_key: str) -> Optional[Tuple[str, float]]:
+    """Returns (value, expires_at) of a non-expired cache entry, or None."""
+    async with _read_connection() as db:
+        async with db.execute(
+            "SELECT value, expires_at FROM ai_cache WHERE cache_key = ? AND expires_at > ?",
+            (cache_key, time.time())
+        ) as cursor:
+            row = await cursor.fetchone()
+    if not row:
+        return None
+    return _decode_content(row[0]), row[1]
+
+async def put_ai_cache(cache_key: str, call_type: str, value: str, expires_at: float):
+    """Stores (or refreshes) a cache entry."""
+    async with _write_connection() as db:
         await db.execute(
-            "INSERT INTO messages (user_id, role, content) VALUES (?, ?, ?)",
-            (user_id, role, content)
+            "INSERT OR REPLACE INTO ai_cache (cache_key, call_type, value, expires_at) VALUES (?, ?, ?, ?)",
+            (cache_key, call_type, _encode_content(value), expires_at)
         )
-        # Prune messages, keeping only the last N
-        await db.execute('''
-            DELETE FROM messages
-            WHERE id NOT IN (
-                SELECT id FROM messages
-                WHERE user_id = ?
-                ORDER BY timestamp DESC
-                LIMIT ?
-            ) AND user_id = ?
-        ''', (user_id, settings.MAX_CONTEXT_MESSAGES * 2, user_id)) # *2 to roughly keep pairs
         await db.commit()
 
-async def get_message_history(user_id: int) -> List[Dict[str, str]]:
-    """Retrieves the last N messages for a user."""
-    history = []
-    async with aiosqlite.connect(DATABASE) as db:
-        # Убедимся, что MAX_CONTEXT_MESSAGES > 0
-        limit = max(1, settings.MAX_CONTEXT_MESSAGES) # Запрашиваем хотя бы 1 сообщение
+async def purge_ai_cache():
+    """Deletes expired cache entries and the soonest-expiring ones above AI_CACHE_MAX_ROWS."""
+    async with _write_connection() as db:
+        cursor = await db.execute("DELETE FROM ai_cache WHERE expires_at <= ?", (time.time(),))
+        expired = cursor.rowcount
+        async with db.execute("SELECT COUNT(*) FROM ai_cache") as count_cursor:
+            excess = (await count_cursor.fetchone())[0] - settings.AI_CACHE_MAX_ROWS
+        if excess > 0:
+            await db.execute(
+                "DELETE FROM ai_cache WHERE cache_key IN "
+                "(SELECT cache_key FROM ai_cache ORDER BY expires_at LIMIT ?)",
+                (excess,)
+            )
+        await db.commit()
+    if expired or excess > 0:
+        logger.debug(f"AI cache purge: {expired} expired, {max(excess, 0)} over the row limit.")
+
+# --- Usage accounting ---
+
+def _today() -> str:
+    return datetime.date.today().isoformat()
+
+def record_usage(user_id: int, call_type: str, prompt_tokens: int, completion_tokens: int,
+                 total_tokens: int, latency_ms: int):
+    """Adds one call to the in-memory usage counters (written by the background flusher)."""
+    global _usage_day
+    day = _today()
+    if day != _usage_day:
+        _usage_today.clear()
+        _usage_day = day
+    counters = _pending_usage.setdefault((user_id, day, call_type), [0, 0, 0, 0, 0])
+    for index, value in enumerate((1, prompt_tokens, completion_tokens, total_tokens, latency_ms)):
+        counters[index] += value
+    if user_id in _usage_today:
+        _usage_today[user_id] += total_tokens
+
+async def flush_usage():
+    """Upserts accumulated usage counters in one transaction."""
+    if not _pending_usage:
+        return
+    batch = list(_pending_usage.items())
+    _pending_usage.clear()
+    try:
+        async with _write_connection() as db:
+            await db.executemany(
+                "INSERT INTO usage_stats (user_id, day, call_type, calls, prompt_tokens, completion_tokens, total_tokens, latency_ms) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id, day, call_type) DO UPDATE SET "
+                "calls = calls + excluded.calls, prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "total_tokens = total_tokens + excluded.total_tokens, latency_ms = latency_ms + excluded.latency_ms",
+                [(*key, *counters) for key, counters in batch]
+            )
+            await db.commit()
+    except Exception:
+        # Возвращаем дельты обратно, складывая с накопленными за время записи
+        for key, counters in batch:
+            pending = _pending_usage.setdefault(key, [0, 0, 0, 0, 0])
+            for index, value in enumerate(counters):
+                pending[index] += value
+        raise
+
+async def get_tokens_used_today(user_id: int) -> int:
+    """Total tokens the user spent today (stored + not yet flushed)."""
+    global _usage_day
+    day = _today()
+    if day != _usage_day:
+        _usage_today.clear()
+        _usage_day = day
+    used = _usage_today.get(user_id)
+    if used is None:
+        async with _read_connection() as db:
+            async with db.execute(
+                "SELECT COALESCE(SUM(total_tokens), 0) FROM usage_stats WHERE user_id = ? AND day = ?",
+                (user_id, day)
+            ) as cursor:
+                used = (await cursor.fetchone())[0]
+        # Ниже без await: добавляем еще не записанные дельты. Квота приблизительная -
+        # батч, записывающийся в момент чтения, может быть не учтен.
+        used += sum(counters[3] for (uid, d, _), counters in _pending_usage.items() if uid == user_id and d == day)
+        _usage_today[user_id] = used
+    return used
+
+async def get_top_usage(days: int = 1, limit: int = 10) -> List[Dict[str, Any]]:
+    """Top consumers by total tokens over the last `days` days (today included)."""
+    await flush_usage()
+    since = (datetime.date.today() - datetime.timedelta(days=max(1, days) - 1)).isoformat()
+    async with _read_connection() as db:
         async with db.execute(
-            "SELECT role, content FROM messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
-            (user_id, limit) # Используем DESC для получения последних, затем развернем
+            "SELECT user_id, SUM(calls), SUM(prompt_tokens), SUM(completion_tokens), SUM(total_tokens), SUM(latency_ms) "
+            "FROM usage_stats WHERE day >= ? GROUP BY user_id ORDER BY SUM(total_tokens) DESC LIMIT ?",
+            (since, limit)
         ) as cursor:
             rows = await cursor.fetchall()
-            # Разворачиваем результат, чтобы порядок был от старых к новым
-            for row in reversed(rows):
-                history.append({"role": row[0], "content": row[1]})
-    return history
+    return [
+        {"user_id": row[0], "calls": row[1], "prompt_tokens": row[2], "completion_tokens": row[3],
+         "total_tokens": row[4], "avg_latency_ms": (row[5] // row[1]) if row[1] else 0}
+        for row in rows
+    ]
+
+def get_history_cache_stats() -> Dict[str, Any]:
+    """Returns size, memory weight and hit/miss counters of the history cache."""
+    return _history_cache.stats()
+
+def _settings_from_row(row) -> Dict[str, Any]:
+    return {"mood": row[0], "speak_enabled": bool(row[1])}
 
-async def get_user_settings(user_id: int) -> Dict[str, any]:
-    """Gets user settings, creating default entry if user doesn't exist."""
-    async with aiosqlite.connect(DATABASE) as db:
+async def get_user_settings(user_id: int) -> Dict[str, Any]:
+    """Gets user settings (cached), creating default entry if user doesn't exist."""
+    cached = _settings_cache.get(user_id)
+    if cached is not None:
+        return dict(cached)  # копия, чтобы вызывающий код не испортил кэш
+
+    async with _read_connection() as db:
         async with db.execute(
             "SELECT mood, speak_enabled FROM users WHERE user_id = ?", (user_id,)
         ) as cursor:
             row = await cursor.fetchone()
-            if row:
-                return {"mood": row[0], "speak_enabled": bool(row[1])}
+
+    if not row:
+        # Create default entry for new user
+        # INSERT OR IGNORE закрывает гонку, когда два апдейта одного нового пользователя пришли одновременно
+        async with _write_connection() as db:
+            cursor = await db.execute(
+                "INSERT OR IGNORE INTO users (user_id, mood, speak_enabled) VALUES (?, ?, ?)",
+                (user_id, settings.DEFAULT_MOOD, 0)
+            )
+            await db.commit()
+            if cursor.rowcount:
+                logger.info(f"Created default settings for new user {user_id}")
+                row = (settings.DEFAULT_MOOD, 0)
             else:
-                # Create default entry for new user
-                try:
-                    await db.execute(
-                        "INSERT INTO users (user_id, mood, speak_enabled) VALUES (?, ?, ?)",
-                        (user_id, settings.DEFAULT_MOOD, 0)
-                    )
-                    await db.commit()
-                    logger.info(f"Created default settings for new user {user_id}")
-                    return {"mood": settings.DEFAULT_MOOD, "speak_enabled": False}
-                except aiosqlite.IntegrityError:
-                    # На случай гонки потоков, если другой процесс успел вставить пользователя
-                    logger.warning(f"User {user_id} likely already exists (IntegrityError on insert). Fetching again.")
-                    # Повторно пытаемся получить настройки
-                    async with db.execute("SELECT mood, speak_enabled FROM users WHERE user_id = ?", (user_id,)) as retry_cursor:
-                        row = await retry_cursor.fetchone()
-                        if row:
-                            return {"mood": row[0], "speak_enabled": bool(row[1])}
-                        else:
-                            # Этого не должно произойти, но на всякий случай
-                            logger.error(f"Failed to create or find settings for user {user_id} after IntegrityError.")
-                            return {"mood": settings.DEFAULT_MOOD, "speak_enabled": False}
+                async with db.execute("SELECT mood, speak_enabled FROM users WHERE user_id = ?", (user_id,)) as retry_cursor:
+                    row = await retry_cursor.fetchone()
+        if not row:
+            # Этого не должно произойти, но на всякий случай
+            logger.error(f"Failed to create or find settings for user {user_id}.")
+            return {"mood": settings.DEFAULT_MOOD, "speak_enabled": False}
+
+    # Кэш мог быть обновлен write-through, пока мы ждали БД - свежие данные не затираем
+    if user_id not in _settings_cache:
+        _settings_cache.put(user_id, _settings_from_row(row))
+    return dict(_settings_cache.peek(user_id))
 
 
 async def update_user_mood(user_id: int, mood: str):
-    """Updates the user's mood preference."""
-    async with aiosqlite.connect(DATABASE) as db:
-        # Сначала убедимся, что пользователь существует (или создаем его)
-        await get_user_settings(user_id)
-        # Затем обновляем
-        await db.execute(
-            "UPDATE users SET mood = ? WHERE user_id = ?",
-            (mood, user_id)
-        )
+    """Updates the user's mood preference (write-through to the settings cache)."""
+    async with _write_connection() as db:
+        # Upsert: создаем пользователя, если его еще нет, иначе обновляем
+        async with db.execute(
+            "INSERT INTO users (user_id, mood, speak_enabled) VALUES (?, ?, 0) "
+            "ON CONFLICT(user_id) DO UPDATE SET mood = excluded.mood "
+            "RETURNING mood, speak_enabled",
+            (user_id, mood)
+        ) as cursor:
+            row = await cursor.fetchone()
         await db.commit()
+    _settings_cache.put(user_id, _settings_from_row(row))
     logger.info(f"Updated mood for user {user_id} to {mood}")
 
 async def toggle_speak_mode(user_id: int) -> bool:
     """Toggles the speak mode for the user and returns the new state."""
-    async with aiosqlite.connect(DATABASE) as db:
-        # Ensure user exists first
-        settings_data = await get_user_settings(user_id) # This creates the user if they don't exist
-
-        # Get current state and toggle it
-        current_state = settings_data.get("speak_enabled", False)
-        new_state = not current_state
-
-        # Update the state
-        await db.execute(
-            "UPDATE users SET speak_enabled = ? WHERE user_id = ?",
-            (int(new_state), user_id)
-        )
+    async with _write_connection() as db:
+        # Upsert: новый пользователь получает speak_enabled = 1, существующий - инверсию
+        async with db.execute(
+            "INSERT INTO users (user_id, mood, speak_enabled) VALUES (?, ?, 1) "
+            "ON CONFLICT(user_id) DO UPDATE SET speak_enabled = 1 - COALESCE(speak_enabled, 0) "
+            "RETURNING mood, speak_enabled",
+            (user_id, settings.DEFAULT_MOOD)
+        ) as cursor:
+            row = await cursor.fetchone()
         await db.commit()
+    new_settings = _settings_from_row(row)
+    _settings_cache.put(user_id, new_settings)
+    new_state = new_settings["speak_enabled"]
     logger.info(f"Toggled speak mode for user {user_id} to {new_state}")
     return new_state
 
+def get_settings_cache_stats() -> Dict[str, Any]:
+    """Returns hit/miss counters of the user settings cache."""
+    return _settings_cache.stats()
+
 async def get_speak_enabled(user_id: int) -> bool:
     """Checks if speak mode is enabled for the user."""
     settings_data = await get_user_settings(user_id)
-    return settings_data.get("speak_enabled", False)
\ No newline at end of file
+    return settings_data.get("speak_enabled", False)
+
+async def compress_existing_messages(batch_size: int = 500) -> int:
+    """
+    One-shot migration: compresses already stored large TEXT contents in place.
+    Returns the number of rows rewritten. Run with: python -m services.database compress
+    """
+    compressed_rows = 0
+    last_id = 0
+    while True:
+        async with _read_connection() as db:
+            async with db.execute(
+                "SELECT id, content FROM messages WHERE id > ? AND typeof(content) = 'text' "
+                "AND LENGTH(CAST(content AS BLOB)) >= ? ORDER BY id LIMIT ?",
+                (last_id, settings.HISTORY_COMPRESS_THRESHOLD, batch_size)
+            ) as cursor:
+                rows = await cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        updates = [(encoded, row_id) for row_id, content in rows
+                   if isinstance(encoded := _encode_content(content), bytes)]
+        if updates:
+            async with _write_connection() as db:
+                await db.executemany("UPDATE messages SET content = ? WHERE id = ?", updates)
+                await db.commit()
+            compressed_rows += len(updates)
+    logger.info(f"Compressed {compressed_rows} existing history message(s).")
+    return compressed_rows
+
+async def _run_compress_tool():
+    await init_db()
+    try:
+        await compress_existing_messages()
+        async with _write_connection() as db:
+            # VACUUM возвращает освободившиеся страницы файловой системе
+            await db.execute("VACUUM")
+        logger.info("Database vacuumed after compression.")
+    finally:
+        await close_db()
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["compress"]:
+        asyncio.run(_run_compress_tool())
+    else:
+        print("Usage: python -m services.database compress", file=sys.stderr)
+        sys.exit(2)
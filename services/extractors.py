@@ -0,0 +1,396 @@
+# --- START OF FILE services/extractors.py ---
+
+import codecs
+from pathlib import Path
+from loguru import logger
+from typing import Iterator, List, Optional, Tuple
+
+import pandas as pd
+import PyPDF2
+import pytesseract
+from PIL import Image
+try:
+    import pymupdf  # PyMuPDF: в разы быстрее PyPDF2 на больших файлах
+except ImportError:
+    pymupdf = None
+try:
+    import openpyxl # Потоковое чтение .xlsx
+except ImportError:
+    openpyxl = None
+# Импорт для DOCX
+try:
+    import docx
+except ImportError:
+    docx = None # Обработаем отсутствие библиотеки ниже
+# Импорт для CSV Sniffer и Pandas ошибок
+try:
+    import csv
+    from pandas.errors import ParserError
+except ImportError:
+    csv = None
+    ParserError = None # Define as None if pandas not fully available or csv fails
+
+from services.table_profiler import TableProfiler
+from services.table_store import TableWriter, available as table_store_available
+
+# Блокирующие функции разбора файлов. Они выполняются в процессах пула (services/cpu_pool.py),
+# поэтому объявлены на уровне модуля, принимают и возвращают только сериализуемые значения
+# и не импортируют config: при импорте settings настраивает логирование в файл бота,
+# а воркеру его логи писать туда не нужно.
+
+class PdfExtractionError(Exception):
+    """The PDF cannot be read (corrupted, encrypted); the message is shown to the user."""
+
+
+def _open_pymupdf(file_path: Path, filename: str):
+    try:
+        document = pymupdf.open(file_path)
+    except Exception as e:
+        raise PdfExtractionError(f"Ошибка: Не удалось прочитать PDF файл '{filename}'. Возможно, он поврежден или имеет несовместимый формат.") from e
+    if document.needs_pass and not document.authenticate(""):
+        document.close()
+        raise PdfExtractionError(f"Ошибка: PDF файл '{filename}' зашифрован и не может быть открыт")
+    return document
+
+
+def _iter_pages_pymupdf(file_path: Path, filename: str) -> Iterator[Tuple[int, str]]:
+    document = _open_pymupdf(file_path, filename)
+    try:
+        for index in range(document.page_count):
+            try:
+                page_text = document.load_page(index).get_text("text").strip()
+            except Exception as page_err:
+                logger.warning(f"Не удалось извлечь текст со страницы {index + 1} файла {filename}: {page_err}")
+                page_text = ""
+            yield document.page_count, page_text
+    finally:
+        document.close()
+
+
+def _iter_pages_pypdf2(file_path: Path, filename: str) -> Iterator[Tuple[int, str]]:
+    try:
+        with open(file_path, 'rb') as f:
+            # strict=False для большей устойчивости к поврежденным PDF
+            reader = PyPDF2.PdfReader(f, strict=False)
+            if reader.is_encrypted:
+                logger.warning(f"PDF файл '{filename}' зашифрован.")
+                try:
+                    decrypted = reader.decrypt('') != PyPDF2.PasswordType.NOT_DECRYPTED
+                except Exception as decrypt_err:
+                    logger.error(f"Ошибка при попытке расшифровать PDF {filename}: {decrypt_err}")
+                    raise PdfExtractionError(f"Ошибка при попытке расшифровать PDF '{filename}'") from decrypt_err
+                if not decrypted:
+                    raise PdfExtractionError(f"Ошибка: PDF файл '{filename}' зашифрован и не может быть открыт")
+            page_count = len(reader.pages)
+            for index in range(page_count):
+                try:
+                    page_text = (reader.pages[index].extract_text() or "").strip()
+                except Exception as page_err:
+                    logger.warning(f"Не удалось извлечь текст со страницы {index + 1} файла {filename}: {page_err}")
+                    page_text = ""
+                yield page_count, page_text
+    except PyPDF2.errors.PdfReadError as pdf_err:
+        logger.error(f"Ошибка чтения PDF {filename} (PyPDF2): {pdf_err}")
+        raise PdfExtractionError(f"Ошибка: Не удалось прочитать PDF файл '{filename}'. Возможно, он поврежден или имеет несовместимый формат.") from pdf_err
+
+
+def iter_pages(file_path: Path, filename: str) -> Iterator[Tuple[int, str]]:
+    """
+    Lazily yields (page_count, page_text) for each page, with PyMuPDF if installed, else PyPDF2.
+    Raises PdfExtractionError for unreadable or encrypted files.
+    """
+    if pymupdf is not None:
+        return _iter_pages_pymupdf(file_path, filename)
+    return _iter_pages_pypdf2(file_path, filename)
+
+def read_pdf_pages(file_path: Path, filename: str, max_chars: int) -> Tuple[List[str], int, str]:
+    """
+    Reads pages in order until max_chars of text are collected (0 - all pages).
+    Returns (page_texts, page_count, engine).
+    """
+    pages: List[str] = []
+    page_count = 0
+    collected = 0
+    pages_iter = iter_pages(file_path, filename)
+    try:
+        for page_count, page_text in pages_iter:
+            pages.append(page_text)
+            collected += len(page_text)
+            if max_chars and collected >= max_chars:
+                break
+    finally:
+        pages_iter.close()  # закрываем документ сразу, не дожидаясь сборщика мусора
+    return pages, page_count, "pymupdf" if pymupdf is not None else "pypdf2"
+
+
+def pdf_page_count(file_path: Path, filename: str) -> int:
+    """Number of pages (PyMuPDF only)."""
+    document = _open_pymupdf(file_path, filename)
+    try:
+        return document.page_count
+    finally:
+        document.close()
+
+
+def read_pdf_page_range(file_path: Path, filename: str, start: int, stop: int) -> List[str]:
+    """Text of pages [start, stop) (PyMuPDF only)."""
+    document = _open_pymupdf(file_path, filename)
+    try:
+        texts = []
+        for index in range(start, min(stop, document.page_count)):
+            try:
+                texts.append(document.load_page(index).get_text("text").strip())
+            except Exception as page_err:
+                logger.warning(f"Не удалось извлечь текст со страницы {index + 1} файла {filename}: {page_err}")
+                texts.append("")
+        return texts
+    finally:
+        document.close()
+
+
+# CSV: кодировка и диалект определяются по одному образцу из начала файла, затем файл
+# читается один раз C-движком pandas кусками, которые сразу уходят в профиль таблицы
+# (services/table_profiler.py) - в памяти только текущий кусок и статистика.
+_CSV_SAMPLE_BYTES = 64 * 1024
+_CSV_DELIMITERS = ',;\t|'
+_TABLE_CHUNK_ROWS = 50_000 # CSV и .xlsx читаются кусками по столько строк
+_TABLE_SUMMARY_MAX_CHARS = 5000
+
+
+def _detect_csv_encoding(sample: bytes) -> str:
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    try:
+        # Образец мог оборваться посреди многобайтного символа - это не ошибка кодировки
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    try:
+        sample.decode("cp1251") # Русские таблицы из Excel
+        return "cp1251"
+    except UnicodeDecodeError:
+        return "latin-1"
+
+
+def _detect_csv_dialect(text: str, complete: bool) -> Tuple[str, str]:
+    """Returns (delimiter, quotechar) guessed from the beginning of the file."""
+    lines = text.splitlines()
+    if not complete and len(lines) > 1:
+        lines = lines[:-1] # Последняя строка образца может быть оборвана
+    lines = [line for line in lines[:200] if line.strip()]
+    try:
+        dialect = csv.Sniffer().sniff("\n".join(lines), delimiters=_CSV_DELIMITERS)
+        return dialect.delimiter, dialect.quotechar or '"'
+    except csv.Error:
+        pass
+    # Sniffer не справился: берем разделитель, который встречается одинаковое число раз в большинстве строк
+    best_delimiter, best_score = ',', 0
+    for delimiter in _CSV_DELIMITERS:
+        counts = [line.count(delimiter) for line in lines[:50]]
+        common = max(set(counts), key=counts.count) if counts else 0
+        score = counts.count(common) if common else 0
+        if score > best_score:
+            best_delimiter, best_score = delimiter, score
+    return best_delimiter, '"'
+
+
+def _read_csv(file_path: Path, filename: str, profiler: TableProfiler) -> Optional[str]:
+    """Streams a CSV file into the profiler; returns an error message / "Таблица пуста." or None."""
+    with open(file_path, 'rb') as f:
+        sample = f.read(_CSV_SAMPLE_BYTES)
+    if not sample.strip():
+        logger.warning(f"CSV файл {filename} пуст.")
+        return "Таблица пуста."
+    encoding = _detect_csv_encoding(sample)
+    sep, quotechar = _detect_csv_dialect(sample.decode(encoding, errors='ignore'), complete=len(sample) < _CSV_SAMPLE_BYTES)
+    logger.info(f"Определен разделитель CSV для {filename}: '{sep}', кодировка {encoding}")
+
+    try:
+        with pd.read_csv(file_path, sep=sep, quotechar=quotechar, encoding=encoding, encoding_errors='replace',
+                         engine='c', on_bad_lines='skip', chunksize=_TABLE_CHUNK_ROWS) as reader:
+            for chunk in reader:
+                profiler.add(chunk)
+    except pd.errors.EmptyDataError:
+        logger.warning(f"CSV файл {filename} не содержит данных.")
+        return "Таблица пуста."
+    except (ParserError, UnicodeError, ValueError) as parse_err:
+        if profiler.head is None:
+            logger.error(f"Не удалось прочитать CSV файл {filename}: {parse_err}")
+            return f"Ошибка: Не удалось определить разделитель или прочитать CSV файл '{filename}'."
+        # Начало таблицы прочитано - описываем то, что удалось разобрать
+        logger.warning(f"CSV {filename} прочитан не до конца (после {profiler.rows} строк): {parse_err}")
+        profiler.note = f"Файл прочитан не до конца: дальше {profiler.rows}-й строки он поврежден."
+    logger.info(f"Успешно прочитан CSV {filename}: {profiler.rows} строк, {len(profiler.columns)} колонок.")
+    return None
+
+
+def _iter_xlsx_chunks(file_path: Path, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    """First sheet of an .xlsx file in DataFrame chunks (openpyxl read-only mode streams rows)."""
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        # Имена колонок как у pandas: пустые - "Unnamed: N", повторы - "имя.1"
+        columns: List[str] = []
+        for index, name in enumerate(header):
+            name = f"Unnamed: {index}" if name is None else str(name)
+            base, suffix = name, 1
+            while name in columns:
+                name, suffix = f"{base}.{suffix}", suffix + 1
+            columns.append(name)
+        width = len(columns)
+        batch = []
+        for row in rows:
+            if all(cell is None for cell in row):
+                continue # Пустые строки (в т.ч. хвост "использованного" диапазона листа)
+            batch.append((tuple(row) + (None,) * width)[:width])
+            if len(batch) >= chunk_rows:
+                yield pd.DataFrame(batch, columns=columns)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=columns)
+    finally:
+        workbook.close()
+
+
+def read_table(file_path: Path, filename: str, file_ext: Optional[str], mime_type: Optional[str],
+               cache_path: Optional[Path] = None, cache_max_bytes: int = 0) -> str:
+    """
+    Reads a CSV/Excel file chunk by chunk and returns its profile (schema, per-column
+    statistics, sample rows) for analysis, or an error message.
+    With cache_path the parsed rows are also written there as an Arrow file
+    (see services/table_store.py), unless it grows beyond cache_max_bytes.
+    """
+    writer = TableWriter(cache_path, cache_max_bytes) if cache_path and table_store_available() else None
+    profiler = TableProfiler(sink=writer)
+    try:
+        # --- CSV ---
+        if file_ext == 'csv' or mime_type == 'text/csv':
+            if not csv or not ParserError: # Проверяем импорты
+               logger.error("Библиотеки 'csv' или 'pandas' не доступны для обработки CSV.")
+               return "Ошибка: Необходимые библиотеки для CSV не установлены."
+            logger.debug(f"Попытка чтения CSV: {filename}")
+            csv_error = _read_csv(file_path, filename, profiler)
+            if csv_error: # Ошибка или пустая таблица
+                return csv_error
+        # --- Excel ---
+        elif file_ext in ['xlsx', 'xls'] or mime_type in ['application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'application/vnd.ms-excel']:
+            logger.debug(f"Попытка чтения Excel файла: {filename} (расширение: {file_ext})")
+            read_ok = False
+            # .xlsx читаем потоком через openpyxl (read-only), не загружая лист целиком
+            if file_ext == 'xlsx':
+                logger.debug(f"Пробуем движок 'openpyxl' для {filename}")
+                if openpyxl is None:
+                    logger.critical("Библиотека `openpyxl` не установлена. Не могу читать .xlsx файлы. Выполните `pip install openpyxl`")
+                    return "Критическая ошибка: Не установлена библиотека 'openpyxl' для чтения современных Excel файлов (.xlsx)"
+                try:
+                    for chunk in _iter_xlsx_chunks(file_path, _TABLE_CHUNK_ROWS):
+                        profiler.add(chunk)
+                    read_ok = True
+                    logger.info(f"Успешно прочитан Excel файл {filename} с помощью openpyxl.")
+                except Exception as excel_read_err:
+                    logger.warning(f"Не удалось прочитать Excel файл {filename} с помощью openpyxl: {excel_read_err}. Пробуем другие движки, если применимо.")
+                    if writer is not None:
+                        writer.abort() # уже записанные строки повторятся при чтении через xlrd
+                        writer = TableWriter(cache_path, cache_max_bytes)
+                    profiler = TableProfiler(sink=writer) # Начинаем заново
+            # Если это .xls или openpyxl не сработал, пробуем xlrd (формат .xls ограничен 65536 строками - читаем целиком)
+            if not read_ok:
+                logger.debug(f"Пробуем движок 'xlrd' для {filename}")
+                try:
+                    profiler.add(pd.read_excel(file_path, engine='xlrd'))
+                    read_ok = True
+                    logger.info(f"Успешно прочитан Excel файл {filename} с помощью xlrd.")
+                except ImportError:
+                    logger.error("Библиотека `xlrd` не установлена. Не могу читать старые .xls файлы. Выполните `pip install xlrd`")
+                    # Если это был .xls, то это критично
+                    if file_ext == 'xls':
+                        return "Ошибка: Не установлена библиотека 'xlrd' для чтения старых Excel файлов (.xls)"
+                    # Если это был .xlsx, просто логируем, т.к. openpyxl должен был сработать
+                except Exception as xlrd_err:
+                    logger.error(f"Не удалось прочитать Excel файл {filename} с помощью xlrd: {xlrd_err}")
+
+            if not read_ok: # Если ни один движок не сработал
+                 logger.error(f"Не удалось прочитать файл Excel {filename} доступными движками.")
+                 return f"Ошибка при чтении файла Excel '{filename}'. Файл может быть поврежден, зашифрован или иметь несовместимый формат."
+        # --- Неизвестный тип таблицы ---
+        else:
+             logger.error(f"Неожиданное расширение/MIME тип для обработки таблицы: {filename}")
+             return f"Внутренняя ошибка: Неожиданный тип файла для таблицы: {filename}"
+
+        if profiler.rows == 0:
+            logger.info(f"Файл таблицы {filename} пуст.")
+            return "Таблица пуста."
+
+        if writer is not None:
+            writer.close(filename, profiler.note)
+        # Описание таблицы для Gemini: схема, статистика колонок и пример строк
+        return profiler.summary(max_chars=_TABLE_SUMMARY_MAX_CHARS)
+
+    except FileNotFoundError:
+        logger.error(f"Файл таблицы не найден во время чтения: {file_path}")
+        return f"Ошибка: Файл {filename} не найден во время чтения."
+    except Exception as e:
+        logger.error(f"Общая ошибка при чтении файла таблицы {filename}: {e}")
+        logger.exception(e)
+        return f"Непредвиденная ошибка при чтении файла таблицы '{filename}'"
+    finally:
+        if writer is not None:
+            writer.abort() # после close() ничего не удаляет
+
+
+def read_docx(file_path: Path, filename: str) -> str:
+    """Returns the text of a DOCX file, or an error message."""
+    if docx is None:
+         logger.critical("Библиотека `python-docx` не установлена. Не могу читать .docx файлы. Выполните `pip install python-docx`")
+         return "Критическая ошибка: Не установлена библиотека 'python-docx' для чтения .docx файлов."
+    try:
+        document = docx.Document(file_path)
+        full_text = [para.text for para in document.paragraphs if para.text] # Собираем непустые параграфы
+        return "\n".join(full_text) # Объединяем параграфы через один перенос строки
+    except docx.opc.exceptions.PackageNotFoundError:
+         logger.error(f"Ошибка чтения DOCX {filename}: Файл не найден или поврежден.")
+         return f"Ошибка: Не удалось открыть DOCX файл '{filename}'. Возможно, он поврежден или не является DOCX файлом."
+    except Exception as docx_err:
+        logger.error(f"Ошибка чтения DOCX файла {filename}: {docx_err}")
+        logger.exception(docx_err)
+        # Проверяем на ошибку шифрования
+        if "encrypted" in str(docx_err).lower() or "password" in str(docx_err).lower():
+             return f"Ошибка: Файл DOCX '{filename}' защищен паролем или зашифрован."
+        return f"Ошибка при чтении файла DOCX '{filename}'."
+
+
+def ocr_image(image_path: Path) -> Optional[str]:
+    """Tesseract OCR (Russian + English) of an image; None on error."""
+    try:
+        # Открываем изображение
+        image = Image.open(image_path)
+        # Уменьшаем размер до 640x480 для ускорения
+        image = image.resize((480, 360), Image.Resampling.LANCZOS)
+        # Указываем русский и английский языки, PSM 6 - единый блок текста
+        custom_config = r'-l rus+eng --psm 6'
+        # Распознаем текст
+        return pytesseract.image_to_string(image, config=custom_config)
+    except pytesseract.TesseractNotFoundError:
+        logger.critical("Tesseract is not installed or not in PATH. OCR will not work.")
+        return None
+    except FileNotFoundError:
+        logger.error(f"Image file disappeared before Tesseract could open it: {image_path}")
+        return None
+    except Exception as ocr_err:
+        logger.error(f"Error during Tesseract OCR processing for {image_path}: {ocr_err}")
+        return None
+
+
+def resize_image(image_path: Path, target_path: Path, size: Tuple[int, int] = (480, 360)) -> None:
+    """Saves a resized copy of the image (for Gemini Vision)."""
+    image = Image.open(image_path)
+    image = image.resize(size, Image.Resampling.LANCZOS)
+    image.save(target_path)
+
+# --- END OF FILE services/extractors.py ---
@@ -1,52 +1,97 @@
 # --- START OF FILE services/file_handler.py ---
 
-import pandas as pd
-import PyPDF2
 import asyncio
 from pathlib import Path
 from loguru import logger
 from typing import Optional, Tuple
-# Импорт для DOCX
-try:
-    import docx
-except ImportError:
-    docx = None # Обработаем отсутствие библиотеки ниже
-# Импорт для CSV Sniffer и Pandas ошибок
-try:
-    import csv
-    from pandas.errors import ParserError
-except ImportError:
-    csv = None
-    ParserError = None # Define as None if pandas not fully available or csv fails
 
-from utils.helpers import cleanup_temp_file
+from utils.helpers import cleanup_temp_file, compute_file_hash
+from utils.singleflight import SingleFlight
 from config import settings
-from services.gemini import analyze_file_content
+from services import cpu_pool, database, extractors, pdf_extractor, table_cache
+from services.gemini import analyze_file_content, ProgressCallback
 
 MAX_FILE_SIZE_BYTES = 50 * 1024 * 1024 # 50 MB limit
+TABLE_EXTENSIONS = ['csv', 'xlsx', 'xls']
+TABLE_MIME_TYPES = ['text/csv', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'application/vnd.ms-excel']
 
-# <<< ИЗМЕНЕНИЕ: Возвращаем (status_message, analysis_result, extracted_content) >>>
-async def process_file(file_path: Path, filename: str, mime_type: Optional[str], file_size: int) -> Optional[Tuple[str, Optional[str], Optional[str]]]:
+# Одинаковые файлы (по sha256), присланные одновременно, обрабатываются один раз
+_in_flight = SingleFlight()
+
+def get_in_flight_stats():
+    """Returns single-flight counters (file jobs started vs. requests that joined one)."""
+    return _in_flight.stats()
+
+# <<< ИЗМЕНЕНИЕ: Возвращаем (status_message, analysis_result, extracted_content, doc_id) >>>
+async def process_file(file_path: Path, filename: str, mime_type: Optional[str], file_size: int,
+                       user_id: Optional[int] = None,
+                       progress: Optional[ProgressCallback] = None) -> Optional[Tuple[str, Optional[str], Optional[str], Optional[int]]]:
     """
     Обрабатывает файл: извлекает содержимое, отправляет на анализ Gemini.
+    Результат сохраняется в таблицу documents по sha256 содержимого; если такой файл
+    уже анализировался (тем же или другим пользователем), возвращается готовый анализ.
 
     Возвращает:
-        Кортеж (status_message, analysis_result, extracted_content) или None.
-        extracted_content: Извлеченный текст/данные (может быть None).
+        Кортеж (status_message, analysis_result, extracted_content, doc_id) или None.
+        extracted_content: Извлеченный текст/данные (может быть None, в т.ч. для повторного файла).
+        doc_id: id документа для ссылки из истории (None, если сохранять нечего).
+    Если тот же файл уже обрабатывается для другого сообщения, ждет общий результат.
+    Расход токенов на анализ записывается на user_id (при общем результате - на запустившего).
+    progress(done, total) получает ход анализа большого файла по частям (только у запустившего).
     """
-    extracted_content: Optional[str] = None # Инициализируем здесь
-    analysis_result: Optional[str] = None
-    status_message: str = f"Обрабатываю файл: {filename}"
-
     if file_size > MAX_FILE_SIZE_BYTES:
          max_mb = MAX_FILE_SIZE_BYTES // 1024 // 1024
          logger.warning(f"Файл '{filename}' превышает макс. размер ({file_size} > {MAX_FILE_SIZE_BYTES} байт). Пропуск.")
-         # <<< Возвращаем 3 значения >>>
-         return f"Файл '{filename}' слишком большой (>{max_mb} МБ)", None, None
+         return f"Файл '{filename}' слишком большой (>{max_mb} МБ)", None, None, None
 
     file_ext = filename.split('.')[-1].lower() if '.' in filename else None
     logger.info(f"Обработка файла: {filename}, размер: {file_size}, тип: {mime_type}, расширение: {file_ext}")
 
+    handed_over = False # файл передан общей задаче - она сама его удалит
+    try:
+        # --- Повторно присланный файл: берем сохраненный анализ ---
+        content_hash = await asyncio.to_thread(compute_file_hash, file_path)
+        known_document = await database.find_document(content_hash)
+        if known_document and known_document["analysis"]:
+            logger.info(f"Файл '{filename}' уже обрабатывался (документ #{known_document['id']}). Используем сохраненный анализ.")
+            if _is_table(file_ext, mime_type):
+                # Анализ готов, но для расчетов по таблице нужна ее копия в кэше этого пользователя
+                await table_cache.ensure_cached(user_id, content_hash, file_path, filename, file_ext, mime_type)
+            return f"{known_document['status']} (ранее обработан)", known_document["analysis"], None, known_document["id"]
+
+        # --- Тот же файл уже обрабатывается для другого сообщения: ждем общий результат ---
+        def start_processing():
+            nonlocal handed_over
+            handed_over = True
+            return _process_new_file(file_path, filename, mime_type, file_ext, content_hash, user_id, progress)
+
+        result = await _in_flight.do(content_hash, start_processing)
+        if not handed_over and _is_table(file_ext, mime_type):
+            # Присоединились к чужой обработке: таблица записана в кэш запустившего
+            await table_cache.ensure_cached(user_id, content_hash, file_path, filename, file_ext, mime_type)
+        return result
+
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка верхнего уровня при обработке файла {filename}: {e}")
+        logger.exception(e)
+        return f"Непредвиденная критическая ошибка при обработке файла {filename}", None, None, None
+    finally:
+        if not handed_over:
+            await cleanup_temp_file(file_path)
+            logger.debug(f"Очищен временный файл {file_path} для {filename}")
+
+def _is_table(file_ext: Optional[str], mime_type: Optional[str]) -> bool:
+    return file_ext in TABLE_EXTENSIONS or mime_type in TABLE_MIME_TYPES
+
+async def _process_new_file(file_path: Path, filename: str, mime_type: Optional[str], file_ext: Optional[str],
+                            content_hash: str, user_id: Optional[int],
+                            progress: Optional[ProgressCallback] = None) -> Tuple[str, Optional[str], Optional[str], Optional[int]]:
+    """Extracts, analyzes and stores a file not seen before. Deletes file_path when done."""
+    extracted_content: Optional[str] = None
+    analysis_result: Optional[str] = None
+    status_message: str = f"Обрабатываю файл: {filename}"
+    doc_id: Optional[int] = None
+
     try:
         # --- Обработка TXT ---
         if file_ext == 'txt' or mime_type == 'text/plain':
@@ -78,190 +123,42 @@ async def process_file(file_path: Path, filename: str, mime_type: Optional[str],
         # --- Обработка PDF ---
         elif file_ext == 'pdf' or mime_type == 'application/pdf':
             logger.debug(f"Чтение PDF файла: {filename}")
-            def read_pdf():
-                text = ""
-                try:
-                    with open(file_path, 'rb') as f:
-                        # strict=False для большей устойчивости к поврежденным PDF
-                        reader = PyPDF2.PdfReader(f, strict=False)
-                        if reader.is_encrypted:
-                             logger.warning(f"PDF файл '{filename}' зашифрован.")
-                             # Попытка расшифровать с пустым паролем
-                             try:
-                                 if reader.decrypt('') == PyPDF2.PasswordType.NOT_DECRYPTED:
-                                      logger.warning(f"Не удалось расшифровать PDF {filename} пустым паролем.")
-                                      return f"Ошибка: PDF файл '{filename}' зашифрован и не может быть открыт"
-                             except Exception as decrypt_err:
-                                  logger.error(f"Ошибка при попытке расшифровать PDF {filename}: {decrypt_err}")
-                                  return f"Ошибка при попытке расшифровать PDF '{filename}'"
-
-                        num_pages = len(reader.pages)
-                        logger.debug(f"PDF '{filename}' содержит {num_pages} страниц.")
-                        extracted_texts = []
-                        # Обрабатываем каждую страницу
-                        for i, page in enumerate(reader.pages):
-                            try:
-                                page_text = page.extract_text()
-                                if page_text:
-                                    extracted_texts.append(page_text.strip()) # Добавляем текст страницы
-                            except Exception as page_err:
-                                logger.warning(f"Не удалось извлечь текст со страницы {i+1} файла {filename}: {page_err}")
-                        # Объединяем текст со всех страниц
-                        text = "\n\n".join(extracted_texts) # Разделяем страницы двойным переносом строки
-                except PyPDF2.errors.PdfReadError as pdf_err:
-                     logger.error(f"Ошибка чтения PDF {filename} (PyPDF2): {pdf_err}")
-                     return f"Ошибка: Не удалось прочитать PDF файл '{filename}'. Возможно, он поврежден или имеет несовместимый формат."
-                except FileNotFoundError:
-                    logger.error(f"PDF файл не найден во время чтения: {file_path}")
-                    return f"Ошибка: Файл {filename} не найден во время чтения."
-                except Exception as e:
-                    logger.error(f"Неожиданная ошибка при чтении PDF {filename}: {e}")
-                    logger.exception(e)
-                    return f"Непредвиденная ошибка при чтении PDF {filename}"
-                return text
-
-            extracted_content = await asyncio.to_thread(read_pdf) # Сохраняем результат
-            # Обработка ошибок read_pdf
-            if not isinstance(extracted_content, str) or extracted_content.startswith("Ошибка"):
-                status_message = extracted_content if isinstance(extracted_content, str) else "Ошибка чтения PDF"
-                extracted_content = None
-            elif extracted_content.strip(): # Если текст извлечен
-                 status_message = f"Извлек текст из PDF {filename} ({len(extracted_content)} символов)"
+            try:
+                # Читаются только страницы, которые войдут в анализ; большие PDF - в нескольких процессах
+                pdf_text = await pdf_extractor.extract_pdf_text(file_path, filename)
+            except pdf_extractor.PdfExtractionError as pdf_err:
+                logger.warning(f"PDF {filename} не прочитан: {pdf_err}")
+                status_message = str(pdf_err)
+            except cpu_pool.ProcessPoolError:
+                raise # сообщение сформирует общий обработчик ниже
+            except FileNotFoundError:
+                logger.error(f"PDF файл не найден во время чтения: {file_path}")
+                status_message = f"Ошибка: Файл {filename} не найден во время чтения."
+            except Exception as e:
+                logger.error(f"Неожиданная ошибка при чтении PDF {filename}: {e}")
+                logger.exception(e)
+                status_message = f"Непредвиденная ошибка при чтении PDF {filename}"
             else:
-                 # Текст не извлечен, но ошибки не было (например, PDF из картинок)
-                 status_message = f"Не удалось извлечь текст из PDF {filename} (возможно, содержит только изображения или текст не извлекается)"
-                 extracted_content = None
+                logger.debug(f"PDF '{filename}': прочитано {pdf_text.pages_read} из {pdf_text.page_count} страниц ({pdf_text.engine}).")
+                if pdf_text.text.strip(): # Если текст извлечен
+                    extracted_content = pdf_text.text
+                    status_message = f"Извлек текст из PDF {filename} ({len(extracted_content)} символов)"
+                    if pdf_text.truncated:
+                        status_message += f", страниц {pdf_text.pages_read} из {pdf_text.page_count}"
+                else:
+                    # Текст не извлечен, но ошибки не было (например, PDF из картинок)
+                    status_message = f"Не удалось извлечь текст из PDF {filename} (возможно, содержит только изображения или текст не извлекается)"
 
         # --- Обработка Таблиц (CSV, XLSX, XLS) ---
-        elif file_ext in ['csv', 'xlsx', 'xls'] or mime_type in ['text/csv', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'application/vnd.ms-excel']:
+        elif _is_table(file_ext, mime_type):
             logger.debug(f"Чтение файла таблицы: {filename}")
-            def read_table():
-                df = None
-                try:
-                    # --- CSV ---
-                    if file_ext == 'csv' or mime_type == 'text/csv':
-                        if not csv or not ParserError: # Проверяем импорты
-                           logger.error("Библиотеки 'csv' или 'pandas' не доступны для обработки CSV.")
-                           return "Ошибка: Необходимые библиотеки для CSV не установлены."
-                        logger.debug(f"Попытка чтения CSV: {filename}")
-                        detected_sep = None
-                        try:
-                             # Пробуем определить разделитель
-                             with open(file_path, 'r', encoding='utf-8', errors='ignore') as csvfile:
-                                 # Читаем небольшой кусок для определения диалекта
-                                 sample = csvfile.read(1024 * 10) # 10 KB sample
-                                 if not sample:
-                                     logger.warning(f"CSV файл {filename} пуст.")
-                                     return "Таблица пуста."
-                                 csvfile.seek(0) # Возвращаемся в начало файла
-                                 sniffer = csv.Sniffer()
-                                 dialect = sniffer.sniff(sample, delimiters=',;\t|') # Явно указываем возможные разделители
-                                 detected_sep = dialect.delimiter
-                                 logger.info(f"Определен разделитель CSV для {filename}: '{detected_sep}'")
-                             # Читаем с определенным разделителем
-                             df = pd.read_csv(file_path, sep=detected_sep, on_bad_lines='warn', engine='python', encoding_errors='ignore', low_memory=False)
-                             logger.info(f"Успешно прочитан CSV {filename} с разделителем '{detected_sep}'.")
-                        except (csv.Error, ParserError, Exception) as sniff_read_err:
-                             logger.warning(f"Определение разделителя/чтение CSV не удалось для {filename}: {sniff_read_err}. Пробуем стандартные разделители.")
-                             df = None # Сбрасываем df
-                             common_separators = [',', ';', '\t', '|']
-                             for sep_try in common_separators:
-                                 if sep_try == detected_sep: continue # Пропускаем уже опробованный
-                                 logger.debug(f"Пробуем разделитель '{sep_try}' для {filename}")
-                                 try:
-                                     # Пробуем прочитать хотя бы несколько строк
-                                     df_try = pd.read_csv(file_path, sep=sep_try, on_bad_lines='skip', nrows=10, encoding_errors='ignore', low_memory=False)
-                                     # Считаем успешным, если есть колонки или не пустой DataFrame
-                                     if not df_try.empty and len(df_try.columns) > 0:
-                                         # Читаем весь файл с этим разделителем
-                                         df = pd.read_csv(file_path, sep=sep_try, on_bad_lines='warn', encoding_errors='ignore', low_memory=False)
-                                         logger.info(f"Успешно прочитан CSV {filename} с разделителем '{sep_try}'.")
-                                         break # Выходим из цикла, если успешно
-                                 except Exception as read_try_err:
-                                     logger.debug(f"Чтение CSV {filename} с разделителем '{sep_try}' не удалось: {read_try_err}")
-                                     continue
-                             if df is None:
-                                 logger.error(f"Не удалось прочитать CSV файл {filename} ни с одним из стандартных разделителей.")
-                                 return f"Ошибка: Не удалось определить разделитель или прочитать CSV файл '{filename}'."
-                    # --- Excel ---
-                    elif file_ext in ['xlsx', 'xls'] or mime_type in ['application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'application/vnd.ms-excel']:
-                        logger.debug(f"Попытка чтения Excel файла: {filename} (расширение: {file_ext})")
-                        engine_to_try = 'openpyxl' if file_ext == 'xlsx' else None
-                        # Сначала пробуем openpyxl для .xlsx
-                        if engine_to_try == 'openpyxl':
-                            logger.debug(f"Пробуем движок 'openpyxl' для {filename}")
-                            try:
-                                df = pd.read_excel(file_path, engine=engine_to_try)
-                                logger.info(f"Успешно прочитан Excel файл {filename} с помощью openpyxl.")
-                            except ImportError:
-                                logger.critical("Библиотека `openpyxl` не установлена. Не могу читать .xlsx файлы. Выполните `pip install openpyxl`")
-                                return "Критическая ошибка: Не установлена библиотека 'openpyxl' для чтения современных Excel файлов (.xlsx)"
-                            except Exception as excel_read_err:
-                                logger.warning(f"Не удалось прочитать Excel файл {filename} с помощью openpyxl: {excel_read_err}. Пробуем другие движки, если применимо.")
-                                df = None # Сбрасываем df
-                                engine_to_try = None # Попробуем другой движок ниже
-                        # Если это .xls или openpyxl не сработал, пробуем xlrd
-                        if df is None:
-                            logger.debug(f"Пробуем движок 'xlrd' для {filename}")
-                            try:
-                                df = pd.read_excel(file_path, engine='xlrd')
-                                logger.info(f"Успешно прочитан Excel файл {filename} с помощью xlrd.")
-                            except ImportError:
-                                logger.error("Библиотека `xlrd` не установлена. Не могу читать старые .xls файлы. Выполните `pip install xlrd`")
-                                # Если это был .xls, то это критично
-                                if file_ext == 'xls':
-                                    return "Ошибка: Не установлена библиотека 'xlrd' для чтения старых Excel файлов (.xls)"
-                                # Если это был .xlsx, просто логируем, т.к. openpyxl должен был сработать
-                            except Exception as xlrd_err:
-                                logger.error(f"Не удалось прочитать Excel файл {filename} с помощью xlrd: {xlrd_err}")
-                                df = None # Сбрасываем df на всякий случай
-
-                        if df is None: # Если ни один движок не сработал
-                             logger.error(f"Не удалось прочитать файл Excel {filename} доступными движками.")
-                             return f"Ошибка при чтении файла Excel '{filename}'. Файл может быть поврежден, зашифрован или иметь несовместимый формат."
-                    # --- Неизвестный тип таблицы ---
-                    else:
-                         logger.error(f"Неожиданное расширение/MIME тип для обработки таблицы: {filename}")
-                         return f"Внутренняя ошибка: Неожиданный тип файла для таблицы: {filename}"
-
-                    # --- Обработка DataFrame ---
-                    if df is None: # Дополнительная проверка
-                        logger.error(f"DataFrame равен None после попытки чтения таблицы {filename}")
-                        return f"Ошибка: Не удалось получить данные из файла таблицы '{filename}'"
-                    if df.empty:
-                        logger.info(f"Файл таблицы {filename} пуст.")
-                        return "Таблица пуста."
-
-                    # Формируем описание таблицы для Gemini
-                    num_rows, num_cols = df.shape
-                    header = ", ".join(map(str, df.columns))
-                    # Берем небольшой срез данных для примера
-                    # Ограничиваем и строки и колонки, чтобы не перегружать промпт
-                    head_df_safe = df.iloc[:5, :10] # Первые 5 строк, первые 10 колонок
-                    head_data = head_df_safe.to_string(index=False, max_rows=5, max_cols=10, header=True)
-
-                    # Добавляем примечания, если данные были урезаны для примера
-                    cols_truncated = " (...колонки урезаны)" if num_cols > 10 else ""
-                    rows_truncated = "\n... (...строки урезаны)" if num_rows > 5 else ""
-
-                    # Собираем финальное описание
-                    max_len_table_desc = 5000 # Ограничиваем длину описания таблицы
-                    content_str = (
-                        f"Таблица содержит {num_rows} строк и {num_cols} колонок.\n"
-                        f"Заголовки: {header}\n\n"
-                        f"Пример данных (до 5 строк, до 10 колонок{cols_truncated}):\n{head_data}{rows_truncated}"
-                    )
-                    return content_str[:max_len_table_desc] # Возвращаем описание (может быть урезано)
-
-                except FileNotFoundError:
-                    logger.error(f"Файл таблицы не найден во время чтения: {file_path}")
-                    return f"Ошибка: Файл {filename} не найден во время чтения."
-                except Exception as e:
-                    logger.error(f"Общая ошибка при чтении файла таблицы {filename}: {e}")
-                    logger.exception(e)
-                    return f"Непредвиденная ошибка при чтении файла таблицы '{filename}'"
-
-            extracted_content = await asyncio.to_thread(read_table) # Сохраняем результат (описание таблицы)
+            # Разбор таблицы - в пуле процессов (pandas держит GIL); строки заодно
+            # записываются в кэш таблиц пользователя для расчетов по последующим вопросам
+            cache_path, cache_max_bytes = table_cache.cache_target(user_id, content_hash)
+            extracted_content = await cpu_pool.run(extractors.read_table, file_path, filename, file_ext, mime_type,
+                                                   cache_path, cache_max_bytes) # Сохраняем результат (описание таблицы)
+            if cache_path is not None:
+                await table_cache.stored(user_id, cache_path)
             # Обработка ошибок read_table
             if not isinstance(extracted_content, str):
                 logger.error(f"read_table вернул неожиданный тип: {type(extracted_content)}")
@@ -280,26 +177,7 @@ async def process_file(file_path: Path, filename: str, mime_type: Optional[str],
         # --- Обработка DOCX ---
         elif file_ext == 'docx' or mime_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
             logger.debug(f"Чтение DOCX файла: {filename}")
-            def read_docx():
-                if docx is None:
-                     logger.critical("Библиотека `python-docx` не установлена. Не могу читать .docx файлы. Выполните `pip install python-docx`")
-                     return "Критическая ошибка: Не установлена библиотека 'python-docx' для чтения .docx файлов."
-                try:
-                    document = docx.Document(file_path)
-                    full_text = [para.text for para in document.paragraphs if para.text] # Собираем непустые параграфы
-                    return "\n".join(full_text) # Объединяем параграфы через один перенос строки
-                except docx.opc.exceptions.PackageNotFoundError:
-                     logger.error(f"Ошибка чтения DOCX {filename}: Файл не найден или поврежден.")
-                     return f"Ошибка: Не удалось открыть DOCX файл '{filename}'. Возможно, он поврежден или не является DOCX файлом."
-                except Exception as docx_err:
-                    logger.error(f"Ошибка чтения DOCX файла {filename}: {docx_err}")
-                    logger.exception(docx_err)
-                    # Проверяем на ошибку шифрования
-                    if "encrypted" in str(docx_err).lower() or "password" in str(docx_err).lower():
-                         return f"Ошибка: Файл DOCX '{filename}' защищен паролем или зашифрован."
-                    return f"Ошибка при чтении файла DOCX '{filename}'."
-
-            extracted_content = await asyncio.to_thread(read_docx) # Сохраняем результат
+            extracted_content = await cpu_pool.run(extractors.read_docx, file_path, filename) # Сохраняем результат
             # Обработка ошибок read_docx
             if not isinstance(extracted_content, str) or extracted_content.startswith("Ошибка") or extracted_content.startswith("Критическая ошибка"):
                 status_message = extracted_content if isinstance(extracted_content, str) else "Ошибка чтения DOCX"
@@ -317,16 +195,14 @@ async def process_file(file_path: Path, filename: str, mime_type: Optional[str],
                               f"Чтение таких файлов напрямую не поддерживается.\n"
                               f"Пожалуйста, **конвертируйте его в .docx или .txt** и отправьте снова.")
             extracted_content = None
-            # <<< Возвращаем 3 значения >>>
-            return status_message, None, None
+            return status_message, None, None, None
 
         # --- Неподдерживаемый тип файла ---
         else:
             logger.warning(f"Неподдерживаемый тип файла: {filename} (расширение: {file_ext}, mime: {mime_type})")
             status_message = f"Файл '{filename}' имеет неподдерживаемый тип ({file_ext or mime_type or 'неизвестный'})"
             extracted_content = None
-            # <<< Возвращаем 3 значения >>>
-            return status_message, None, None
+            return status_message, None, None, None
 
         # --- Анализ извлеченного содержимого (если оно есть и не было ошибки извлечения) ---
         # Анализируем, только если есть контент и статус не содержит явную ошибку
@@ -338,15 +214,11 @@ async def process_file(file_path: Path, filename: str, mime_type: Optional[str],
                  # Промпт для анализа описания таблицы
                  analysis_prompt = f"Проанализируй следующую информацию о таблице из файла '{filename}':\n{extracted_content}\n\nСделай краткое резюме о данных в таблице, их возможном назначении или ключевых особенностях."
             else: # Обычный текст из TXT, PDF, DOCX
-                 # Урезаем контент для промпта Gemini, если он слишком длинный
-                 content_to_analyze = extracted_content[:settings.MAX_FILE_CONTENT_LENGTH_FOR_GEMINI]
-                 analysis_prompt = f"Проанализируй следующее содержимое файла '{filename}':\n{content_to_analyze}"
-                 if len(extracted_content) > settings.MAX_FILE_CONTENT_LENGTH_FOR_GEMINI:
-                     logger.warning(f"Контент из {filename} был урезан для анализа Gemini (отправлено {len(content_to_analyze)} символов).")
-                     analysis_prompt += "\n\n[Примечание: Содержимое файла было урезано для анализа из-за ограничений по длине]"
+                 # Текст целиком: длинный документ analyze_file_content разберет по частям
+                 analysis_prompt = extracted_content
 
             # Вызываем Gemini для анализа
-            analysis_result = await analyze_file_content(analysis_prompt, filename)
+            analysis_result = await analyze_file_content(analysis_prompt, filename, user_id=user_id, progress=progress)
             if not analysis_result:
                  logger.warning(f"Анализ Gemini для {filename} вернул пустой результат или не удался.")
                  # Не добавляем ошибку анализа к status_message здесь, сделаем это в хендлере
@@ -355,16 +227,30 @@ async def process_file(file_path: Path, filename: str, mime_type: Optional[str],
         elif not extracted_content and "Ошибка" not in status_message and file_ext not in ['doc']:
              logger.info(f"Контент из {filename} не извлечен для анализа (Статус: {status_message}). Пропуск анализа.")
 
-        # <<< ИЗМЕНЕНИЕ: Возвращаем все три значения >>>
-        return status_message, analysis_result, extracted_content
+        # Сохраняем документ (без ошибок извлечения), чтобы история ссылалась на него по id
+        if "Ошибка" not in status_message and "Критическая" not in status_message:
+            try:
+                doc_id = await database.save_document(content_hash, filename, mime_type, status_message, extracted_content, analysis_result)
+            except Exception as save_err:
+                logger.error(f"Не удалось сохранить документ {filename}: {save_err}")
+
+        return status_message, analysis_result, extracted_content, doc_id
 
+    except cpu_pool.JobTimeoutError:
+        logger.error(f"Разбор файла {filename} не уложился в {settings.CPU_JOB_TIMEOUT_SEC} с и был прерван.")
+        return f"Ошибка: файл '{filename}' обрабатывался слишком долго, обработка прервана. Возможно, он поврежден.", None, None, None
+    except cpu_pool.PoolOverloadedError:
+        logger.warning(f"Очередь разбора файлов переполнена, файл {filename} отклонен.")
+        return f"Ошибка: сейчас обрабатывается слишком много файлов. Пожалуйста, отправьте '{filename}' чуть позже.", None, None, None
+    except cpu_pool.ProcessPoolError as pool_err:
+        logger.error(f"Процесс разбора файла {filename} завершился с ошибкой: {pool_err}")
+        return f"Ошибка: не удалось разобрать файл '{filename}'. Возможно, он поврежден.", None, None, None
     except Exception as e:
         # Непредвиденная ошибка на верхнем уровне обработки файла
         logger.error(f"Неожиданная ошибка верхнего уровня при обработке файла {filename}: {e}")
         logger.exception(e)
         status_message = f"Непредвиденная критическая ошибка при обработке файла {filename}"
-        # <<< Возвращаем 3 значения >>>
-        return status_message, None, None
+        return status_message, None, None, None
     finally:
         # Гарантированное удаление временного файла
         await cleanup_temp_file(file_path)
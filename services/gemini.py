@@ -3,23 +3,77 @@
 import google.generativeai as genai
 import PIL.Image
 import asyncio
+import contextlib
 from loguru import logger
-from typing import List, Dict, Optional
+from typing import Any, Awaitable, Callable, List, Dict, Optional, AsyncIterator, Tuple
 
 from config import settings
-from services.database import get_message_history, get_user_settings
-from utils.helpers import get_current_datetime_str
+from services import gemini_client, result_cache, table_cache
+from services.gemini_pool import ModelTemplate
+from services.gemini_client import GeminiTimeoutError, GeminiUnavailableError, GeminiQuotaExceededError
+from services.database import (
+    get_message_history, get_user_settings, get_history_size,
+    get_summary, get_messages_for_summary, save_summary,
+)
+from utils.helpers import get_current_datetime_str, estimate_tokens, compute_file_hash, split_text_chunks
+
+# progress(done, total): вызывается по мере анализа частей большого файла
+ProgressCallback = Callable[[int, int], Awaitable[None]]
+
+
+class StreamInterruptedError(Exception):
+    """The stream broke off after part of the answer had already been yielded."""
+
+# Общая часть системной инструкции; стиль общения добавляется для каждого настроения.
+# Дата сюда не входит (инструкция неизменна), она подставляется коротким префиксом в запрос.
+_BASE_SYSTEM_INSTRUCTION = (
+    "Ты - ИИ-ассистент в Telegram. Отвечай на русском языке, если не указано иное. "
+    "Учитывай предыдущие сообщения. Текущие дата и время указаны в квадратных скобках в начале запроса. "
+    "ВАЖНО: Если пользователь явно просит тебя 'озвучить', 'сказать', 'произнести' какой-то текст "
+    "(например: 'озвучь Привет мир', 'скажи Как дела?'), твой единственный ответ ДОЛЖЕН быть в формате "
+    "`[TTS:Текст для озвучки]`, где 'Текст для озвучки' - это именно тот текст, который нужно озвучить. "
+    "Не добавляй к этому маркеру НИКАКИХ других слов, пояснений или приветствий. "
+    "Если пользователь просит перевести текст (например: 'переведи hello на русский'), выполни перевод. "
+    "В остальных случаях отвечай на запрос как обычно."
+)
+
+_MOOD_INSTRUCTIONS: Dict[str, str] = {
+    "friendly": "Общайся дружелюбно и неформально.",
+    "professional": "Общайся строго профессионально и формально.",
+    "sarcastic": "Общайся с сарказмом и иронией, но оставайся полезным.",
+    "romantic": "Общайся тепло, мягко и немного романтично.",
+    "funny": "Общайся весело, с юмором и шутками, но оставайся полезным.",
+}
+
+def _system_instruction(mood: str) -> str:
+    mood_instruction = _MOOD_INSTRUCTIONS.get(mood)
+    return f"{_BASE_SYSTEM_INSTRUCTION} {mood_instruction}" if mood_instruction else _BASE_SYSTEM_INSTRUCTION
+
+# Модели чата по настроениям: создаются один раз и переиспользуются
+_mood_models: Dict[str, ModelTemplate] = {}
 
 try:
     genai.configure(api_key=settings.GEMINI_API_KEY)
-    text_model = genai.GenerativeModel(settings.GEMINI_TEXT_MODEL)
-    vision_model = genai.GenerativeModel(settings.GEMINI_VISION_MODEL)
+    text_model = ModelTemplate(settings.GEMINI_TEXT_MODEL)
+    vision_model = ModelTemplate(settings.GEMINI_VISION_MODEL)
+    for _mood in settings.allowed_moods:
+        _mood_models[_mood] = ModelTemplate(settings.GEMINI_TEXT_MODEL, system_instruction=_system_instruction(_mood))
     logger.info("Google Generative AI configured successfully.")
 except Exception as e:
     logger.error(f"Failed to configure Google Generative AI: {e}")
     text_model = None
     vision_model = None
 
+def _chat_model(mood: str) -> Optional[ModelTemplate]:
+    """Returns the cached chat model for a mood (built on first use for moods added later)."""
+    if not text_model:
+        return None
+    model = _mood_models.get(mood)
+    if model is None:
+        model = ModelTemplate(settings.GEMINI_TEXT_MODEL, system_instruction=_system_instruction(mood))
+        _mood_models[mood] = model
+    return model
+
 safety_settings = [
     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
     {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
@@ -32,102 +86,330 @@ generation_config = genai.types.GenerationConfig(
     # max_output_tokens=2048
 )
 
-async def generate_text_response(user_id: int, user_prompt: str) -> Optional[str]:
-    """Generates a text response using Gemini, considering context and mood."""
-    if not text_model:
-        logger.error("Gemini text model is not initialized.")
-        return "Извините, произошла ошибка конфигурации AI"
-
+def _quota_message(error: GeminiQuotaExceededError) -> str:
+    """User-facing text when the daily token quota is spent."""
+    return (f"Вы исчерпали дневной лимит обращений к AI ({error.used}/{error.quota} токенов). "
+            f"Лимит обновится завтра.")
+
+def _unavailable_message(error: GeminiUnavailableError) -> str:
+    """User-facing text while the circuit breaker is open."""
+    return f"Сервис AI сейчас недоступен. Попробуйте через {max(1, round(error.retry_after))} сек."
+
+async def _build_chat_payload(user_id: int, user_prompt: str) -> Tuple[Optional[ModelTemplate], List[Dict[str, List[str]]], bool]:
+    """
+    Picks the chat model for the user's mood and builds the payload: token-budgeted history and the prompt.
+    The last value tells whether the user's cached tables were listed (the model may answer with [QUERY:...]).
+    """
+    user_settings = await get_user_settings(user_id)
+    mood = user_settings.get('mood', settings.DEFAULT_MOOD)
+    model = _chat_model(mood)
+
+    # Дата - единственная изменчивая часть контекста: короткий префикс к текущему запросу
+    prompt_with_date = f"[{get_current_datetime_str()}] {user_prompt}"
+
+    summary = await get_summary(user_id)
+    summary_text = f"[Краткое содержание более раннего разговора: {summary['summary']}]" if summary else None
+    # Недавно присланные таблицы: модель может запросить по ним точный расчет
+    tables_text = await table_cache.prompt_context(user_id, user_prompt)
+
+    # Бюджет токенов: инструкция, сводка и текущий запрос входят всегда, история добавляется
+    # от новых сообщений к старым, пока помещается в CONTEXT_TOKEN_BUDGET
+    fixed_tokens = (estimate_tokens(_system_instruction(mood)) + estimate_tokens(prompt_with_date)
+                    + estimate_tokens(summary_text) + estimate_tokens(tables_text))
+    history = await get_message_history(user_id, token_budget=settings.CONTEXT_TOKEN_BUDGET - fixed_tokens)
+    history_tokens = sum(msg['tokens'] for msg in history)
+    request_payload: List[Dict[str, List[str]]] = [
+        {'role': msg['role'], 'parts': [str(msg['content'])]} for msg in history
+    ]
+    if summary_text:
+        # Сводка - первой частью первой реплики пользователя (без лишнего хода user/model)
+        if request_payload and request_payload[0]['role'] == 'user':
+            request_payload[0]['parts'].insert(0, summary_text)
+        else:
+            request_payload.insert(0, {'role': 'user', 'parts': [summary_text]})
+    request_payload.append({'role': 'user', 'parts': [tables_text, prompt_with_date] if tables_text else [prompt_with_date]})
+    _maybe_schedule_summary(user_id)
+
+    total_tokens = fixed_tokens + history_tokens
+    logger.info(f"Gemini context for user {user_id}: ~{total_tokens} tokens (budget {settings.CONTEXT_TOKEN_BUDGET}), "
+                f"{len(history)} history messages{', with summary' if summary else ''}{', with tables' if tables_text else ''}.")
+    logger.debug(f"Sending request to Gemini text model ({settings.GEMINI_TEXT_MODEL}, mood {mood}) for user {user_id}. Payload size approx: {len(str(request_payload))} chars.")
+    return model, request_payload, tables_text is not None
+
+# --- Rolling conversation summary ---
+# Запускается в фоне после сборки запроса, не более одной задачи на пользователя.
+_summary_tasks: Dict[int, asyncio.Task] = {}
+
+def _maybe_schedule_summary(user_id: int):
+    """Starts a background summary pass if the user's history crossed the threshold."""
+    if settings.SUMMARY_TRIGGER_TOKENS <= 0 or user_id in _summary_tasks or not text_model:
+        return
+    count, tokens = get_history_size(user_id)
+    # Лимит сообщений тоже повод: иначе компактор удалит старые реплики, не свернув их
+    if tokens < settings.SUMMARY_TRIGGER_TOKENS and count < settings.MAX_CONTEXT_MESSAGES * 2:
+        return
+    if count <= settings.SUMMARY_KEEP_RECENT:
+        return
+    task = asyncio.create_task(_update_summary(user_id), name=f"summary-{user_id}")
+    _summary_tasks[user_id] = task
+    task.add_done_callback(lambda _: _summary_tasks.pop(user_id, None))
+
+async def _update_summary(user_id: int):
+    """Folds all but the last SUMMARY_KEEP_RECENT messages (and the previous summary) into a new summary."""
     try:
-        user_settings = await get_user_settings(user_id)
-        mood = user_settings.get('mood', settings.DEFAULT_MOOD)
-        history = await get_message_history(user_id)
-
-        current_time_str = get_current_datetime_str()
-        # --- ИЗМЕНЕНИЯ В ИНСТРУКЦИИ ---
-        system_instruction = (
-            f"Ты - ИИ-ассистент в Telegram. Отвечай на русском языке, если не указано иное. "
-            f"Учитывай предыдущие сообщения. Сегодня {current_time_str}. "
-            f"ВАЖНО: Если пользователь явно просит тебя 'озвучить', 'сказать', 'произнести' какой-то текст "
-            f"(например: 'озвучь Привет мир', 'скажи Как дела?'), твой единственный ответ ДОЛЖЕН быть в формате "
-            f"`[TTS:Текст для озвучки]`, где 'Текст для озвучки' - это именно тот текст, который нужно озвучить. "
-            f"Не добавляй к этому маркеру НИКАКИХ других слов, пояснений или приветствий. "
-            f"Если пользователь просит перевести текст (например: 'переведи hello на русский'), выполни перевод. "
-            f"В остальных случаях отвечай на запрос как обычно."
-        )
-        # --- КОНЕЦ ИЗМЕНЕНИЙ В ИНСТРУКЦИИ ---
-
-        if mood == "friendly": system_instruction += " Общайся дружелюбно и неформально."
-        elif mood == "professional": system_instruction += " Общайся строго профессионально и формально."
-        elif mood == "sarcastic": system_instruction += " Общайся с сарказмом и иронией, но оставайся полезным."
-
-        gemini_history: List[Dict[str, List[str]]] = []
-        if system_instruction:
-             gemini_history.append({'role': 'user', 'parts': [system_instruction]})
-             gemini_history.append({'role': 'model', 'parts': ["Понял. Я готов отвечать."]})
-
-        for msg in history:
-             if msg.get('content'):
-                 gemini_history.append({'role': msg['role'], 'parts': [str(msg['content'])]})
-
-        current_user_message = {'role': 'user', 'parts': [user_prompt]}
-        request_payload = gemini_history + [current_user_message]
+        messages = await get_messages_for_summary(user_id)
+        to_fold = messages[:-settings.SUMMARY_KEEP_RECENT]
+        if not to_fold:
+            return
+        previous = await get_summary(user_id)
+        summary = await summarize_conversation(previous['summary'] if previous else None, to_fold, user_id=user_id)
+        if summary:
+            await save_summary(user_id, summary, to_fold[-1]['seq'])
+    except Exception as e:
+        logger.error(f"Error updating conversation summary for user {user_id}: {e}")
+        logger.exception(e)
 
-        logger.debug(f"Sending request to Gemini text model ({settings.GEMINI_TEXT_MODEL}) for user {user_id}. History length: {len(gemini_history)}. Payload size approx: {len(str(request_payload))} chars.")
-        # logger.debug(f"Gemini History: {gemini_history}")
-        # logger.debug(f"Current prompt: {current_user_message}")
+async def summarize_conversation(previous_summary: Optional[str], messages: List[Dict[str, Any]],
+                                 user_id: Optional[int] = None) -> Optional[str]:
+    """Produces an updated running summary of a conversation. Returns None on failure."""
+    if not text_model:
+        return None
+    speakers = {'user': "Пользователь", 'model': "Ассистент"}
+    dialogue = "\n".join(f"{speakers.get(msg['role'], msg['role'])}: {msg['content']}" for msg in messages)
+    prompt = (
+        "Составь краткое содержание разговора пользователя с ассистентом для использования как контекст "
+        "в дальнейшем диалоге. Сохрани факты о пользователе, его просьбы, договоренности и открытые вопросы; "
+        "опусти приветствия и повторы. Не более 200 слов, на русском языке, без вступления.\n\n"
+    )
+    if previous_summary:
+        prompt += f"Предыдущее краткое содержание:\n{previous_summary}\n\n"
+    prompt += f"Новые сообщения:\n{dialogue}"
 
-        logger.debug(f"Starting Gemini text generation in thread for user {user_id}...")
-        response = await asyncio.to_thread(
-            text_model.generate_content,
-            contents=request_payload,
+    try:
+        response = await gemini_client.generate(
+            text_model, [prompt],
+            call_type="summary",
+            user_id=user_id,
+            enforce_quota=False, # сводка - фоновая работа, запрос пользователя уже прошел проверку
             generation_config=generation_config,
             safety_settings=safety_settings,
         )
-        logger.debug(f"Finished Gemini text generation in thread for user {user_id}.")
-
         if response and response.candidates and response.candidates[0].content.parts:
-            generated_text = response.candidates[0].content.parts[0].text
-            logger.info(f"Received text response from Gemini for user {user_id} (length: {len(generated_text)}).")
-            return generated_text.strip()
-        else:
-            block_reason = response.prompt_feedback.block_reason if response.prompt_feedback else 'Unknown'
-            finish_reason = response.candidates[0].finish_reason if response.candidates else 'Unknown'
-            logger.warning(f"Gemini text response was empty or blocked for user {user_id}. Block reason: {block_reason}, Finish reason: {finish_reason}")
-            try: fallback_text = response.text; logger.warning(f"Trying fallback text: {fallback_text[:100]}...");
-            except Exception: fallback_text = None
-            if finish_reason == 'SAFETY': return "Извините, ваш запрос или контекст не соответствуют правилам безопасности. Попробуйте переформулировать"
-            elif block_reason != 'Unknown' and block_reason != 'OTHER': return f"Извините, не могу сгенерировать ответ. Причина: {block_reason}"
-            elif fallback_text: return fallback_text.strip()
-            else: return "Извините, не удалось получить ответ от AI. Попробуйте позже"
+            summary = response.candidates[0].content.parts[0].text.strip()
+            logger.debug(f"Conversation summary generated: {len(messages)} message(s) -> {len(summary)} chars.")
+            return summary or None
+        logger.warning("Gemini returned an empty conversation summary.")
+    except Exception as e:
+        logger.error(f"Error generating conversation summary: {e}")
+    return None
 
+async def generate_text_response(user_id: int, user_prompt: str) -> Optional[str]:
+    """Generates a text response using Gemini, considering context and mood."""
+    if not text_model:
+        logger.error("Gemini text model is not initialized.")
+        return "Извините, произошла ошибка конфигурации AI"
+
+    try:
+        chat_model, request_payload, tables_listed = await _build_chat_payload(user_id, user_prompt)
+
+        # Ответ может быть запросом к таблице [QUERY:...]: он выполняется локально, результат
+        # отправляется модели следующим ходом - не больше TABLE_QUERY_MAX_ROUNDS раз
+        for query_round in range(settings.TABLE_QUERY_MAX_ROUNDS + 1):
+            logger.debug(f"Starting Gemini text generation for user {user_id}...")
+            response = await gemini_client.generate(
+                chat_model, request_payload,
+                call_type="text",
+                user_id=user_id,
+                generation_config=generation_config,
+                safety_settings=safety_settings,
+            )
+            logger.debug(f"Finished Gemini text generation for user {user_id}.")
+
+            if response and response.candidates and response.candidates[0].content.parts:
+                generated_text = response.candidates[0].content.parts[0].text
+                logger.info(f"Received text response from Gemini for user {user_id} (length: {len(generated_text)}).")
+                query_text = table_cache.find_query(generated_text) if tables_listed else None
+                if query_text is None:
+                    return generated_text.strip()
+                if query_round == settings.TABLE_QUERY_MAX_ROUNDS:
+                    logger.warning(f"Gemini kept querying tables for user {user_id} after {query_round} queries.")
+                    return "Не удалось рассчитать ответ по таблице. Попробуйте сформулировать вопрос проще"
+                await _answer_table_query(user_id, request_payload, generated_text, query_text, query_round)
+            else:
+                block_reason = response.prompt_feedback.block_reason if response.prompt_feedback else 'Unknown'
+                finish_reason = response.candidates[0].finish_reason if response.candidates else 'Unknown'
+                logger.warning(f"Gemini text response was empty or blocked for user {user_id}. Block reason: {block_reason}, Finish reason: {finish_reason}")
+                try: fallback_text = response.text; logger.warning(f"Trying fallback text: {fallback_text[:100]}...");
+                except Exception: fallback_text = None
+                if finish_reason == 'SAFETY': return "Извините, ваш запрос или контекст не соответствуют правилам безопасности. Попробуйте переформулировать"
+                elif block_reason != 'Unknown' and block_reason != 'OTHER': return f"Извините, не могу сгенерировать ответ. Причина: {block_reason}"
+                elif fallback_text: return fallback_text.strip()
+                else: return "Извините, не удалось получить ответ от AI. Попробуйте позже"
+
+    except GeminiQuotaExceededError as e:
+        return _quota_message(e)
+    except GeminiUnavailableError as e:
+        logger.warning(f"Gemini call skipped, API unavailable: {e}")
+        return _unavailable_message(e)
+    except GeminiTimeoutError:
+        logger.error(f"Gemini text generation timed out for user {user_id}.")
+        return "AI слишком долго не отвечает. Попробуйте позже"
     except Exception as e:
         logger.error(f"Error generating text response from Gemini for user {user_id}: {e}")
         logger.exception(e)
         return "Произошла ошибка при обращении к AI. Попробуйте позже"
 
-async def analyze_image_content(image_path: str, prompt: str = "Опиши, что изображено на этой картинке.") -> Optional[str]:
-    """Analyzes image content using Gemini Vision."""
+async def _answer_table_query(user_id: int, request_payload: List[Dict[str, List[str]]],
+                              response_text: str, query_text: str, query_round: int):
+    """Runs the model's [QUERY:...] against the cached table and appends it with its result to the payload."""
+    result = await table_cache.run_query(user_id, query_text)
+    last = query_round + 1 >= settings.TABLE_QUERY_MAX_ROUNDS
+    request_payload.append({'role': 'model', 'parts': [response_text]})
+    request_payload.append({'role': 'user', 'parts': [table_cache.query_result_message(result, last)]})
+
+def _chunk_text(chunk) -> str:
+    """Text of a streamed chunk; empty for chunks without text parts (e.g. the final one)."""
+    try:
+        if chunk.candidates and chunk.candidates[0].content.parts:
+            return "".join(part.text for part in chunk.candidates[0].content.parts if getattr(part, 'text', None))
+    except Exception:
+        pass
+    return ""
+
+async def stream_text_response(user_id: int, user_prompt: str) -> AsyncIterator[str]:
+    """
+    Streams a Gemini text response chunk by chunk (same context and mood as generate_text_response).
+    A response that is a table query marker is not shown: the query runs locally and the answer
+    to its result is streamed instead.
+    On errors or blocked responses before any text yields a single user-facing error text instead;
+    if the stream breaks off after part of the answer was yielded, raises StreamInterruptedError.
+    """
+    if not text_model:
+        logger.error("Gemini text model is not initialized.")
+        yield "Извините, произошла ошибка конфигурации AI"
+        return
+
+    try:
+        chat_model, request_payload, tables_listed = await _build_chat_payload(user_id, user_prompt)
+    except Exception as e:
+        logger.error(f"Error building Gemini payload for user {user_id}: {e}")
+        logger.exception(e)
+        yield "Произошла ошибка при обращении к AI. Попробуйте позже"
+        return
+
+    received_chars = 0
+    finish_reason = None
+    block_reason = None
+    for query_round in range(settings.TABLE_QUERY_MAX_ROUNDS + 1):
+        logger.debug(f"Starting Gemini streaming generation for user {user_id}...")
+        # Пока ответ может оказаться маркером [QUERY:...], текст придерживается
+        held: Optional[str] = "" if tables_listed else None
+        try:
+            # aclosing: если потребитель прервет поток, запрос к Gemini отменяется сразу, а не при сборке мусора
+            async with contextlib.aclosing(gemini_client.generate_stream(
+                chat_model, request_payload,
+                call_type="stream",
+                user_id=user_id,
+                generation_config=generation_config,
+                safety_settings=safety_settings,
+            )) as stream:
+                async for chunk in stream:
+                    if chunk.candidates:
+                        finish_reason = chunk.candidates[0].finish_reason
+                    if getattr(chunk, 'prompt_feedback', None) and chunk.prompt_feedback.block_reason:
+                        block_reason = chunk.prompt_feedback.block_reason
+                    text = _chunk_text(chunk)
+                    if text and held is not None:
+                        held += text
+                        if table_cache.may_be_query(held):
+                            continue
+                        text, held = held, None
+                    if text:
+                        received_chars += len(text)
+                        yield text
+        except GeminiQuotaExceededError as e:
+            if received_chars:
+                raise StreamInterruptedError(f"quota exceeded after {received_chars} chars") from e
+            yield _quota_message(e)
+            return
+        except GeminiUnavailableError as e:
+            logger.warning(f"Gemini call skipped, API unavailable: {e}")
+            if received_chars:
+                raise StreamInterruptedError(f"API unavailable after {received_chars} chars") from e
+            yield _unavailable_message(e)
+            return
+        except GeminiTimeoutError as e:
+            logger.error(f"Gemini stream timed out for user {user_id} after {received_chars} chars.")
+            if received_chars:
+                raise StreamInterruptedError(f"timed out after {received_chars} chars") from e
+            yield "AI слишком долго не отвечает. Попробуйте позже"
+            return
+        except Exception as e:
+            logger.error(f"Error streaming text response from Gemini for user {user_id}: {e}")
+            if received_chars:
+                raise StreamInterruptedError(f"stream failed after {received_chars} chars: {e}") from e
+            yield "Произошла ошибка при обращении к AI. Попробуйте позже"
+            return
+
+        if held:
+            query_text = table_cache.find_query(held)
+            if query_text is not None and query_round < settings.TABLE_QUERY_MAX_ROUNDS:
+                await _answer_table_query(user_id, request_payload, held, query_text, query_round)
+                continue
+            if query_text is not None:
+                logger.warning(f"Gemini kept querying tables for user {user_id} after {query_round} queries.")
+                held = "Не удалось рассчитать ответ по таблице. Попробуйте сформулировать вопрос проще"
+            received_chars += len(held)
+            yield held
+        break
+
+    if not received_chars:
+        logger.warning(f"Gemini stream was empty or blocked for user {user_id}. Block reason: {block_reason}, Finish reason: {finish_reason}")
+        if getattr(finish_reason, 'name', finish_reason) == 'SAFETY':
+            yield "Извините, ваш запрос или контекст не соответствуют правилам безопасности. Попробуйте переформулировать"
+        elif block_reason:
+            yield f"Извините, не могу сгенерировать ответ. Причина: {block_reason}"
+        else:
+            yield "Извините, не удалось получить ответ от AI. Попробуйте позже"
+    logger.debug(f"Finished Gemini streaming generation for user {user_id} ({received_chars} chars).")
+
+async def analyze_image_content(image_path: str, prompt: str = "Опиши, что изображено на этой картинке.",
+                                cache_key: Optional[str] = None, user_id: Optional[int] = None) -> Optional[str]:
+    """
+    Analyzes image content using Gemini Vision.
+    cache_key identifies the image for the result cache (e.g. Telegram file_unique_id);
+    without it the file content hash is used.
+    """
     if not vision_model:
         logger.error("Gemini vision model is not initialized.")
         return "Извините, произошла ошибка конфигурации AI Vision"
 
     try:
+        content_key = cache_key or await asyncio.to_thread(compute_file_hash, image_path)
+        result_key = result_cache.make_key("vision", settings.GEMINI_VISION_MODEL, prompt, content_key)
+        cached = await result_cache.get(result_key)
+        if cached is not None:
+            logger.info(f"Image analysis for {image_path} served from cache.")
+            return cached
+
         logger.info(f"Analyzing image using {settings.GEMINI_VISION_MODEL}: {image_path}")
         img = await asyncio.to_thread(PIL.Image.open, image_path)
 
-        logger.debug(f"Starting Gemini vision analysis in thread for image {image_path}...")
-        response = await asyncio.to_thread(
-            vision_model.generate_content,
-            contents=[prompt, img],
+        logger.debug(f"Starting Gemini vision analysis for image {image_path}...")
+        response, served_model = await gemini_client.generate_with_model(
+            vision_model, [prompt, img],
+            call_type="vision",
+            user_id=user_id,
             generation_config=generation_config,
             safety_settings=safety_settings,
         )
-        logger.debug(f"Finished Gemini vision analysis in thread for image {image_path}.")
+        logger.debug(f"Finished Gemini vision analysis for image {image_path}.")
 
         if response and response.candidates and response.candidates[0].content.parts:
             analysis = response.candidates[0].content.parts[0].text
             logger.info(f"Received image analysis from Gemini Vision (length: {len(analysis)}).")
+            if _cacheable(vision_model, served_model):
+                await result_cache.put(result_key, "vision", analysis.strip())
             return analysis.strip()
         else:
             block_reason = response.prompt_feedback.block_reason if response.prompt_feedback else 'Unknown'
@@ -140,55 +422,175 @@ async def analyze_image_content(image_path: str, prompt: str = "Опиши, чт
             elif fallback_text: return fallback_text.strip()
             else: return "Извините, не удалось получить анализ изображения от AI"
 
+    except GeminiQuotaExceededError as e:
+        return _quota_message(e)
+    except GeminiUnavailableError as e:
+        logger.warning(f"Gemini call skipped, API unavailable: {e}")
+        return _unavailable_message(e)
+    except GeminiTimeoutError:
+        logger.error(f"Gemini Vision analysis timed out ({image_path}).")
+        return "AI слишком долго анализирует изображение. Попробуйте позже"
     except Exception as e:
         logger.error(f"Error analyzing image with Gemini Vision ({image_path}): {e}")
         logger.exception(e)
         return "Произошла ошибка при анализе изображения"
 
-async def analyze_file_content(text_content: str, filename: str) -> Optional[str]:
-    """Analyzes extracted text content from a file using Gemini."""
+async def _cached_file_call(prompt: str, user_id: Optional[int]) -> Tuple[Optional[str], Any]:
+    """One file-analysis request through the result cache. Returns (text or None if empty/blocked, response)."""
+    result_key = result_cache.make_key("file", settings.GEMINI_TEXT_MODEL, prompt)
+    cached = await result_cache.get(result_key)
+    if cached is not None:
+        return cached, None
+    response, served_model = await gemini_client.generate_with_model(
+        text_model, [prompt],
+        call_type="file",
+        user_id=user_id,
+        generation_config=generation_config,
+        safety_settings=safety_settings,
+    )
+    if response and response.candidates and response.candidates[0].content.parts:
+        text = response.candidates[0].content.parts[0].text.strip()
+        if text:
+            if _cacheable(text_model, served_model):
+                await result_cache.put(result_key, "file", text)
+            return text, response
+    return None, response
+
+def _cacheable(template: ModelTemplate, served_model: Optional[str]) -> bool:
+    """The cache key names the primary model: answers of the fallback model are not cached."""
+    return served_model is None or served_model == template.model_name
+
+def _pick_chunks(chunks: List[str], limit: int) -> List[Tuple[int, str]]:
+    """Keeps at most limit chunks spread evenly over the document (always the first and the last)."""
+    if limit <= 0 or len(chunks) <= limit:
+        return list(enumerate(chunks))
+    if limit == 1:
+        return [(0, chunks[0])]
+    step = (len(chunks) - 1) / (limit - 1)
+    return [(round(i * step), chunks[round(i * step)]) for i in range(limit)]
+
+async def _map_chunks(chunks: List[Tuple[int, str]], total: int, filename: str, user_id: Optional[int],
+                      progress: Optional[ProgressCallback]) -> List[Tuple[int, str]]:
+    """Analyzes chunks concurrently, at most as many at once as there are analysis slots. Returns (index, notes)."""
+    done = 0
+    # Дедлайн вызова считается с постановки в очередь планировщика: если отправить все части
+    # сразу, последние части большого файла истекают в очереди, так и не дойдя до API
+    limiter = asyncio.Semaphore(gemini_client.analysis_slots())
+
+    async def analyze_chunk(index: int, chunk: str) -> Optional[str]:
+        nonlocal done
+        prompt = (f"Это часть {index + 1} из {total} файла '{filename}'. Кратко изложи основные моменты "
+                  f"этой части: факты, цифры, выводы, имена. Не делай выводов о документе в целом, "
+                  f"не пиши вступлений.\n\n{chunk}")
+        try:
+            async with limiter:
+                notes, _ = await _cached_file_call(prompt, user_id)
+            return notes
+        finally:
+            done += 1
+            if progress:
+                await progress(done, len(chunks))
+
+    results = await asyncio.gather(*(analyze_chunk(index, chunk) for index, chunk in chunks), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    for error in errors:
+        # Исчерпанная квота и недоступный API касаются всего документа - сообщаем пользователю
+        if isinstance(error, (GeminiQuotaExceededError, GeminiUnavailableError)):
+            raise error
+    notes = [(index, result) for (index, _), result in zip(chunks, results) if isinstance(result, str)]
+    if not notes and errors:
+        raise errors[0]
+    if errors or len(notes) < len(chunks):
+        logger.warning(f"File analysis of {filename}: {len(chunks) - len(notes)} of {len(chunks)} part(s) failed or were blocked.")
+    return notes
+
+async def _reduce_notes(notes: List[Tuple[int, str]], total: int, filename: str, user_id: Optional[int]) -> Optional[str]:
+    """Folds per-part notes into one analysis, in several rounds if they do not fit one prompt."""
+    blocks = [f"[Часть {index + 1} из {total}]\n{text}" for index, text in notes]
+    limiter = asyncio.Semaphore(gemini_client.analysis_slots())  # см. _map_chunks
+
+    async def reduce_group(prompt: str):
+        async with limiter:
+            return await _cached_file_call(prompt, user_id)
+
+    while True:
+        groups = split_text_chunks("\n\n\n".join(blocks), settings.MAX_FILE_CONTENT_LENGTH_FOR_GEMINI) if len(blocks) > 1 else blocks
+        final = len(groups) == 1
+        if final:
+            instruction = (f"Ниже - заметки по частям файла '{filename}'. Составь по ним единый анализ содержимого "
+                           f"всего файла: о чем он, основные моменты, важные факты и выводы. "
+                           f"Не перечисляй части по отдельности.")
+        else:
+            instruction = (f"Ниже - заметки по нескольким частям файла '{filename}'. Объедини их в одни сжатые "
+                           f"заметки, сохранив факты, цифры и выводы.")
+        results = await asyncio.gather(*(reduce_group(f"{instruction}\n\n{group}") for group in groups))
+        reduced = [text for text, _ in results if text]
+        if final or not reduced:
+            return reduced[0] if reduced else None
+        if len(reduced) >= len(blocks):
+            # Заметки не сжимаются - дальше сворачивать бессмысленно
+            return "\n\n".join(reduced)
+        blocks = reduced
+
+async def analyze_file_content(text_content: str, filename: str, user_id: Optional[int] = None,
+                               progress: Optional[ProgressCallback] = None) -> Optional[str]:
+    """
+    Analyzes extracted text content from a file using Gemini.
+    Content that does not fit one request is split on page and paragraph boundaries,
+    the parts are analyzed concurrently and their notes reduced into one analysis
+    (at most DOC_ANALYSIS_MAX_CHUNKS parts, spread over the document).
+    progress(done, total) is awaited after each analyzed part.
+    """
     if not text_model:
         logger.error("Gemini text model is not initialized.")
         return "Извините, произошла ошибка конфигурации AI"
 
-    max_chars_for_prompt = 8000
-    truncated_content = text_content[:max_chars_for_prompt]
-    truncation_note = "\n\n(Содержимое файла было урезано для анализа)" if len(text_content) > max_chars_for_prompt else ""
-    prompt = f"Проанализируй содержимое файла '{filename}'. Основные моменты:\n\n{truncated_content}{truncation_note}"
-
     try:
+        all_chunks = split_text_chunks(text_content, settings.MAX_FILE_CONTENT_LENGTH_FOR_GEMINI)
+        if len(all_chunks) > 1:
+            chunks = _pick_chunks(all_chunks, settings.DOC_ANALYSIS_MAX_CHUNKS)
+            logger.info(f"File {filename} is analyzed in {len(chunks)} of {len(all_chunks)} part(s) "
+                        f"({len(text_content)} chars).")
+            notes = await _map_chunks(chunks, len(all_chunks), filename, user_id, progress)
+            analysis = await _reduce_notes(notes, len(all_chunks), filename, user_id)
+            if not analysis:
+                return "Извините, не удалось получить анализ файла от AI"
+            if len(notes) < len(all_chunks):
+                analysis += (f"\n\n(Проанализировано {len(notes)} из {len(all_chunks)} частей файла: "
+                             f"остальные пропущены из-за ограничения объема или ошибок)")
+            logger.info(f"Received map-reduce file analysis for {filename} (length: {len(analysis)}).")
+            return analysis
+
+        prompt = f"Проанализируй содержимое файла '{filename}'. Основные моменты:\n\n{text_content.strip()}"
         logger.debug(f"Sending file content analysis request ({settings.GEMINI_TEXT_MODEL}) for file: {filename}. Prompt size approx: {len(prompt)} chars.")
-
-        logger.debug(f"Starting Gemini file analysis in thread for {filename}...")
-        response = await asyncio.to_thread(
-            text_model.generate_content,
-            contents=[prompt],
-            generation_config=generation_config,
-            safety_settings=safety_settings,
-        )
-        logger.debug(f"Finished Gemini file analysis in thread for {filename}.")
-
-        if response and response.candidates and response.candidates[0].content.parts:
-            analysis = response.candidates[0].content.parts[0].text
+        analysis, response = await _cached_file_call(prompt, user_id)
+        if analysis:
             logger.info(f"Received file content analysis from Gemini for file {filename} (length: {len(analysis)}).")
-            return analysis.strip()
-        else:
-            block_reason = response.prompt_feedback.block_reason if response.prompt_feedback else 'Unknown'
-            finish_reason = response.candidates[0].finish_reason if response.candidates else 'Unknown'
-            logger.warning(f"Gemini file analysis response was empty/blocked for {filename}. Block reason: {block_reason}, Finish reason: {finish_reason}")
-            try: fallback_text = response.text
-            except Exception: fallback_text = None
-            if finish_reason == 'SAFETY': return "Извините, содержимое файла не соответствует правилам безопасности"
-            elif block_reason != 'Unknown' and block_reason != 'OTHER': return f"Извините, не могу проанализировать файл. Причина: {block_reason}"
-            elif fallback_text: return fallback_text.strip()
-            else: return "Извините, не удалось получить анализ файла от AI"
-
+            return analysis
+        block_reason = response.prompt_feedback.block_reason if response and response.prompt_feedback else 'Unknown'
+        finish_reason = response.candidates[0].finish_reason if response and response.candidates else 'Unknown'
+        logger.warning(f"Gemini file analysis response was empty/blocked for {filename}. Block reason: {block_reason}, Finish reason: {finish_reason}")
+        try: fallback_text = response.text
+        except Exception: fallback_text = None
+        if finish_reason == 'SAFETY': return "Извините, содержимое файла не соответствует правилам безопасности"
+        elif block_reason != 'Unknown' and block_reason != 'OTHER': return f"Извините, не могу проанализировать файл. Причина: {block_reason}"
+        elif fallback_text: return fallback_text.strip()
+        else: return "Извините, не удалось получить анализ файла от AI"
+
+    except GeminiQuotaExceededError as e:
+        return _quota_message(e)
+    except GeminiUnavailableError as e:
+        logger.warning(f"Gemini call skipped, API unavailable: {e}")
+        return _unavailable_message(e)
+    except GeminiTimeoutError:
+        logger.error(f"Gemini file analysis timed out ({filename}).")
+        return "AI слишком долго анализирует файл. Попробуйте позже"
     except Exception as e:
         logger.error(f"Error analyzing file content with Gemini ({filename}): {e}")
         logger.exception(e)
         return "Произошла ошибка при анализе файла"
 
-async def translate_via_gemini(text: str, target_language: str) -> Optional[str]:
+async def translate_via_gemini(text: str, target_language: str, user_id: Optional[int] = None) -> Optional[str]:
     """Translates text using Gemini."""
     if not text_model:
         logger.error("Gemini text model is not initialized.")
@@ -197,20 +599,29 @@ async def translate_via_gemini(text: str, target_language: str) -> Optional[str]
     prompt = f"Переведи следующий текст на язык '{target_language}':\n\n{text}"
 
     try:
+        result_key = result_cache.make_key("translate", settings.GEMINI_TEXT_MODEL, prompt)
+        cached = await result_cache.get(result_key)
+        if cached is not None:
+            logger.info(f"Translation to '{target_language}' served from cache.")
+            return cached
+
         logger.info(f"Requesting translation via Gemini ({settings.GEMINI_TEXT_MODEL}) to '{target_language}'. Text length: {len(text)}")
 
-        logger.debug(f"Starting Gemini translation in thread to {target_language}...")
-        response = await asyncio.to_thread(
-            text_model.generate_content,
-            contents=[prompt],
+        logger.debug(f"Starting Gemini translation to {target_language}...")
+        response, served_model = await gemini_client.generate_with_model(
+            text_model, [prompt],
+            call_type="translate",
+            user_id=user_id,
             generation_config=generation_config,
             safety_settings=safety_settings,
         )
-        logger.debug(f"Finished Gemini translation in thread to {target_language}.")
+        logger.debug(f"Finished Gemini translation to {target_language}.")
 
         if response and response.candidates and response.candidates[0].content.parts:
             translated_text = response.candidates[0].content.parts[0].text
             logger.info(f"Received translation from Gemini (length: {len(translated_text)}).")
+            if _cacheable(text_model, served_model):
+                await result_cache.put(result_key, "translate", translated_text.strip())
             return translated_text.strip()
         else:
             block_reason = response.prompt_feedback.block_reason if response.prompt_feedback else 'Unknown'
@@ -221,6 +632,14 @@ async def translate_via_gemini(text: str, target_language: str) -> Optional[str]
             if finish_reason == 'SAFETY': return "Извините, текст для перевода не соответствует правилам безопасности"
             else: return "Извините, не удалось получить перевод от AI"
 
+    except GeminiQuotaExceededError as e:
+        return _quota_message(e)
+    except GeminiUnavailableError as e:
+        logger.warning(f"Gemini call skipped, API unavailable: {e}")
+        return _unavailable_message(e)
+    except GeminiTimeoutError:
+        logger.error("Gemini translation timed out.")
+        return "AI слишком долго переводит текст. Попробуйте позже"
     except Exception as e:
         logger.error(f"Error translating text via Gemini: {e}")
         logger.exception(e)
@@ -0,0 +1,446 @@
+# --- START OF FILE services/gemini_client.py ---
+
+import asyncio
+import random
+import time
+from google.api_core import exceptions as google_exceptions
+from loguru import logger
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+from config import settings
+from services import database
+from services.gemini_pool import pool
+from utils.fair_scheduler import FairScheduler
+from utils.helpers import estimate_tokens
+
+# Низкоуровневый асинхронный доступ к Gemini: нативные async-методы SDK вместо
+# asyncio.to_thread, глобальный лимит одновременных запросов и дедлайны, которые
+# действительно отменяют запрос (а не оставляют висеть поток в executor'е).
+#
+# Поверх этого: пул ключей/моделей с квотами RPM/TPM на ключ (services/gemini_pool.py;
+# запросы ждут в очереди, а не получают 429), повтор временных ошибок с экспоненциальной
+# задержкой (каждая попытка заново выбирает ключ и модель) и circuit breaker, который
+# при недоступности API сразу отказывает вместо новых попыток.
+#
+# Слоты конкурентности раздает справедливый планировщик (utils/fair_scheduler.py):
+# диалог важнее анализа файлов и фото, а те - фоновых сводок; внутри класса слоты
+# делятся между пользователями пропорционально (оценочному) объему их запросов.
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_ANALYSIS = 1
+PRIORITY_BACKGROUND = 2
+
+_PRIORITIES = {
+    "text": PRIORITY_INTERACTIVE,
+    "stream": PRIORITY_INTERACTIVE,
+    "translate": PRIORITY_INTERACTIVE,
+    "vision": PRIORITY_ANALYSIS,
+    "file": PRIORITY_ANALYSIS,
+    "summary": PRIORITY_BACKGROUND,
+}
+
+_scheduler = FairScheduler(
+    settings.GEMINI_MAX_CONCURRENCY,
+    classes=("interactive", "analysis", "background"),
+    reserved=settings.GEMINI_INTERACTIVE_RESERVED_SLOTS,
+)
+
+_stats: Dict[str, int] = {
+    "in_flight": 0,   # запросы, выполняющиеся прямо сейчас
+    "completed": 0,
+    "failed": 0,
+    "timed_out": 0,
+    "queue_timeouts": 0,  # из них не дождались слота в очереди планировщика
+    "retries": 0,
+    "rate_limited": 0,  # запросы, ждавшие лимитера
+    "rejected": 0,      # отклонены открытым breaker'ом
+}
+
+# Временные ошибки: имеет смысл повторить запрос чуть позже
+_TRANSIENT_ERRORS = (
+    google_exceptions.TooManyRequests,  # 429, в т.ч. ResourceExhausted
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.GatewayTimeout,
+)
+
+# Картинка стоит фиксированное число токенов независимо от размера (для оценки TPM)
+_IMAGE_TOKENS = 258
+
+
+class GeminiTimeoutError(Exception):
+    """Raised when a Gemini call does not finish within its deadline (the request is cancelled)."""
+
+
+class GeminiUnavailableError(Exception):
+    """Raised without calling the API while the circuit breaker is open."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Gemini API is unavailable, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class GeminiQuotaExceededError(Exception):
+    """Raised without calling the API when the user has spent their daily token quota."""
+
+    def __init__(self, used: int, quota: int):
+        super().__init__(f"Daily token quota exceeded: {used}/{quota}")
+        self.used = used
+        self.quota = quota
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `threshold` consecutive failed calls; open rejects calls for
+    `cooldown` seconds; then half-open lets a single probe through, whose outcome
+    closes or re-opens the circuit.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.state = "closed"
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def before_call(self):
+        """Raises GeminiUnavailableError if the call must not go out."""
+        if self.state == "closed":
+            return
+        remaining = self._opened_at + self.cooldown - time.monotonic()
+        if self.state == "open" and remaining > 0:
+            raise GeminiUnavailableError(remaining)
+        if self._probe_in_flight:
+            raise GeminiUnavailableError(max(remaining, 1.0))
+        self.state = "half-open"
+        self._probe_in_flight = True
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info("Gemini circuit breaker closed: upstream is responding again.")
+        self.failures = 0
+        self.state = "closed"
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == "half-open" or self.failures >= self.threshold:
+            if self.state != "open":
+                logger.warning(f"Gemini circuit breaker opened after {self.failures} failure(s); "
+                               f"failing fast for {self.cooldown:.0f}s.")
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+    def release_probe(self):
+        """Frees the half-open probe slot when the call ended without a verdict (cancelled, bad request)."""
+        self._probe_in_flight = False
+
+
+_breaker = CircuitBreaker(settings.GEMINI_BREAKER_THRESHOLD, settings.GEMINI_BREAKER_COOLDOWN_SEC)
+
+
+def _deadline(timeout: float | None) -> float:
+    return timeout if timeout is not None else settings.GEMINI_REQUEST_TIMEOUT_SEC
+
+
+def _estimate_request_tokens(contents) -> int:
+    """Rough input token count of a request (text parts by length, images at a flat rate)."""
+    if isinstance(contents, str):
+        return estimate_tokens(contents)
+    total = 0
+    for item in contents:
+        if isinstance(item, str):
+            total += estimate_tokens(item)
+        elif isinstance(item, dict):
+            total += _estimate_request_tokens(item.get('parts', []))
+        else:
+            total += _IMAGE_TOKENS
+    return total
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter: uniform(0, min(max, base * 2^attempt))."""
+    return random.uniform(0, min(settings.GEMINI_RETRY_MAX_SEC, settings.GEMINI_RETRY_BASE_SEC * (2 ** attempt)))
+
+
+async def _lease_endpoint(model, estimated_tokens: int, call_type: str):
+    """Picks a key/model from the pool and waits for that key's RPM/TPM quota."""
+    lease, waited = await pool.acquire(model, estimated_tokens)
+    if waited > 0.05:
+        _stats["rate_limited"] += 1
+        logger.debug(f"Gemini {call_type} call waited {waited:.2f}s for RPM/TPM quota of key {lease.api_key.label}.")
+    return lease
+
+
+def _priority(call_type: str, priority: Optional[int]) -> int:
+    return priority if priority is not None else _PRIORITIES.get(call_type, PRIORITY_ANALYSIS)
+
+
+async def _start_with_retries(model, contents, call_type: str, started: float, deadline: float, state: Dict[str, Any],
+                              hold_slot: bool = False, request_timeout: Optional[float] = None, **kwargs) -> Any:
+    """
+    Sends one request (or opens one stream) with scheduling, quota and retries.
+    Transient errors are retried with backoff; the last one is re-raised.
+    With hold_slot the concurrency slot stays taken after success (the caller releases it).
+    request_timeout overrides the API-side timeout (by default what is left of the deadline).
+    state["dispatched"] tells the caller whether the call ever got past the scheduler queue;
+    state["model_name"] gets the model that served it (None for objects the pool passes through).
+    """
+    attempt = 0
+    estimated_tokens = _estimate_request_tokens(contents)
+    while True:
+        # Сначала слот планировщика, потом квота ключа: очередь к RPM/TPM тоже
+        # идет в порядке, который выбрал планировщик
+        waited = await _scheduler.acquire(state["user_id"], state["priority"], cost=estimated_tokens)
+        state["dispatched"] = True
+        if waited > 1.0:
+            logger.debug(f"Gemini {call_type} call for user {state['user_id']} waited {waited:.2f}s in the scheduler queue.")
+        _stats["in_flight"] += 1
+        keep_slot = False
+        try:
+            lease = await _lease_endpoint(model, estimated_tokens, call_type)
+            remaining = request_timeout or max(1.0, deadline - (time.monotonic() - started))
+            response = await lease.model.generate_content_async(contents, request_options={"timeout": remaining}, **kwargs)
+            pool.report_success(lease)
+            state["model_name"] = lease.model_name
+            keep_slot = hold_slot
+            return response
+        except _TRANSIENT_ERRORS as e:
+            pool.report_failure(lease, e, quota_exhausted=isinstance(e, google_exceptions.TooManyRequests))
+            if attempt >= settings.GEMINI_MAX_RETRIES:
+                raise
+            delay = _backoff_delay(attempt)
+            attempt += 1
+            _stats["retries"] += 1
+            logger.warning(f"Gemini {call_type} call failed with {type(e).__name__} on key {lease.api_key.label}, "
+                           f"retry {attempt}/{settings.GEMINI_MAX_RETRIES} in {delay:.1f}s.")
+        except google_exceptions.GoogleAPICallError:
+            pool.report_neutral(lease)
+            raise
+        finally:
+            if not keep_slot:
+                _stats["in_flight"] -= 1
+                _scheduler.release(state["priority"])
+        await asyncio.sleep(delay)
+
+
+async def _check_quota(user_id: Optional[int], call_type: str, enforce: bool):
+    if user_id is None or not enforce or settings.USER_DAILY_TOKEN_QUOTA <= 0:
+        return
+    used = await database.get_tokens_used_today(user_id)
+    if used >= settings.USER_DAILY_TOKEN_QUOTA:
+        logger.warning(f"Gemini {call_type} call for user {user_id} rejected: daily quota {used}/{settings.USER_DAILY_TOKEN_QUOTA}.")
+        raise GeminiQuotaExceededError(used, settings.USER_DAILY_TOKEN_QUOTA)
+
+
+def _record_usage(user_id: Optional[int], call_type: str, contents, response, started: float, completion_text: str = ""):
+    """Books usage_metadata of a finished call (or an estimate if the response has none) to the user."""
+    if user_id is None:
+        return
+    usage = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    completion_tokens = getattr(usage, "candidates_token_count", 0) or 0
+    total_tokens = getattr(usage, "total_token_count", 0) or 0
+    if not total_tokens:
+        prompt_tokens = prompt_tokens or _estimate_request_tokens(contents)
+        completion_tokens = completion_tokens or estimate_tokens(completion_text or _response_text(response))
+        total_tokens = prompt_tokens + completion_tokens
+    database.record_usage(user_id, call_type, prompt_tokens, completion_tokens, total_tokens,
+                          int((time.monotonic() - started) * 1000))
+
+
+def _response_text(response) -> str:
+    try:
+        return response.text
+    except Exception:
+        return ""
+
+
+def _check_breaker(call_type: str):
+    try:
+        _breaker.before_call()
+    except GeminiUnavailableError:
+        _stats["rejected"] += 1
+        logger.warning(f"Gemini {call_type} call rejected: circuit breaker is {_breaker.state}.")
+        raise
+
+
+def _record_timeout(call_type: str, deadline: float, state: Dict[str, Any], what: str = "call"):
+    _stats["timed_out"] += 1
+    if state["dispatched"]:
+        _breaker.record_failure()
+        logger.warning(f"Gemini {call_type} {what} cancelled after {deadline:.0f}s deadline.")
+    else:
+        # Запрос так и не дождался слота - API тут ни при чем, breaker не трогаем
+        _stats["queue_timeouts"] += 1
+        _breaker.release_probe()
+        logger.warning(f"Gemini {call_type} {what} for user {state['user_id']} cancelled after "
+                       f"{deadline:.0f}s in the scheduler queue.")
+
+
+async def generate(model, contents, **kwargs) -> Any:
+    """Calls the model (see generate_with_model) and returns the response."""
+    response, _ = await generate_with_model(model, contents, **kwargs)
+    return response
+
+
+async def generate_with_model(model, contents, *, timeout: float | None = None, call_type: str = "text",
+                              user_id: Optional[int] = None, enforce_quota: bool = True,
+                              priority: Optional[int] = None, **kwargs) -> Tuple[Any, Optional[str]]:
+    """
+    Calls model.generate_content_async under the fair scheduler, the quota limiter
+    and the circuit breaker, retrying transient errors.
+    The deadline covers queueing, retries and the request itself; on expiry the
+    request is cancelled and GeminiTimeoutError is raised.
+    With user_id the call is checked against the user's daily token quota first
+    (GeminiQuotaExceededError) and its token usage is booked to the user.
+    The priority class defaults to the one of call_type (see _PRIORITIES).
+    Returns the response and the full name of the model that served it: after failover
+    it is the fallback model (None for objects the key pool passes through as is).
+    """
+    deadline = _deadline(timeout)
+    started = time.monotonic()
+    await _check_quota(user_id, call_type, enforce_quota)
+    _check_breaker(call_type)
+    state = {"user_id": user_id, "priority": _priority(call_type, priority), "dispatched": False, "model_name": None}
+    try:
+        response = await asyncio.wait_for(
+            _start_with_retries(model, contents, call_type, started, deadline, state, **kwargs),
+            timeout=deadline,
+        )
+    except asyncio.TimeoutError:
+        _record_timeout(call_type, deadline, state)
+        raise GeminiTimeoutError(f"Gemini {call_type} call exceeded {deadline:.0f}s") from None
+    except asyncio.CancelledError:
+        _breaker.release_probe()
+        raise
+    except _TRANSIENT_ERRORS:
+        _stats["failed"] += 1
+        _breaker.record_failure()
+        raise
+    except Exception:
+        # Ошибка запроса (400, блокировка и т.п.) - API при этом доступен
+        _stats["failed"] += 1
+        _breaker.release_probe()
+        raise
+    _stats["completed"] += 1
+    _breaker.record_success()
+    _record_usage(user_id, call_type, contents, response, started)
+    logger.debug(f"Gemini {call_type} call finished in {time.monotonic() - started:.2f}s.")
+    return response, state["model_name"]
+
+
+async def generate_stream(model, contents, *, timeout: float | None = None, call_type: str = "stream",
+                          user_id: Optional[int] = None, enforce_quota: bool = True,
+                          priority: Optional[int] = None, **kwargs) -> AsyncIterator[Any]:
+    """
+    Streams model.generate_content_async(stream=True) chunks with the same limits as generate().
+    Opening the stream is retried on transient errors; a stream that already produced
+    chunks is not restarted. The deadline covers queueing, retries and the first chunk;
+    after that the stream is cancelled only if no chunk arrives within
+    GEMINI_STREAM_IDLE_TIMEOUT_SEC or it runs longer than GEMINI_STREAM_MAX_SEC.
+    Closing the generator early cancels the underlying request.
+    """
+    deadline = _deadline(timeout)
+    started = time.monotonic()
+    await _check_quota(user_id, call_type, enforce_quota)
+    _check_breaker(call_type)
+    state = {"user_id": user_id, "priority": _priority(call_type, priority), "dispatched": False}
+    first_chunk = True
+
+    def chunk_timeout() -> float:
+        # До первого фрагмента - остаток общего дедлайна, дальше - пауза между фрагментами
+        elapsed = time.monotonic() - started
+        left = (deadline if first_chunk else settings.GEMINI_STREAM_MAX_SEC) - elapsed
+        if left <= 0:
+            raise asyncio.TimeoutError
+        return left if first_chunk else min(left, settings.GEMINI_STREAM_IDLE_TIMEOUT_SEC)
+
+    try:
+        # Слот конкурентности остается занятым, пока читается поток (освобождается в finally ниже)
+        response = await asyncio.wait_for(
+            _start_with_retries(model, contents, call_type, started, deadline, state, hold_slot=True,
+                                request_timeout=settings.GEMINI_STREAM_MAX_SEC, stream=True, **kwargs),
+            timeout=deadline,
+        )
+    except asyncio.TimeoutError:
+        _record_timeout(call_type, deadline, state, "stream")
+        raise GeminiTimeoutError(f"Gemini {call_type} stream exceeded {deadline:.0f}s") from None
+    except asyncio.CancelledError:
+        _breaker.release_probe()
+        raise
+    except _TRANSIENT_ERRORS:
+        _stats["failed"] += 1
+        _breaker.record_failure()
+        raise
+    except Exception:
+        _stats["failed"] += 1
+        _breaker.release_probe()
+        raise
+
+    last_chunk = None
+    streamed_text = []
+    try:
+        iterator = response.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), timeout=chunk_timeout())
+            except StopAsyncIteration:
+                break
+            first_chunk = False
+            last_chunk = chunk
+            if user_id is not None:
+                streamed_text.append(_response_text(chunk))
+            yield chunk
+        _stats["completed"] += 1
+        _breaker.record_success()
+        # usage_metadata с итоговыми счетчиками приходит в последнем чанке
+        _record_usage(user_id, call_type, contents, last_chunk, started, "".join(streamed_text))
+        logger.debug(f"Gemini {call_type} stream finished in {time.monotonic() - started:.2f}s.")
+    except asyncio.TimeoutError:
+        _stats["timed_out"] += 1
+        _breaker.record_failure()
+        if first_chunk:
+            reason = f"no response within the {deadline:.0f}s deadline"
+        elif time.monotonic() - started >= settings.GEMINI_STREAM_MAX_SEC:
+            reason = f"streaming longer than {settings.GEMINI_STREAM_MAX_SEC:.0f}s"
+        else:
+            reason = f"no new chunk for {settings.GEMINI_STREAM_IDLE_TIMEOUT_SEC:.0f}s"
+        logger.warning(f"Gemini {call_type} stream cancelled: {reason}.")
+        raise GeminiTimeoutError(f"Gemini {call_type} stream cancelled: {reason}") from None
+    except (asyncio.CancelledError, GeneratorExit):
+        _breaker.release_probe()
+        raise
+    except _TRANSIENT_ERRORS:
+        _stats["failed"] += 1
+        _breaker.record_failure()
+        raise
+    except Exception:
+        _stats["failed"] += 1
+        _breaker.release_probe()
+        raise
+    finally:
+        _stats["in_flight"] -= 1
+        _scheduler.release(state["priority"])
+
+
+def analysis_slots() -> int:
+    """Concurrency slots open to analysis calls (the limit minus the slots reserved for chat)."""
+    return _scheduler.limit - _scheduler.reserved
+
+
+def get_stats() -> Dict[str, Any]:
+    """Returns in-flight / waiting gauges, completion counters, breaker state, scheduler queues and per-key pool stats."""
+    return dict(
+        _stats,
+        waiting=_scheduler.queued(),
+        limit=settings.GEMINI_MAX_CONCURRENCY,
+        scheduler=_scheduler.stats(),
+        breaker=_breaker.state,
+        pool=pool.stats(),
+    )
+
+# --- END OF FILE services/gemini_client.py ---
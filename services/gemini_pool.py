@@ -0,0 +1,268 @@
+# --- START OF FILE services/gemini_pool.py ---
+
+import asyncio
+import importlib
+import time
+import weakref
+import google.generativeai as genai
+from google.ai import generativelanguage as glm
+from loguru import logger
+from typing import Any, Callable, Dict, List, Optional
+
+from config import settings
+
+# Пул ключей API и моделей Gemini. Каждый ключ имеет свой вес, свою квоту RPM/TPM
+# (token bucket) и свой async-клиент. Выбор ключа - плавный взвешенный round-robin
+# (как в nginx) среди здоровых ключей; ключ, давший подряд несколько ошибок или
+# упершийся в квоту, временно исключается (пассивная проверка здоровья). Модель,
+# которая подряд отвечает перегрузкой, так же исключается, и запросы переходят
+# на GEMINI_FALLBACK_MODEL.
+#
+# Модели задаются шаблонами (ModelTemplate) - открытыми аргументами конструктора
+# GenerativeModel; пул сам строит из них модель для каждой пары (ключ, модель).
+
+
+def _load_client_factory() -> Callable[[str], Any]:
+    """API key -> async client: GenerativeServiceAsyncClient, or the "module:callable" from GEMINI_CLIENT_FACTORY (fake backends for load tests)."""
+    if not settings.GEMINI_CLIENT_FACTORY:
+        return lambda key: glm.GenerativeServiceAsyncClient(client_options={"api_key": key})
+    module_name, _, attr = settings.GEMINI_CLIENT_FACTORY.partition(":")
+    return getattr(importlib.import_module(module_name), attr or "create_client")
+
+
+_client_factory = _load_client_factory()
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at rate_per_minute / 60 per second.
+    Waiters are served strictly in FIFO order; rate_per_minute <= 0 disables the limit.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self._rate = self.capacity / 60.0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()  # asyncio.Lock будит ожидающих в порядке очереди
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def available(self, amount: float = 1.0) -> bool:
+        """True if amount tokens could be taken right now without waiting."""
+        if self.capacity <= 0:
+            return True
+        self._refill()
+        return self.tokens >= min(amount, self.capacity) and not self._lock.locked()
+
+    async def acquire(self, amount: float = 1.0) -> float:
+        """Takes amount tokens, waiting as long as needed. Returns the time spent waiting."""
+        if self.capacity <= 0:
+            return 0.0
+        amount = min(amount, self.capacity)  # запрос больше ведра иначе ждал бы вечно
+        started = time.monotonic()
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self._rate)
+                self._refill()
+            self.tokens -= amount
+        return time.monotonic() - started
+
+
+class _Health:
+    """Consecutive-error counter with timed ejection."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.ejected_until = 0.0
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def success(self):
+        self.requests += 1
+        self.consecutive_errors = 0
+
+    def failure(self, eject_now: bool = False) -> bool:
+        """Records an error; returns True if this ejected the member."""
+        self.requests += 1
+        self.errors += 1
+        self.consecutive_errors += 1
+        if eject_now or self.consecutive_errors >= settings.GEMINI_EJECT_AFTER_ERRORS:
+            self.ejected_until = time.monotonic() + settings.GEMINI_EJECT_SEC
+            self.consecutive_errors = 0
+            return True
+        return False
+
+
+class ApiKey:
+    def __init__(self, index: int, key: str, weight: int):
+        self.index = index
+        self.key = key
+        self.weight = max(1, weight)
+        self.current_weight = 0  # для плавного взвешенного round-robin
+        self.requests_bucket = TokenBucket(settings.GEMINI_RPM)
+        self.tokens_bucket = TokenBucket(settings.GEMINI_TPM)
+        self.health = _Health()
+        self._client = None
+
+    @property
+    def label(self) -> str:
+        return f"#{self.index + 1} (...{self.key[-4:]})"
+
+    def async_client(self):
+        # Клиент создается лениво, уже внутри работающего event loop
+        if self._client is None:
+            self._client = _client_factory(self.key)
+        return self._client
+
+
+def _full_name(model_name: str) -> str:
+    return model_name if "/" in model_name else f"models/{model_name}"
+
+
+class ModelTemplate:
+    """
+    Public constructor arguments of a Gemini model: the name plus GenerativeModel keyword
+    arguments (system_instruction, safety_settings, generation_config). The pool builds
+    a GenerativeModel from them for each API key and for the fallback model.
+    """
+
+    def __init__(self, model_name: str, **model_kwargs):
+        self.model_name = _full_name(model_name)
+        self.model_kwargs = model_kwargs
+
+
+class Lease:
+    """One attempt's choice of key and model; report the outcome back to the pool."""
+
+    def __init__(self, api_key: Optional[ApiKey], model: Any, model_name: Optional[str]):
+        self.api_key = api_key
+        self.model = model
+        self.model_name = model_name
+
+
+class GeminiPool:
+    def __init__(self, keys: List[ApiKey], fallback_model: Optional[str]):
+        self.keys = keys
+        self.fallback_model = _full_name(fallback_model) if fallback_model else None
+        self.model_health: Dict[str, _Health] = {}
+        # Модели, привязанные к клиенту ключа: шаблон -> {(ключ, модель): модель}
+        self._bound: "weakref.WeakKeyDictionary[ModelTemplate, Dict]" = weakref.WeakKeyDictionary()
+
+    def _pick_key(self, now: float, amount: float) -> ApiKey:
+        """Smooth weighted round-robin over healthy keys, preferring keys with quota left."""
+        healthy = [key for key in self.keys if key.health.healthy(now)] or self.keys
+        candidates = [key for key in healthy
+                      if key.requests_bucket.available(1) and key.tokens_bucket.available(amount)] or healthy
+        total = sum(key.weight for key in candidates)
+        for key in candidates:
+            key.current_weight += key.weight
+        chosen = max(candidates, key=lambda key: key.current_weight)
+        chosen.current_weight -= total
+        return chosen
+
+    def _pick_model_name(self, template_name: str, now: float) -> str:
+        health = self.model_health.get(template_name)
+        if self.fallback_model and self.fallback_model != template_name and health and not health.healthy(now):
+            return self.fallback_model
+        return template_name
+
+    def _bind(self, template: ModelTemplate, api_key: ApiKey, model_name: str) -> genai.GenerativeModel:
+        bound = self._bound.setdefault(template, {})
+        model = bound.get((api_key.index, model_name))
+        if model is None:
+            model = genai.GenerativeModel(model_name, **template.model_kwargs)
+            # Клиент ключа конструктор не принимает: generate_content_async берет его из
+            # _async_client (при None - клиент по умолчанию). Это единственное обращение
+            # к внутренностям SDK; без этого поля все ключи молча шли бы через один клиент.
+            if not hasattr(model, "_async_client"):
+                raise RuntimeError(
+                    f"google-generativeai {getattr(genai, '__version__', '?')} is not supported by the Gemini key pool: "
+                    f"GenerativeModel has no _async_client. Install the version pinned in requirements.txt."
+                )
+            model._async_client = api_key.async_client()
+            bound[(api_key.index, model_name)] = model
+        return model
+
+    async def acquire(self, template: Any, estimated_tokens: int) -> "tuple[Lease, float]":
+        """
+        Picks a key and model for one attempt and waits for that key's RPM/TPM quota.
+        Returns the lease and the time spent waiting for quota.
+        Objects other than ModelTemplate (test doubles) are used as is, with the quota of the picked key.
+        """
+        now = time.monotonic()
+        api_key = self._pick_key(now, estimated_tokens)
+        waited = await api_key.requests_bucket.acquire(1)
+        waited += await api_key.tokens_bucket.acquire(estimated_tokens)
+        if not isinstance(template, ModelTemplate):
+            return Lease(api_key, template, None), waited
+        model_name = self._pick_model_name(template.model_name, now)
+        return Lease(api_key, self._bind(template, api_key, model_name), model_name), waited
+
+    def report_success(self, lease: Lease):
+        lease.api_key.health.success()
+        if lease.model_name:
+            self.model_health.setdefault(lease.model_name, _Health()).success()
+
+    def report_failure(self, lease: Lease, error: Exception, quota_exhausted: bool = False):
+        """Records a transient error; a key that hit its quota (429) is ejected immediately."""
+        if lease.api_key.health.failure(eject_now=quota_exhausted and len(self.keys) > 1):
+            logger.warning(f"Gemini API key {lease.api_key.label} ejected for {settings.GEMINI_EJECT_SEC:.0f}s "
+                           f"after {type(error).__name__}.")
+        # Перегрузку модели (5xx) записываем на модель: переключимся на запасную
+        if lease.model_name and not quota_exhausted:
+            if self.model_health.setdefault(lease.model_name, _Health()).failure():
+                target = self.fallback_model if self.fallback_model != lease.model_name else None
+                logger.warning(f"Gemini model {lease.model_name} ejected for {settings.GEMINI_EJECT_SEC:.0f}s"
+                               f"{f', failing over to {target}' if target else ''}.")
+
+    def report_neutral(self, lease: Lease):
+        """The request reached the API and was rejected for its own reasons (400, safety): the key is fine."""
+        lease.api_key.health.success()
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "keys": [
+                {
+                    "label": key.label,
+                    "weight": key.weight,
+                    "requests": key.health.requests,
+                    "errors": key.health.errors,
+                    "healthy": key.health.healthy(now),
+                    "rpm_available": int(key.requests_bucket.tokens) if key.requests_bucket.capacity > 0 else None,
+                }
+                for key in self.keys
+            ],
+            "models": {name: health.healthy(now) for name, health in self.model_health.items()},
+            "fallback_model": self.fallback_model,
+        }
+
+
+def _parse_keys(spec: str) -> List[ApiKey]:
+    """'key1:3,key2,key3:1' -> keys with weights (default weight 1)."""
+    keys: List[ApiKey] = []
+    for item in (part.strip() for part in spec.split(",")):
+        if not item:
+            continue
+        key, _, weight = item.partition(":")
+        try:
+            parsed_weight = int(weight) if weight else 1
+        except ValueError:
+            logger.warning(f"Invalid weight '{weight}' for a Gemini API key, using 1.")
+            parsed_weight = 1
+        keys.append(ApiKey(len(keys), key.strip(), parsed_weight))
+    return keys
+
+
+pool = GeminiPool(_parse_keys(settings.GEMINI_API_KEYS), settings.GEMINI_FALLBACK_MODEL or None)
+logger.info(f"Gemini pool: {len(pool.keys)} API key(s), fallback model: {pool.fallback_model or 'none'}.")
+
+# --- END OF FILE services/gemini_pool.py ---
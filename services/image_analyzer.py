@@ -1,5 +1,3 @@
-import pytesseract
-from PIL import Image
 import asyncio
 from pathlib import Path
 from loguru import logger
@@ -7,7 +5,9 @@ from typing import Optional, Dict
 
 # Предполагается, что эта функция импортируется и работает корректно
 from services.gemini import analyze_image_content as analyze_with_gemini  # Gemini Vision
+from services import cpu_pool, extractors
 from utils.helpers import cleanup_temp_file
+from utils.singleflight import SingleFlight
 
 async def extract_text_from_image(image_path: Path) -> Optional[str]:
     """Extracts text from an image using Tesseract OCR (Russian + English)."""
@@ -17,31 +17,14 @@ async def extract_text_from_image(image_path: Path) -> Optional[str]:
         return None
     try:
         logger.info(f"Extracting text from image (OCR): {image_path}")
-        # Синхронная функция для выполнения OCR
-        def run_ocr():
-            try:
-                # Открываем изображение
-                image = Image.open(image_path)
-                # Уменьшаем размер до 640x480 для ускорения
-                image = image.resize((480, 360), Image.Resampling.LANCZOS)
-                # Указываем русский и английский языки, PSM 6 - единый блок текста
-                custom_config = r'-l rus+eng --psm 6'
-                # Распознаем текст
-                return pytesseract.image_to_string(image, config=custom_config)
-            except pytesseract.TesseractNotFoundError:
-                logger.critical("Tesseract is not installed or not in PATH. OCR will not work.")
-                return None
-            except FileNotFoundError:
-                logger.error(f"Image file disappeared before Tesseract could open it: {image_path}")
-                return None
-            except Exception as ocr_err:
-                logger.error(f"Error during Tesseract OCR processing for {image_path}: {ocr_err}")
-                return None
-
-        # Запускаем синхронную функцию OCR в отдельном потоке
-        logger.debug(f"Starting Tesseract OCR in thread for {image_path}...")
-        text = await asyncio.to_thread(run_ocr)
-        logger.debug(f"Finished Tesseract OCR in thread for {image_path}.")
+        # OCR (PIL + Tesseract) - в пуле процессов, с дедлайном
+        logger.debug(f"Starting Tesseract OCR in process pool for {image_path}...")
+        try:
+            text = await cpu_pool.run(extractors.ocr_image, image_path)
+        except cpu_pool.ProcessPoolError as pool_err:
+            logger.error(f"OCR job failed for {image_path}: {pool_err}")
+            text = None
+        logger.debug(f"Finished Tesseract OCR for {image_path}.")
 
         # Обрабатываем результат
         if text is not None:
@@ -67,11 +50,37 @@ async def extract_text_from_image(image_path: Path) -> Optional[str]:
         logger.exception(e)  # Логируем traceback
         return None
 
-async def analyze_image(image_path: Path, user_id: int) -> Dict[str, Optional[str]]:
+# Одно и то же фото (file_unique_id), присланное одновременно, анализируется один раз
+_in_flight = SingleFlight()
+
+def get_in_flight_stats():
+    """Returns single-flight counters (image jobs started vs. requests that joined one)."""
+    return _in_flight.stats()
+
+async def analyze_image(image_path: Path, user_id: int, file_unique_id: Optional[str] = None) -> Dict[str, Optional[str]]:
     """
     Analyzes an image using Tesseract OCR and Gemini Vision.
     OCR result is obtained but NOT passed to Gemini Vision prompt.
+    file_unique_id (Telegram) lets repeated/forwarded photos hit the Vision result cache,
+    and concurrent requests for the same photo share one analysis.
     """
+    if not file_unique_id:
+        return await _analyze_image_file(image_path, user_id, None)
+
+    handed_over = False # файл передан общей задаче - она сама его удалит
+    def start_analysis():
+        nonlocal handed_over
+        handed_over = True
+        return _analyze_image_file(image_path, user_id, file_unique_id)
+    try:
+        result = await _in_flight.do(file_unique_id, start_analysis)
+    finally:
+        if not handed_over:
+            await cleanup_temp_file(image_path)
+    return dict(result)
+
+async def _analyze_image_file(image_path: Path, user_id: int, file_unique_id: Optional[str]) -> Dict[str, Optional[str]]:
+    """OCR + Gemini Vision for one image file; deletes the file (and its resized copy) when done."""
     ocr_text: Optional[str] = None
     vision_analysis: Optional[str] = None
 
@@ -89,16 +98,14 @@ async def analyze_image(image_path: Path, user_id: int) -> Dict[str, Optional[st
 
         # 2. Уменьшаем изображение для Gemini Vision
         temp_small_path = image_path.with_name(f"small_{image_path.name}")
-        image = Image.open(image_path)
-        image = image.resize((480, 360), Image.Resampling.LANCZOS)
-        image.save(temp_small_path)
+        await cpu_pool.run(extractors.resize_image, image_path, temp_small_path)
 
         # 3. Формируем промпт для Gemini Vision БЕЗ OCR
         vision_prompt = "Опиши это изображение подробно."
 
         # 4. Вызываем Gemini Vision
         logger.debug(f"Starting Gemini Vision analysis for {temp_small_path}...")
-        vision_analysis = await analyze_with_gemini(str(temp_small_path), prompt=vision_prompt)
+        vision_analysis = await analyze_with_gemini(str(temp_small_path), prompt=vision_prompt, cache_key=file_unique_id, user_id=user_id)
         logger.debug(f"Finished Gemini Vision analysis for {temp_small_path}.")
 
         # Логируем результат
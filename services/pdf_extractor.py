@@ -0,0 +1,79 @@
+# --- START OF FILE services/pdf_extractor.py ---
+
+import asyncio
+from pathlib import Path
+from loguru import logger
+from typing import List, Optional
+
+from config import settings
+from services import cpu_pool
+from services.extractors import PdfExtractionError, pymupdf, read_pdf_pages, pdf_page_count, read_pdf_page_range
+from utils.helpers import PAGE_BREAK
+
+# Извлечение текста из PDF. Страницы читаются лениво и только пока не набран бюджет
+# символов: дальше анализ (map-reduce в services/gemini.py) текст все равно не возьмет.
+# Чтение идет в пуле процессов (services/cpu_pool.py); большие документы читаются
+# несколькими процессами диапазонами страниц, волнами - чтобы остановиться, как только
+# хватит текста.
+
+
+class PdfText:
+    def __init__(self, text: str, pages_read: int, page_count: int, engine: str):
+        self.text = text
+        self.pages_read = pages_read
+        self.page_count = page_count
+        self.engine = engine
+
+    @property
+    def truncated(self) -> bool:
+        return self.pages_read < self.page_count
+
+
+def default_budget() -> int:
+    """As many characters as one file analysis can use."""
+    return settings.MAX_FILE_CONTENT_LENGTH_FOR_GEMINI * max(1, settings.DOC_ANALYSIS_MAX_CHUNKS)
+
+
+def _join(pages: List[str]) -> str:
+    # Граница страницы нужна для деления на части при анализе
+    return f"\n{PAGE_BREAK}\n".join(page for page in pages if page)
+
+
+async def _extract_parallel(file_path: Path, filename: str, page_count: int, budget: int) -> PdfText:
+    step = max(1, settings.PDF_PAGES_PER_TASK)
+    ranges = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+    pages: List[str] = []
+    collected = 0
+    # Волна - по диапазону на процесс; следующая запускается, только если текста еще мало
+    wave = max(1, cpu_pool.workers())
+    for offset in range(0, len(ranges), wave):
+        jobs = [cpu_pool.run(read_pdf_page_range, file_path, filename, start, stop)
+                for start, stop in ranges[offset:offset + wave]]
+        for texts in await asyncio.gather(*jobs):
+            for page_text in texts:
+                if budget and collected >= budget:
+                    break
+                pages.append(page_text)
+                collected += len(page_text)
+        if budget and collected >= budget:
+            break
+    return PdfText(_join(pages), len(pages), page_count, "pymupdf-parallel")
+
+
+async def extract_pdf_text(file_path: Path, filename: str, max_chars: Optional[int] = None) -> PdfText:
+    """
+    Extracts text from a PDF in the process pool, stopping at max_chars
+    (default: what one file analysis can use; 0 - no limit).
+    Large PDFs are read by several processes when PyMuPDF is installed and the pool has 2+ workers.
+    Raises PdfExtractionError with a user-facing message, cpu_pool errors on deadline/overload.
+    """
+    budget = default_budget() if max_chars is None else max_chars
+    if pymupdf is not None and cpu_pool.workers() > 1:
+        page_count = await cpu_pool.run(pdf_page_count, file_path, filename)
+        if page_count >= settings.PDF_PARALLEL_MIN_PAGES:
+            logger.debug(f"PDF '{filename}': {page_count} страниц, параллельное извлечение в {cpu_pool.workers()} процессах.")
+            return await _extract_parallel(file_path, filename, page_count, budget)
+    pages, page_count, engine = await cpu_pool.run(read_pdf_pages, file_path, filename, budget)
+    return PdfText(_join(pages), len(pages), page_count, engine)
+
+# --- END OF FILE services/pdf_extractor.py ---
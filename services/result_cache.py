@@ -0,0 +1,87 @@
+# --- START OF FILE services/result_cache.py ---
+
+import hashlib
+import sys
+import time
+from loguru import logger
+from typing import Any, Dict, Optional
+
+from config import settings
+from services import database
+from utils.cache import LRUCache
+
+# Двухуровневый кэш результатов "чистых" вызовов Gemini (анализ файлов и изображений,
+# перевод): LRU в памяти процесса поверх таблицы ai_cache в SQLite. Кэшируются только
+# успешные ответы; ошибки и заблокированные ответы всегда запрашиваются заново.
+
+_memory = LRUCache(100000, max_weight=settings.AI_CACHE_MEMORY_MB * 1024 * 1024)  # key -> (expires_at, value)
+
+_stats: Dict[str, int] = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+
+
+def enabled() -> bool:
+    return settings.AI_CACHE_TTL_HOURS > 0
+
+
+def make_key(call_type: str, model_name: str, prompt: str, content_hash: str = "") -> str:
+    """Cache key: sha256 over call type, model, prompt and a content hash (or Telegram file_unique_id)."""
+    digest = hashlib.sha256()
+    for part in (call_type, model_name, prompt, content_hash):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+async def get(cache_key: str) -> Optional[str]:
+    """Returns a cached result from memory, then SQLite (promoting it to memory), or None."""
+    if not enabled():
+        return None
+    now = time.time()
+    entry = _memory.get(cache_key)
+    if entry is not None:
+        expires_at, value = entry
+        if expires_at > now:
+            _stats["memory_hits"] += 1
+            return value
+        _memory.pop(cache_key)
+    try:
+        stored = await database.get_ai_cache(cache_key)
+    except Exception as e:
+        logger.error(f"AI cache lookup failed for {cache_key[:12]}...: {e}")
+        stored = None
+    if stored is None:
+        _stats["misses"] += 1
+        return None
+    value, expires_at = stored
+    _memory.put(cache_key, (expires_at, value), weight=sys.getsizeof(value))
+    _stats["disk_hits"] += 1
+    return value
+
+
+async def put(cache_key: str, call_type: str, value: str):
+    """Stores a successful result in both tiers. Errors are logged, never raised."""
+    if not enabled() or not value:
+        return
+    expires_at = time.time() + settings.AI_CACHE_TTL_HOURS * 3600
+    _memory.put(cache_key, (expires_at, value), weight=sys.getsizeof(value))
+    try:
+        await database.put_ai_cache(cache_key, call_type, value, expires_at)
+        _stats["stores"] += 1
+    except Exception as e:
+        logger.error(f"AI cache store failed for {cache_key[:12]}...: {e}")
+
+
+def get_stats() -> Dict[str, Any]:
+    """Returns per-tier hit counters, overall hit rate and memory usage."""
+    lookups = _stats["memory_hits"] + _stats["disk_hits"] + _stats["misses"]
+    hits = _stats["memory_hits"] + _stats["disk_hits"]
+    memory = _memory.stats()
+    return dict(
+        _stats,
+        hit_rate=(hits / lookups) if lookups else None,
+        memory_entries=memory["size"],
+        memory_weight=memory["weight"],
+        memory_max_weight=memory["max_weight"],
+    )
+
+# --- END OF FILE services/result_cache.py ---
@@ -0,0 +1,365 @@
+# --- START OF FILE services/table_cache.py ---
+
+import asyncio
+import json
+import os
+import re
+import shutil
+import time
+from pathlib import Path
+from loguru import logger
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import settings
+from services import cpu_pool, extractors, table_store
+
+# Кэш разобранных таблиц по пользователям: TABLE_CACHE_DIR/<user_id>/<sha256>.arrow и
+# описание <sha256>.json. Файл пишется при разборе таблицы (extractors.read_table в пуле
+# процессов); время изменения файла - время последнего использования, по нему давно не
+# нужные таблицы удаляются при превышении квот. Модели в запросе перечисляются недавние
+# таблицы, и для точного расчета она отвечает маркером [QUERY:{...}] (как [TTS:...]);
+# запрос выполняется локально (table_store.run_query), в модель уходит только результат.
+# Список таблиц пользователя держится в памяти (читается с диска один раз), а описание
+# таблиц с правилами запроса добавляется только к вопросам, похожим на расчет по таблице,
+# и к первому сообщению после загрузки таблицы.
+
+QUERY_MARKER = "[QUERY:"
+_QUERY_RE = re.compile(r"^\s*(?:```\w*\s*)?\[QUERY:\s*(\{.*\})\s*\]\s*(?:```)?\s*$", re.DOTALL)
+_TABLE_ID_RE = re.compile(r"[0-9a-f]{4,64}")
+_TABLE_ID_LENGTH = 8 # в запросах таблица называется началом sha256 файла
+_CONTEXT_MAX_TABLES = 3
+_CONTEXT_MAX_COLUMNS = 40
+_RESULT_MAX_ROWS = 50
+_RESULT_MAX_CHARS = 4000
+_STALE_TMP_SEC = 3600 # недописанные файлы процессов, убитых по таймауту
+_MIN_NAME_LENGTH = 3 # короче - имя колонки не считается упоминанием таблицы в вопросе
+_CALCULATION_RE = re.compile(
+    r"сколько|посчита|подсчита|вычисл|рассчита|сумм|средн|медиан|итог|максим|миним|наибол|наимен|"
+    r"количеств|процент|дол[яюи]\b|сгруппир|по месяц|по год|по дн|топ|табл|файл|строк|колонк|столб|"
+    r"\b(?:how many|count|sum|total|average|mean|median|max|min|top|group|table|rows?|columns?)\b",
+    re.IGNORECASE)
+
+_QUERY_HELP = (
+    "Если для ответа нужны точные числа по этим таблицам (суммы, средние, количества, группировки, "
+    "отбор строк), ответь ТОЛЬКО маркером `[QUERY:{...}]` с JSON-запросом, без других слов; "
+    "результат придет следующим сообщением. Поля запроса (все, кроме table, необязательны): "
+    '"table": "id", "filter": [["колонка", "оператор", значение], ...], "group_by": ["колонка", ...], '
+    '"aggregate": [["колонка", "функция"], ...], "columns": ["колонка", ...], '
+    '"order_by": [["колонка", "desc"], ...], "limit": 20. '
+    "Операторы: ==, !=, >, >=, <, <=, in, not_in, contains, is_null, not_null. "
+    'Функции: count, count_distinct, sum, mean, median, min, max; ["*", "count"] - число строк. '
+    'Колонки результата агрегатов называются "функция(колонка)", например "sum(Сумма)" - по ним можно сортировать. '
+    "Без aggregate и group_by возвращаются сами строки. Даты - в формате ГГГГ-ММ-ДД. "
+    "Не делай запрос, если ответ уже есть в описании таблицы или в разговоре."
+)
+
+_stats = {"stored": 0, "evicted": 0, "queries": 0, "query_errors": 0}
+# Таблицы пользователей в памяти: имя каталога пользователя -> {sha256: (последнее использование, описание)}
+_user_tables: Dict[str, Dict[str, Tuple[float, Dict[str, Any]]]] = {}
+_fresh_uploads: set = set() # пользователи, к следующему сообщению которых добавляется описание таблиц
+
+
+def enabled() -> bool:
+    """Whether parsed tables are cached (pyarrow is installed and the quotas are non-zero)."""
+    return table_store.available() and settings.TABLE_CACHE_USER_MB > 0 and settings.TABLE_CACHE_MAX_MB > 0
+
+
+def _user_dir(user_id: int) -> Path:
+    return settings.TABLE_CACHE_DIR / str(user_id)
+
+
+def cache_target(user_id: Optional[int], content_hash: str) -> Tuple[Optional[Path], int]:
+    """Path and size limit for extractors.read_table to store a parsed table; (None, 0) if the cache is off."""
+    if user_id is None or not enabled():
+        return None, 0
+    max_bytes = min(settings.TABLE_CACHE_USER_MB, settings.TABLE_CACHE_MAX_MB) * 1024 * 1024
+    return _user_dir(user_id) / f"{content_hash}.arrow", max_bytes
+
+
+# --- Квоты и LRU ---
+
+def _entries(directory: Path) -> List[Tuple[float, int, Path]]:
+    """(last use, size with description, path) of the tables in a user directory."""
+    entries = []
+    try:
+        files = list(os.scandir(directory))
+    except FileNotFoundError:
+        return entries
+    now = time.time()
+    for entry in files:
+        try:
+            if entry.name.endswith(".arrow"):
+                stat = entry.stat()
+                meta = table_store.meta_path(Path(entry.path))
+                meta_size = meta.stat().st_size if meta.exists() else 0
+                entries.append((stat.st_mtime, stat.st_size + meta_size, Path(entry.path)))
+            elif entry.name.endswith(".tmp") and now - entry.stat().st_mtime > _STALE_TMP_SEC:
+                os.unlink(entry.path)
+        except FileNotFoundError:
+            pass # удален параллельно
+    return entries
+
+
+def _evict(path: Path, reason: str):
+    table_store.remove_table(path)
+    _user_tables.get(path.parent.name, {}).pop(path.stem, None)
+    _stats["evicted"] += 1
+    logger.info(f"Table cache: removed {path.parent.name}/{path.name} ({reason}).")
+
+
+def _enforce_quotas(user_id: int):
+    # Квота пользователя: от недавно использованных к давним, не поместившиеся удаляются
+    user_limit = settings.TABLE_CACHE_USER_MB * 1024 * 1024
+    total = 0
+    for _, size, path in sorted(_entries(_user_dir(user_id)), reverse=True):
+        if total + size > user_limit:
+            _evict(path, f"user quota {settings.TABLE_CACHE_USER_MB} MB")
+        else:
+            total += size
+    # Общая квота: удаляются самые давние таблицы всех пользователей
+    entries = _all_entries()
+    total = sum(size for _, size, _ in entries)
+    global_limit = settings.TABLE_CACHE_MAX_MB * 1024 * 1024
+    for _, size, path in sorted(entries):
+        if total <= global_limit:
+            break
+        _evict(path, f"total quota {settings.TABLE_CACHE_MAX_MB} MB")
+        total -= size
+
+
+def _all_entries() -> List[Tuple[float, int, Path]]:
+    try:
+        directories = [entry.path for entry in os.scandir(settings.TABLE_CACHE_DIR) if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+    return [entry for directory in directories for entry in _entries(Path(directory))]
+
+
+def _touch(path: Path):
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return
+    tables = _user_tables.get(path.parent.name)
+    if tables is not None and path.stem in tables:
+        tables[path.stem] = (time.time(), tables[path.stem][1])
+
+
+def _load_tables(user_id: int) -> Dict[str, Tuple[float, Dict[str, Any]]]:
+    """The user's tables from memory; read from the user directory on first use."""
+    key = str(user_id)
+    tables = _user_tables.get(key)
+    if tables is None:
+        tables = {}
+        for mtime, _, path in _entries(_user_dir(user_id)):
+            meta = table_store.read_meta(path)
+            if meta:
+                tables[path.stem] = (mtime, meta)
+        tables = _user_tables.setdefault(key, tables)
+    return tables
+
+
+def _remember(user_id: int, path: Path) -> bool:
+    """Adds a just written or adopted table to the in-memory list; False if it is not on disk."""
+    meta = table_store.read_meta(path) if path.exists() else None
+    tables = _load_tables(user_id)
+    if not meta:
+        tables.pop(path.stem, None)
+        return False
+    tables[path.stem] = (time.time(), meta)
+    return True
+
+
+async def stored(user_id: int, path: Path):
+    """Called after read_table was given cache_target(): applies the quotas if the table was written."""
+    if await asyncio.to_thread(_remember, user_id, path):
+        _stats["stored"] += 1
+        _fresh_uploads.add(user_id)
+        await asyncio.to_thread(_enforce_quotas, user_id)
+
+
+def _adopt(path: Path) -> bool:
+    """Uses the user's existing copy or links another user's copy of the same file."""
+    if path.exists():
+        _touch(path)
+        return True
+    for other in settings.TABLE_CACHE_DIR.glob(f"*/{path.name}"):
+        if not table_store.meta_path(other).exists():
+            continue
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            for source, target in ((table_store.meta_path(other), table_store.meta_path(path)), (other, path)):
+                try:
+                    os.link(source, target) # файлы не меняются - жесткая ссылка вместо копии
+                except OSError:
+                    shutil.copyfile(source, target)
+        except FileNotFoundError:
+            table_store.remove_table(path) # копию удалили по квоте, пока мы ее брали
+            continue
+        _touch(path)
+        return True
+    return False
+
+
+async def ensure_cached(user_id: Optional[int], content_hash: str, file_path: Path, filename: str,
+                        file_ext: Optional[str], mime_type: Optional[str]):
+    """
+    Makes a table that was analyzed before (by this or another user) available for queries:
+    reuses a cached copy or parses file_path again. Errors are only logged.
+    """
+    path, max_bytes = cache_target(user_id, content_hash)
+    if path is None:
+        return
+    try:
+        if not await asyncio.to_thread(_adopt, path):
+            if not await asyncio.to_thread(file_path.exists):
+                return # файл уже удален общей задачей, а ее копии нет (таблица не записалась)
+            logger.debug(f"Table cache: parsing '{filename}' again for user {user_id}.")
+            await cpu_pool.run(extractors.read_table, file_path, filename, file_ext, mime_type, path, max_bytes)
+        await stored(user_id, path)
+    except Exception as e:
+        logger.warning(f"Table cache: could not cache '{filename}' for user {user_id}: {e}")
+
+
+# --- Контекст запроса и маркер [QUERY:...] ---
+
+def _recent_tables(user_id: int) -> List[Tuple[str, Dict[str, Any]]]:
+    since = time.time() - settings.TABLE_QUERY_CONTEXT_HOURS * 3600
+    recent = sorted(((used, stem, meta) for stem, (used, meta) in list(_load_tables(user_id).items()) if used >= since),
+                    key=lambda table: table[0], reverse=True)
+    return [(stem[:_TABLE_ID_LENGTH], meta) for _, stem, meta in recent[:_CONTEXT_MAX_TABLES]]
+
+
+def _mentions_tables(user_prompt: str, tables: List[Tuple[str, Dict[str, Any]]]) -> bool:
+    """Whether the message looks like a question about the tables: a calculation word, a column or file name."""
+    if _CALCULATION_RE.search(user_prompt):
+        return True
+    lowered = user_prompt.lower()
+    for _, meta in tables:
+        names = [Path(str(meta.get("filename", ""))).stem] + [str(name) for name, _ in meta.get("columns", [])]
+        if any(len(name) >= _MIN_NAME_LENGTH and name.lower() in lowered for name in names):
+            return True
+    return False
+
+
+async def prompt_context(user_id: int, user_prompt: str) -> Optional[str]:
+    """
+    Description of the user's recently used tables and of the query marker, or None if there are
+    none or the message is not about them (only the first message after an upload always gets it).
+    """
+    if not enabled() or settings.TABLE_QUERY_MAX_ROUNDS <= 0:
+        return None
+    try:
+        if str(user_id) in _user_tables:
+            tables = _recent_tables(user_id)
+        else:
+            tables = await asyncio.to_thread(_recent_tables, user_id)
+    except Exception as e:
+        logger.warning(f"Table cache: could not list tables of user {user_id}: {e}")
+        return None
+    fresh = user_id in _fresh_uploads
+    _fresh_uploads.discard(user_id)
+    if not tables or not (fresh or _mentions_tables(user_prompt, tables)):
+        return None
+    lines = ["[Таблицы пользователя, доступные для точных расчетов:"]
+    for table_id, meta in tables:
+        columns = meta.get("columns", [])
+        described = ", ".join(f"{name} ({table_store.kind_name(kind)})" for name, kind in columns[:_CONTEXT_MAX_COLUMNS])
+        if len(columns) > _CONTEXT_MAX_COLUMNS:
+            described += f" и еще {len(columns) - _CONTEXT_MAX_COLUMNS}"
+        line = f'- {table_id}: "{meta.get("filename")}", {meta.get("rows")} строк; колонки: {described}'
+        if meta.get("note"):
+            line += f" ({meta['note']})"
+        lines.append(line)
+    lines.append(_QUERY_HELP + "]")
+    return "\n".join(lines)
+
+
+def may_be_query(text: str) -> bool:
+    """Whether a streamed response so far may still turn out to be a [QUERY:...] marker."""
+    text = text.lstrip()
+    if text.startswith("```"):
+        text = text[3:].lstrip("abcdefghijklmnopqrstuvwxyz").lstrip()
+    elif "```".startswith(text):
+        return True
+    return text.startswith(QUERY_MARKER) or QUERY_MARKER.startswith(text)
+
+
+def find_query(text: str) -> Optional[str]:
+    """JSON of the query if the whole response is a [QUERY:{...}] marker, else None."""
+    match = _QUERY_RE.match(text)
+    return match.group(1) if match else None
+
+
+def _find_table(user_id: int, table_id: Any) -> Optional[Path]:
+    if table_id is None:
+        # Без id - единственная недавняя таблица
+        recent = _recent_tables(user_id)
+        table_id = recent[0][0] if len(recent) == 1 else None
+    if not isinstance(table_id, str) or not _TABLE_ID_RE.fullmatch(table_id.lower()):
+        return None
+    matches = sorted(_user_dir(user_id).glob(f"{table_id.lower()}*.arrow"))
+    return matches[0] if len(matches) == 1 else None
+
+
+def _query_failed(reason: str) -> str:
+    _stats["query_errors"] += 1
+    return f"Ошибка запроса: {reason}"
+
+
+async def run_query(user_id: int, query_text: str) -> str:
+    """
+    Runs the JSON of a [QUERY:...] marker against the user's cached table in the process pool.
+    Returns the small result table or an error description for the model; never raises.
+    """
+    _stats["queries"] += 1
+    try:
+        query = json.loads(query_text)
+    except ValueError as e:
+        return _query_failed(f"это не корректный JSON ({e}).")
+    if not isinstance(query, dict):
+        return _query_failed("запрос должен быть JSON-объектом.")
+    path = await asyncio.to_thread(_find_table, user_id, query.get("table"))
+    if path is None:
+        return _query_failed(f"таблица {query.get('table')!r} не найдена. Если ее нет в списке таблиц, "
+                             f"попроси пользователя прислать файл заново.")
+    await asyncio.to_thread(_touch, path)
+    try:
+        result = await cpu_pool.run(table_store.run_query, path, query, _RESULT_MAX_ROWS, _RESULT_MAX_CHARS,
+                                    timeout=settings.TABLE_QUERY_TIMEOUT_SEC)
+    except table_store.QueryError as e:
+        return _query_failed(str(e))
+    except cpu_pool.JobTimeoutError:
+        return _query_failed(f"не выполнен за {settings.TABLE_QUERY_TIMEOUT_SEC:.0f} с, упрости его.")
+    except cpu_pool.PoolOverloadedError:
+        return _query_failed("сервер сейчас перегружен, ответь без точного расчета.")
+    except FileNotFoundError:
+        return _query_failed("таблица только что удалена из кэша, попроси пользователя прислать файл заново.")
+    except Exception as e:
+        logger.error(f"Table query failed for user {user_id}: {e}")
+        return _query_failed("внутренняя ошибка при выполнении, ответь без точного расчета.")
+    logger.info(f"Table query for user {user_id} on {path.name}: {len(result)} chars of result.")
+    return result
+
+
+def query_result_message(result: str, last: bool) -> str:
+    """User-turn text that returns a query result to the model."""
+    instruction = ("Больше запросов не делай: ответь пользователю по этим данным." if last else
+                   "Ответь на исходный вопрос пользователя по этому результату (при необходимости сделай еще один запрос).")
+    return f"[Результат запроса к таблице]\n{result}\n\n{instruction}"
+
+
+async def get_stats() -> Optional[Dict[str, Any]]:
+    """Cached tables and query counters, or None when the cache is off."""
+    if not enabled():
+        return None
+    entries = await asyncio.to_thread(_all_entries)
+    return {
+        "tables": len(entries),
+        "users": len({path.parent.name for _, _, path in entries}),
+        "bytes": sum(size for _, size, _ in entries),
+        "max_bytes": settings.TABLE_CACHE_MAX_MB * 1024 * 1024,
+        **_stats,
+    }
+
+# --- END OF FILE services/table_cache.py ---
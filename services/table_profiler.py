@@ -0,0 +1,284 @@
+# --- START OF FILE services/table_profiler.py ---
+
+import math
+import warnings
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# Профиль таблицы по кускам: статистика каждой колонки накапливается по мере чтения,
+# поэтому память не зависит от размера файла - в ней только текущий кусок, счетчики
+# и несколько строк для примера. Выполняется в процессах пула (вызывается из
+# services/extractors.py), поэтому не импортирует config.
+
+_KIND_NAMES = {"number": "число", "date": "дата", "bool": "логическое", "text": "текст"}
+# Логические значения в текстовых выгрузках (сравниваются без учета регистра)
+_BOOL_TOKENS = {"true": True, "false": False, "да": True, "нет": False, "yes": True, "no": False}
+
+
+def _bit_length32(values: np.ndarray) -> np.ndarray:
+    # Для чисел < 2^32 log2 в float64 точен достаточно, чтобы floor дал верный номер бита
+    return np.where(values > 0, np.floor(np.log2(np.maximum(values, 1).astype(np.float64))) + 1, 0)
+
+
+class HyperLogLog:
+    """
+    Приблизительное число различных значений (HyperLogLog, 2^precision регистров,
+    ошибка около 1.04 / sqrt(2^precision)). Значения добавляются массивами 64-битных хэшей.
+    """
+
+    def __init__(self, precision: int = 12):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = np.zeros(self.size, dtype=np.uint8)
+
+    def add_hashes(self, hashes: np.ndarray):
+        if not len(hashes):
+            return
+        hashes = hashes.astype(np.uint64, copy=False)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.intp)
+        rest = hashes << np.uint64(self.precision)
+        high = (rest >> np.uint64(32)).astype(np.uint32)
+        low = (rest & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+        bit_length = np.where(high > 0, 32 + _bit_length32(high), _bit_length32(low))
+        # Позиция первой единицы в оставшихся битах (для нулевых - максимум)
+        rank = np.minimum(64 - bit_length + 1, 64 - self.precision + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def estimate(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        raw = alpha * self.size * self.size / float(np.sum(np.exp2(-self.registers.astype(np.float64))))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * self.size and zeros:
+            return int(round(self.size * math.log(self.size / zeros)))  # малые количества - linear counting
+        return int(round(raw))
+
+
+class ColumnProfile:
+    """
+    Статистика одной колонки. Тип определяется по первому куску (число, дата,
+    логическое, текст); дальше значения приводятся к нему, не подошедшие считаются
+    отдельно. Для чисел - min/max/среднее/стандартное отклонение (слияние по Уэлфорду),
+    для дат - min/max, для текста - приблизительный top-k (счетчик ограниченного размера).
+    """
+
+    def __init__(self, name: str, top_k: int = 5, max_tracked: int = 1000, hll_precision: int = 12):
+        self.name = name
+        self.kind: Optional[str] = None
+        self.decimal_comma = False
+        self.rows = 0
+        self.nulls = 0
+        self.mismatched = 0  # непустые значения, не приводимые к типу колонки
+        self.top_k = top_k
+        self.max_tracked = max_tracked
+        self.counts: Dict[Any, int] = {}
+        self.distinct = HyperLogLog(hll_precision)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min: Any = None
+        self.max: Any = None
+
+    def add(self, column: pd.Series):
+        self.rows += len(column)
+        values = column.dropna()
+        self.nulls += len(column) - len(values)
+        if values.empty:
+            return
+        if self.kind is None:
+            self.kind = self._detect_kind(values)
+        self.distinct.add_hashes(pd.util.hash_pandas_object(values, index=False).to_numpy())
+
+        if self.kind == "number":
+            numbers = self.to_numbers(values)
+            self.mismatched += int(numbers.isna().sum())
+            self._add_numbers(numbers.dropna().to_numpy(dtype=np.float64))
+        elif self.kind == "date":
+            dates = self.to_dates(values)
+            self.mismatched += int(dates.isna().sum())
+            dates = dates.dropna()
+            if not dates.empty:
+                self.count += len(dates)
+                self.min = dates.min() if self.min is None else min(self.min, dates.min())
+                self.max = dates.max() if self.max is None else max(self.max, dates.max())
+        elif self.kind == "bool":
+            bools = self.to_bools(values)
+            self.mismatched += int(bools.isna().sum())
+            self._add_counts(bools.dropna())
+        else:
+            self._add_counts(values)
+
+    def _detect_kind(self, values: pd.Series) -> str:
+        if pd.api.types.is_bool_dtype(values):
+            return "bool"
+        if pd.api.types.is_numeric_dtype(values):
+            return "number"
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return "date"
+        sample = values.head(1000)
+        # С пустыми ячейками True/False приходят как object, а "да"/"нет" - строками;
+        # до проверки на число, иначе to_numeric примет True/False за 1/0
+        if self.to_bools(sample).notna().all():
+            return "bool"
+        if pd.to_numeric(sample, errors="coerce").notna().mean() >= 0.9:
+            return "number"
+        if sample.dtype != object or sample.map(type).eq(str).all():
+            # "1,5" - дробные числа из русских выгрузок
+            comma_numbers = pd.to_numeric(sample.astype(str).str.replace(",", ".", regex=False), errors="coerce")
+            if comma_numbers.notna().mean() >= 0.9:
+                self.decimal_comma = True
+                return "number"
+        if self.to_dates(sample).notna().mean() >= 0.9:
+            return "date"
+        return "text"
+
+    @staticmethod
+    def to_bools(values: pd.Series) -> pd.Series:
+        """Values as True/False (None where not a bool or a bool-like word such as "да"/"false")."""
+        if pd.api.types.is_bool_dtype(values):
+            return values.astype(object)
+
+        def to_bool(value):
+            if isinstance(value, (bool, np.bool_)):
+                return bool(value)
+            if isinstance(value, str):
+                return _BOOL_TOKENS.get(value.strip().lower())
+            return None
+
+        return values.map(to_bool)
+
+    def to_numbers(self, values: pd.Series) -> pd.Series:
+        """Values as float64 (NaN where not a number)."""
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            return values.astype(np.float64)
+        if self.decimal_comma:
+            values = values.astype(str).str.replace(",", ".", regex=False)
+        return pd.to_numeric(values, errors="coerce")
+
+    @staticmethod
+    def to_dates(values: pd.Series) -> pd.Series:
+        """Values as datetimes (NaT where not a date)."""
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return values
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            return pd.Series(pd.NaT, index=values.index)
+        with warnings.catch_warnings():
+            # Формат угадывается по первому значению; предупреждение об этом не нужно
+            warnings.simplefilter("ignore")
+            return pd.to_datetime(values, errors="coerce")
+
+    def _add_numbers(self, numbers: np.ndarray):
+        if not len(numbers):
+            return
+        chunk_count = len(numbers)
+        chunk_mean = float(numbers.mean())
+        chunk_m2 = float(((numbers - chunk_mean) ** 2).sum())
+        total = self.count + chunk_count
+        delta = chunk_mean - self.mean
+        self.mean += delta * chunk_count / total
+        self.m2 += chunk_m2 + delta * delta * self.count * chunk_count / total
+        self.count = total
+        chunk_min, chunk_max = float(numbers.min()), float(numbers.max())
+        self.min = chunk_min if self.min is None else min(self.min, chunk_min)
+        self.max = chunk_max if self.max is None else max(self.max, chunk_max)
+
+    def _add_counts(self, values: pd.Series):
+        self.count += len(values)
+        counts = self.counts
+        for value, count in values.value_counts().head(self.max_tracked).items():
+            counts[value] = counts.get(value, 0) + int(count)
+        if len(counts) > 2 * self.max_tracked:
+            # Редкие значения забываются: top-k приблизительный, но память ограничена
+            kept = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:self.max_tracked]
+            self.counts = dict(kept)
+
+    @property
+    def std(self) -> Optional[float]:
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else None
+
+    def describe(self) -> str:
+        parts = [f"{self.name}: {_KIND_NAMES.get(self.kind, 'пусто')}"]
+        if self.nulls:
+            parts.append(f"пустых {self.nulls} ({self.nulls / max(self.rows, 1):.0%})")
+        if self.kind == "number" and self.count:
+            stats = f"мин {_format_number(self.min)}, макс {_format_number(self.max)}, среднее {_format_number(self.mean)}"
+            if self.std is not None:
+                stats += f", ст. откл. {_format_number(self.std)}"
+            parts.append(stats)
+        elif self.kind == "date" and self.count:
+            parts.append(f"с {_format_date(self.min)} по {_format_date(self.max)}")
+        if self.mismatched:
+            parts.append(f"не по типу {self.mismatched}")
+        if self.kind is not None:
+            parts.append(f"различных ≈{min(self.distinct.estimate(), self.rows - self.nulls)}")
+        if self.counts:
+            top = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:self.top_k]
+            parts.append("частые: " + ", ".join(f"{_shorten(value)} ({count / max(self.count, 1):.0%})" for value, count in top))
+        return "; ".join(parts)
+
+
+def _format_number(value: float) -> str:
+    if value is None:
+        return "—"
+    if float(value).is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return f"{value:.6g}"
+
+
+def _format_date(value) -> str:
+    value = pd.Timestamp(value)
+    return value.strftime("%Y-%m-%d") if value == value.normalize() else value.strftime("%Y-%m-%d %H:%M")
+
+
+def _shorten(value: Any, limit: int = 40) -> str:
+    text = str(value).replace("\n", " ")
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+class TableProfiler:
+    """
+    Накопитель профиля таблицы: add() для каждого куска DataFrame, затем summary().
+    Хранит только статистику колонок и первые head_rows строк. Если задан sink
+    (например, services/table_store.TableWriter), каждый кусок после учета
+    передается в sink.write(chunk, columns) - уже с определенными типами колонок.
+    """
+
+    def __init__(self, head_rows: int = 5, top_k: int = 5, sink: Any = None):
+        self.head_rows = head_rows
+        self.top_k = top_k
+        self.rows = 0
+        self.columns: List[ColumnProfile] = []
+        self.head: Optional[pd.DataFrame] = None
+        self.note: Optional[str] = None  # например, что файл прочитан не до конца
+        self.sink = sink
+
+    def add(self, chunk: pd.DataFrame):
+        if self.head is None:
+            self.head = chunk.head(self.head_rows)
+            self.columns = [ColumnProfile(str(name), top_k=self.top_k) for name in chunk.columns]
+        self.rows += len(chunk)
+        for profile, (_, column) in zip(self.columns, chunk.items()):
+            profile.add(column)
+        if self.sink is not None:
+            self.sink.write(chunk, self.columns)
+
+    def summary(self, max_chars: int = 5000, max_columns: int = 40, preview_columns: int = 10) -> str:
+        """Compact schema + statistics + sample rows for the analysis prompt."""
+        num_cols = len(self.columns)
+        lines = [f"Таблица содержит {self.rows} строк и {num_cols} колонок."]
+        if self.note:
+            lines.append(self.note)
+        lines.append("Колонки (тип; пустые; статистика; приблизительное число различных значений; частые значения):")
+        for profile in self.columns[:max_columns]:
+            lines.append(f"- {profile.describe()}")
+        if num_cols > max_columns:
+            lines.append(f"... и еще {num_cols - max_columns} колонок: " + ", ".join(p.name for p in self.columns[max_columns:]))
+        if self.head is not None and not self.head.empty:
+            preview = self.head.iloc[:, :preview_columns].to_string(index=False, max_colwidth=40)
+            cols_truncated = " (...колонки урезаны)" if num_cols > preview_columns else ""
+            lines.append(f"\nПример данных (до {self.head_rows} строк, до {preview_columns} колонок{cols_truncated}):\n{preview}")
+        return "\n".join(lines)[:max_chars]
+
+
+# --- END OF FILE services/table_profiler.py ---
@@ -0,0 +1,406 @@
+# --- START OF FILE services/table_store.py ---
+
+import json
+import os
+from pathlib import Path
+from loguru import logger
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow as pa  # Колоночный кэш таблиц (Arrow IPC / Feather v2)
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+    pc = None
+
+from services.table_profiler import ColumnProfile
+
+# Разобранные таблицы на диске и запросы к ним. Файл - Arrow IPC (Feather v2) без
+# сжатия: открывается через memory map без копирования и без разбора, поэтому даже
+# большая таблица "загружается" мгновенно, а в память попадают только страницы
+# нужных колонок. Рядом - <имя>.json с описанием (имя файла, строки, колонки).
+# Выполняется в процессах пула (services/cpu_pool.py), поэтому не импортирует config.
+
+_ARROW_TYPES = {"number": "float64", "date": "timestamp[ns]", "bool": "bool", "text": "string"}
+_KIND_NAMES = {"number": "число", "date": "дата", "bool": "логическое", "text": "текст"}
+
+# Запросы - JSON с фиксированным набором полей, операторов и функций (без выражений и eval)
+_QUERY_KEYS = {"table", "filter", "group_by", "aggregate", "columns", "order_by", "limit"}
+_OPERATORS = {"==", "!=", ">", ">=", "<", "<=", "in", "not_in", "contains", "is_null", "not_null"}
+_AGGREGATES = {"count", "count_distinct", "sum", "mean", "median", "min", "max"}
+_NUMERIC_AGGREGATES = {"sum", "mean", "median"}
+# Медиана в группах считается точно по спискам значений (у Arrow только приближенная)
+_ARROW_AGGREGATES = {"median": "list"}
+_MAX_RESULT_COLUMNS = 20
+
+
+class QueryError(ValueError):
+    """The query is malformed or refers to unknown columns; the message is returned to the model."""
+
+
+def available() -> bool:
+    """Whether pyarrow is installed."""
+    return pa is not None
+
+
+def kind_name(kind: str) -> str:
+    """Russian name of a column kind stored in the table description."""
+    return _KIND_NAMES.get(kind, kind)
+
+
+def meta_path(path: Path) -> Path:
+    return Path(path).with_suffix(".json")
+
+
+def read_meta(path: Path) -> Optional[Dict[str, Any]]:
+    """Description written next to a cached table, or None if missing/corrupted."""
+    try:
+        with open(meta_path(path), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class TableWriter:
+    """
+    Пишет куски таблицы в файл Arrow IPC по мере чтения (sink для TableProfiler).
+    Схема фиксируется по первому куску из типов, определенных профилем: число - float64,
+    дата - timestamp, логическое - bool, остальное - строка; значения, не подошедшие
+    к типу, становятся пустыми. Файл пишется во временный и появляется под своим
+    именем только после close(); при превышении max_bytes или ошибке запись
+    прекращается, а чтение таблицы продолжается как обычно.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = 0):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.rows = 0
+        self.failed: Optional[str] = None
+        self._tmp_path = self.path.with_suffix(".tmp")
+        self._kinds: List[str] = []
+        self._schema = None
+        self._sink = None
+        self._writer = None
+
+    def write(self, chunk: pd.DataFrame, columns: List[ColumnProfile]):
+        if self.failed:
+            return
+        try:
+            if self._writer is None:
+                self._open(columns)
+            arrays = [_to_arrow(profile, column, kind)
+                      for profile, (_, column), kind in zip(columns, chunk.items(), self._kinds)]
+            self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self._schema))
+            self.rows += len(chunk)
+            if self.max_bytes and self._sink.tell() > self.max_bytes:
+                self.abort(f"больше {self.max_bytes // (1024 * 1024)} МБ")
+        except Exception as write_err:
+            self.abort(f"ошибка записи: {write_err}")
+
+    def _open(self, columns: List[ColumnProfile]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._kinds = [profile.kind if profile.kind in _ARROW_TYPES else "text" for profile in columns]
+        self._schema = pa.schema([pa.field(profile.name, pa.type_for_alias(_ARROW_TYPES[kind]))
+                                  for profile, kind in zip(columns, self._kinds)])
+        self._sink = pa.OSFile(str(self._tmp_path), "wb")
+        self._writer = pa.ipc.new_file(self._sink, self._schema)
+
+    def close(self, filename: str, note: Optional[str] = None) -> bool:
+        """Finishes the file and writes its description; returns False if nothing was stored."""
+        if self.failed or self._writer is None:
+            self.abort(self.failed or "нет данных")
+            return False
+        try:
+            self._writer.close()
+            self._sink.close()
+            self._writer = self._sink = None
+            os.replace(self._tmp_path, self.path)
+            meta = {"filename": filename, "rows": self.rows, "note": note,
+                    "columns": [[field.name, kind] for field, kind in zip(self._schema, self._kinds)]}
+            with open(meta_path(self.path), "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+        except Exception as close_err:
+            self.abort(f"ошибка записи: {close_err}")
+            remove_table(self.path)
+            return False
+        logger.debug(f"Таблица '{filename}' сохранена в кэш: {self.rows} строк, {self.path.stat().st_size} байт.")
+        return True
+
+    def abort(self, reason: Optional[str] = None):
+        """Drops the partially written file (no-op after close())."""
+        if reason and not self.failed:
+            self.failed = reason
+            logger.info(f"Таблица не будет сохранена в кэш ({self.path.name}): {reason}")
+        try:
+            if self._writer is not None:
+                self._writer.close()
+            if self._sink is not None:
+                self._sink.close()
+        except Exception:
+            pass
+        self._writer = self._sink = None
+        try:
+            self._tmp_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _to_arrow(profile: ColumnProfile, column: pd.Series, kind: str):
+    if kind == "number":
+        return pa.array(profile.to_numbers(column), type=pa.float64(), from_pandas=True)
+    if kind == "date":
+        dates = profile.to_dates(column)
+        if not pd.api.types.is_datetime64_any_dtype(dates):
+            dates = pd.to_datetime(dates, errors="coerce", utc=True)  # смешанные часовые пояса
+        if getattr(dates.dt, "tz", None) is not None:
+            dates = dates.dt.tz_convert(None)
+        return pa.array(dates, type=pa.timestamp("ns"), from_pandas=True)
+    if kind == "bool":
+        return pa.array(profile.to_bools(column), type=pa.bool_(), from_pandas=True)
+    return pa.array(column.astype(str).where(column.notna(), None), type=pa.string(), from_pandas=True)
+
+
+def remove_table(path: Path):
+    """Deletes a cached table and its description."""
+    for file in (Path(path), meta_path(path)):
+        try:
+            file.unlink()
+        except FileNotFoundError:
+            pass
+
+
+# --- Запросы ---
+
+def run_query(path: Path, query: Dict[str, Any], max_rows: int = 50, max_chars: int = 4000) -> str:
+    """
+    Runs an aggregate/select query (see _QUERY_KEYS) against a cached table and returns
+    the result as a short text table. Raises QueryError for invalid queries.
+    """
+    if pa is None:
+        raise QueryError("Запросы к таблицам недоступны: не установлен pyarrow.")
+    if not isinstance(query, dict):
+        raise QueryError("Запрос должен быть JSON-объектом.")
+    unknown = set(query) - _QUERY_KEYS
+    if unknown:
+        raise QueryError(f"Неизвестные поля запроса: {', '.join(sorted(unknown))}. Допустимые: {', '.join(sorted(_QUERY_KEYS))}.")
+    limit = _limit(query.get("limit"), max_rows)
+
+    with pa.memory_map(str(path)) as source:
+        table = pa.ipc.open_file(source).read_all()  # без копирования: данные остаются в mmap
+        table = table.filter(_filter_expression(table, query.get("filter"))) if query.get("filter") else table
+        group_by = _columns(table, query.get("group_by"), "group_by")
+        aggregates = _aggregates(table, query.get("aggregate"))
+        if aggregates or group_by:
+            result = _aggregate(table, group_by, aggregates or [("*", "count")])
+        else:
+            columns = _columns(table, query.get("columns"), "columns") or table.column_names[:_MAX_RESULT_COLUMNS]
+            result = table.select(columns[:_MAX_RESULT_COLUMNS])
+        total = result.num_rows
+        result = _order_and_limit(result, query.get("order_by"), limit)
+        return _format_result(result, total, max_chars)
+
+
+def _limit(value: Any, max_rows: int) -> int:
+    if value is None:
+        return max_rows
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise QueryError("limit должен быть положительным целым числом.")
+    return min(value, max_rows)
+
+
+def _check_column(table, name: Any) -> str:
+    if not isinstance(name, str) or name not in table.column_names:
+        raise QueryError(f"Нет колонки {name!r}. Колонки: {', '.join(table.column_names)}.")
+    return name
+
+
+def _columns(table, value: Any, key: str) -> List[str]:
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list):
+        raise QueryError(f"{key} должен быть списком колонок.")
+    return [_check_column(table, name) for name in value]
+
+
+def _filter_expression(table, conditions: Any):
+    if not isinstance(conditions, list):
+        raise QueryError('filter должен быть списком условий вида ["колонка", "оператор", значение].')
+    if conditions and not isinstance(conditions[0], list):
+        conditions = [conditions]  # одно условие без внешнего списка
+    expression = None
+    for condition in conditions:
+        if not isinstance(condition, list) or len(condition) not in (2, 3):
+            raise QueryError(f'Неверное условие {condition!r}: нужно ["колонка", "оператор", значение].')
+        name, operator = _check_column(table, condition[0]), condition[1]
+        if operator not in _OPERATORS:
+            raise QueryError(f"Неизвестный оператор {operator!r}. Допустимые: {', '.join(sorted(_OPERATORS))}.")
+        field_type = table.schema.field(name).type
+        field = pc.field(name)
+        if operator in ("is_null", "not_null"):
+            part = field.is_null() if operator == "is_null" else field.is_valid()
+        elif len(condition) != 3:
+            raise QueryError(f"Для оператора {operator} нужно значение: {condition!r}.")
+        elif operator in ("in", "not_in"):
+            values = condition[2] if isinstance(condition[2], list) else [condition[2]]
+            part = field.isin(pa.array([_scalar(field_type, value, name).as_py() for value in values], type=field_type))
+            part = ~part if operator == "not_in" else part
+        elif operator == "contains":
+            if not pa.types.is_string(field_type):
+                raise QueryError(f"contains применим только к текстовым колонкам, а {name!r} - не текст.")
+            part = pc.match_substring(field, str(condition[2]), ignore_case=True)
+        else:
+            value = _scalar(field_type, condition[2], name)
+            part = {"==": field == value, "!=": field != value, ">": field > value,
+                    ">=": field >= value, "<": field < value, "<=": field <= value}[operator]
+        expression = part if expression is None else expression & part
+    return expression if expression is not None else pc.scalar(True)
+
+
+def _scalar(field_type, value: Any, name: str):
+    """Converts a JSON value to the column type, so that e.g. "2024-01-31" compares with dates."""
+    try:
+        if pa.types.is_floating(field_type):
+            if isinstance(value, bool):
+                raise ValueError
+            return pa.scalar(float(str(value).replace(",", ".")) if isinstance(value, str) else float(value), type=field_type)
+        if pa.types.is_timestamp(field_type):
+            timestamp = pd.Timestamp(value)
+            if timestamp.tzinfo is not None:
+                timestamp = timestamp.tz_convert(None)
+            return pa.scalar(timestamp, type=field_type)
+        if pa.types.is_boolean(field_type):
+            if isinstance(value, str):
+                lowered = value.strip().lower()
+                if lowered not in ("true", "false", "1", "0", "да", "нет", "yes", "no"):
+                    raise ValueError
+                value = lowered in ("true", "1", "да", "yes")
+            return pa.scalar(bool(value), type=field_type)
+    except (TypeError, ValueError, OverflowError):
+        raise QueryError(f"Значение {value!r} не подходит к типу колонки {name!r} ({_type_name(field_type)}).") from None
+    return pa.scalar(str(value), type=field_type)
+
+
+def _type_name(field_type) -> str:
+    for kind, alias in _ARROW_TYPES.items():
+        if field_type == pa.type_for_alias(alias):
+            return _KIND_NAMES[kind]
+    return str(field_type)
+
+
+def _aggregates(table, value: Any) -> List[Tuple[str, str]]:
+    if value is None:
+        return []
+    if not isinstance(value, list) or (value and not isinstance(value[0], list)):
+        value = [value]
+    result: List[Tuple[str, str]] = []
+    for spec in value:
+        if not isinstance(spec, list) or len(spec) != 2:
+            raise QueryError(f'Неверный агрегат {spec!r}: нужно ["колонка", "функция"].')
+        name, function = spec
+        if function not in _AGGREGATES:
+            raise QueryError(f"Неизвестная функция {function!r}. Допустимые: {', '.join(sorted(_AGGREGATES))}.")
+        if name == "*":
+            if function != "count":
+                raise QueryError('"*" допустимо только с count (число строк).')
+        else:
+            _check_column(table, name)
+            field_type = table.schema.field(name).type
+            if function in _NUMERIC_AGGREGATES and not pa.types.is_floating(field_type):
+                raise QueryError(f"{function} применима только к числовым колонкам, а {name!r} - {_type_name(field_type)}.")
+        if (name, function) not in result:
+            result.append((name, function))
+    return result
+
+
+def _label(name: str, function: str) -> str:
+    return f"{function}({name})"
+
+
+def _aggregate(table, group_by: List[str], aggregates: List[Tuple[str, str]]):
+    labels = [_label(name, function) for name, function in aggregates]
+    if not group_by:
+        values = [_aggregate_column(table, name, function) for name, function in aggregates]
+        return pa.table({label: [value] for label, value in zip(labels, values)})
+    specs = [([], "count_all") if name == "*" else (name, _ARROW_AGGREGATES.get(function, function))
+             for name, function in aggregates]
+    grouped = table.group_by(group_by).aggregate(specs)
+    # Имена колонок Arrow: "<колонка>_<функция>" и "count_all"
+    arrow_names = ["count_all" if name == "*" else f"{name}_{_ARROW_AGGREGATES.get(function, function)}"
+                   for name, function in aggregates]
+    columns = [grouped.column(name) for name in group_by]
+    for (_, function), arrow_name in zip(aggregates, arrow_names):
+        column = grouped.column(arrow_name)
+        columns.append(_group_medians(column) if function == "median" else column)
+    return pa.table(columns, names=group_by + labels)
+
+
+def _aggregate_column(table, name: str, function: str) -> Any:
+    if name == "*":
+        return table.num_rows
+    column = table.column(name)
+    if function == "median":
+        return pc.quantile(column, q=0.5).to_pylist()[0]
+    return getattr(pc, function)(column).as_py()
+
+
+def _group_medians(lists):
+    """Exact median of every list<double> value (one list per group), nulls skipped."""
+    lists = lists.combine_chunks() if isinstance(lists, pa.ChunkedArray) else lists
+    values = pc.list_flatten(lists)
+    parents = pc.list_parent_indices(lists)
+    valid = pc.is_valid(values)
+    values = values.filter(valid).to_numpy(zero_copy_only=False)
+    parents = parents.filter(valid).to_numpy(zero_copy_only=False)
+    # Сортировка по группе, внутри группы - по значению; медиана - середина каждого отрезка
+    order = np.lexsort((values, parents))
+    values = values[order]
+    counts = np.bincount(parents, minlength=len(lists))
+    starts = np.cumsum(counts) - counts
+    present = counts > 0
+    starts, counts = starts[present], counts[present]
+    medians = np.zeros(len(lists), dtype=np.float64)
+    medians[present] = (values[starts + (counts - 1) // 2] + values[starts + counts // 2]) / 2
+    return pa.array(medians, mask=~present)
+
+
+def _order_and_limit(table, order_by: Any, limit: int):
+    if not order_by:
+        return table.slice(0, limit)
+    if isinstance(order_by, str) or (isinstance(order_by, list) and order_by and isinstance(order_by[0], str)
+                                     and (len(order_by) != 2 or order_by[1] in ("asc", "desc"))):
+        order_by = [order_by]
+    if not isinstance(order_by, list):
+        raise QueryError('order_by должен быть списком вида [["колонка", "desc"], ...].')
+    sort_keys = []
+    for key in order_by:
+        if isinstance(key, str):
+            name, direction = key, "asc"
+        elif isinstance(key, list) and len(key) in (1, 2):
+            name, direction = key[0], key[1] if len(key) == 2 else "asc"
+        else:
+            raise QueryError(f'Неверный ключ сортировки {key!r}: нужно "колонка" или ["колонка", "asc" или "desc"].')
+        _check_column(table, name)
+        if direction not in ("asc", "desc"):
+            raise QueryError(f"Направление сортировки {direction!r}: нужно asc или desc.")
+        sort_keys.append((name, "ascending" if direction == "asc" else "descending"))
+    if table.num_rows > limit:
+        # Top-k без полной сортировки таблицы; выбранные строки затем упорядочиваются
+        table = table.take(pc.select_k_unstable(table, k=limit, sort_keys=sort_keys))
+    return table.sort_by(sort_keys)
+
+
+def _format_result(table, total: int, max_chars: int) -> str:
+    header = f"Строк в результате: {total}"
+    if table.num_rows < total:
+        header += f" (показаны первые {table.num_rows})"
+    if not table.num_rows:
+        return header + "."
+    frame = table.to_pandas()
+    text = f"{header}:\n{frame.to_string(index=False, max_colwidth=60, float_format=lambda value: f'{value:.10g}')}"
+    return text if len(text) <= max_chars else text[:max_chars - 1] + "…"
+
+# --- END OF FILE services/table_store.py ---
@@ -0,0 +1,29 @@
+import asyncio
+import os
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# config/settings.py читает окружение при импорте: до импорта модулей бота тестам
+# задаются свои каталоги и ненастоящие ключи (как в loadtest/run.py)
+_workdir = Path(tempfile.mkdtemp(prefix="bot-tests-"))
+os.environ.update({
+    "TELEGRAM_BOT_TOKEN": "123456:TEST",
+    "GEMINI_API_KEY": "test-key",
+    "GEMINI_API_KEYS": "",
+    "AUTHORIZED_USERS": "",
+    "DATABASE_FILE": str(_workdir / "test.db"),
+    "TEMP_DIR": str(_workdir / "temp"),
+    "TABLE_CACHE_DIR": str(_workdir / "tables"),
+    "LOG_FILE": str(_workdir / "bot.log"),
+    "GEMINI_RPM": "0",
+    "GEMINI_TPM": "0",
+})
+
+
+@pytest.fixture(scope="session")
+def run():
+    """Runs a coroutine on one event loop shared by the session: module-level locks and events bind to it."""
+    with asyncio.Runner() as runner:
+        yield runner.run
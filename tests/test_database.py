@@ -0,0 +1,153 @@
+import asyncio
+
+import pytest
+
+from config import settings
+from services import database
+
+
+async def _seqs(user_id: int):
+    async with database._read_connection() as db:
+        async with db.execute("SELECT seq FROM messages WHERE user_id = ? ORDER BY seq", (user_id,)) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+
+async def _add(user_id: int, count: int):
+    for i in range(count):
+        await database.add_message(user_id, "user" if i % 2 == 0 else "model", f"сообщение {i}")
+    await database.flush_pending_messages()
+
+
+@pytest.fixture
+def db(run):
+    run(database.init_db())
+    yield
+    run(database.close_db())
+
+
+@pytest.fixture
+def no_flusher(run, db):
+    """Stops the background flusher: the test flushes the queue itself."""
+    async def stop():
+        database._flusher_stop.set()
+        database._flush_wakeup.set()
+        await database._flusher_task
+
+    run(stop())
+
+
+@pytest.fixture
+def small_history(monkeypatch):
+    monkeypatch.setattr(database, "_HISTORY_KEEP", 4)
+    monkeypatch.setattr(database, "_HISTORY_BACKSTOP", 12)
+
+
+def test_compaction_keeps_messages_not_yet_summarized(run, db, small_history, monkeypatch):
+    monkeypatch.setattr(settings, "SUMMARY_TRIGGER_TOKENS", 3000)
+    user_id = 1001
+
+    async def scenario():
+        await _add(user_id, 10)
+        await database.compact_history(all_users=True)
+        assert await _seqs(user_id) == list(range(1, 11))  # сводки нет - ничего не удаляется
+        # Сводка покрыла только 3 сообщения (сама сводка их уже удалила бы; здесь - отставшая запись)
+        async with database._write_connection() as conn:
+            await conn.execute("INSERT INTO summaries (user_id, summary, covered_seq, tokens) VALUES (?, 's', 3, 1)", (user_id,))
+            await conn.commit()
+        await database.compact_history(all_users=True)
+        assert await _seqs(user_id) == list(range(4, 11))
+        # Сводка отстала больше чем на _HISTORY_BACKSTOP: остаются последние 12
+        await _add(user_id, 10)
+        await database.compact_history()
+        assert await _seqs(user_id) == list(range(9, 21))
+
+    run(scenario())
+
+
+def test_compaction_without_summaries_keeps_last_messages(run, db, small_history, monkeypatch):
+    monkeypatch.setattr(settings, "SUMMARY_TRIGGER_TOKENS", 0)
+    user_id = 1002
+
+    async def scenario():
+        await _add(user_id, 10)
+        await database.compact_history()
+        assert await _seqs(user_id) == [7, 8, 9, 10]
+
+    run(scenario())
+
+
+def test_flusher_writes_queued_messages_in_the_background(run, db):
+    user_id = 2001
+
+    async def scenario():
+        for i in range(3):
+            await database.add_message(user_id, "user", f"сообщение {i}")
+        # Еще не записанные сообщения уже видны в истории
+        history = await database.get_message_history(user_id)
+        assert [message["content"] for message in history][-3:] == ["сообщение 0", "сообщение 1", "сообщение 2"]
+        await asyncio.sleep(settings.DB_FLUSH_INTERVAL_MS / 1000 * 4)
+        assert await _seqs(user_id) == [1, 2, 3]
+        assert not database._pending_messages
+
+    run(scenario())
+
+
+def test_cancelled_flush_still_commits_its_batch(run, no_flusher, monkeypatch):
+    user_id = 2002
+    write_batch = database._write_batch
+
+    async def slow_write(batch):
+        await asyncio.sleep(0.05)
+        await write_batch(batch)
+
+    monkeypatch.setattr(database, "_write_batch", slow_write)
+
+    async def scenario():
+        for i in range(3):
+            database._pending_messages.append((user_id, {"role": "user", "content": f"m{i}", "tokens": 1}))
+        flush = asyncio.create_task(database.flush_pending_messages())
+        await asyncio.sleep(0.01)
+        flush.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await flush
+        # Транзакция доработала под shield: батч записан ровно один раз и не вернулся в очередь
+        assert await _seqs(user_id) == [1, 2, 3]
+        assert not database._pending_messages
+        assert database._flush_epoch % 2 == 0
+
+    run(scenario())
+
+
+def test_failed_flush_requeues_the_batch_in_order(run, no_flusher, monkeypatch):
+    user_id = 2003
+    write_batch = database._write_batch
+    failures = [RuntimeError("database is locked")]
+
+    async def flaky_write(batch):
+        if failures:
+            raise failures.pop()
+        await write_batch(batch)
+
+    monkeypatch.setattr(database, "_write_batch", flaky_write)
+
+    async def scenario():
+        database._pending_messages.extend((user_id, {"role": "user", "content": f"m{i}", "tokens": 1}) for i in range(2))
+        with pytest.raises(RuntimeError):
+            await database.flush_pending_messages()
+        database._pending_messages.append((user_id, {"role": "user", "content": "m2", "tokens": 1}))
+        assert [message["content"] for _, message in database._pending_messages] == ["m0", "m1", "m2"]
+        await database.flush_pending_messages()
+        async with database._read_connection() as conn:
+            async with conn.execute("SELECT content FROM messages WHERE user_id = ? ORDER BY seq", (user_id,)) as cursor:
+                rows = [database._decode_content(row[0]) for row in await cursor.fetchall()]
+        assert rows == ["m0", "m1", "m2"]
+
+    run(scenario())
+
+
+def test_close_db_flushes_pending_messages(run, db):
+    user_id = 2004
+    run(database.add_message(user_id, "user", "последнее"))
+    run(database.close_db())
+    run(database.init_db())
+    assert run(_seqs(user_id)) == [1]
@@ -0,0 +1,72 @@
+import asyncio
+
+from services import gemini, gemini_client
+
+
+def test_map_chunks_runs_at_most_analysis_slots_at_once(monkeypatch):
+    running = 0
+    peak = 0
+
+    async def fake_call(prompt, user_id):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return f"заметки: {prompt.split()[2]}", None
+
+    progress = []
+
+    async def report(done, total):
+        progress.append((done, total))
+
+    monkeypatch.setattr(gemini, "_cached_file_call", fake_call)
+    monkeypatch.setattr(gemini_client, "analysis_slots", lambda: 3)
+    chunks = [(index, f"текст {index}") for index in range(10)]
+    notes = asyncio.run(gemini._map_chunks(chunks, 10, "doc.txt", 1, report))
+
+    assert peak == 3
+    assert [index for index, _ in notes] == list(range(10))
+    assert progress[-1] == (10, 10)
+
+
+def test_analysis_slots_exclude_reserved_chat_slots():
+    scheduler = gemini_client._scheduler
+    assert gemini_client.analysis_slots() == scheduler.limit - scheduler.reserved >= 1
+
+
+class _Part:
+    text = "ответ"
+
+
+class _Response:
+    class _Candidate:
+        class content:
+            parts = [_Part()]
+
+    candidates = [_Candidate()]
+
+
+def test_fallback_answers_are_not_cached(run, monkeypatch):
+    stored = []
+
+    async def no_cache(key):
+        return None
+
+    async def put(key, call_type, value):
+        stored.append(value)
+
+    async def generate_with_model(model, contents, **kwargs):
+        return _Response(), served_model
+
+    monkeypatch.setattr(gemini.result_cache, "get", no_cache)
+    monkeypatch.setattr(gemini.result_cache, "put", put)
+    monkeypatch.setattr(gemini_client, "generate_with_model", generate_with_model)
+
+    served_model = "models/gemini-fallback"
+    assert run(gemini._cached_file_call("промпт", None))[0] == "ответ"
+    assert stored == []
+
+    served_model = gemini.text_model.model_name
+    run(gemini._cached_file_call("промпт", None))
+    assert stored == ["ответ"]
@@ -0,0 +1,75 @@
+import asyncio
+
+from utils.fair_scheduler import FairScheduler
+
+CLASSES = ("interactive", "analysis", "background")
+
+
+async def _job(scheduler: FairScheduler, order: list, flow: str, priority: int = 1):
+    await scheduler.acquire(flow, priority)
+    order.append(flow)
+    await asyncio.sleep(0.01)
+    scheduler.release(priority)
+
+
+def test_flows_share_slots_fairly(run):
+    async def scenario():
+        scheduler = FairScheduler(1, CLASSES)
+        order = []
+        jobs = [asyncio.create_task(_job(scheduler, order, "a")) for _ in range(5)]
+        await asyncio.sleep(0)
+        jobs.append(asyncio.create_task(_job(scheduler, order, "b")))
+        await asyncio.gather(*jobs)
+        return order
+
+    # Заявка "b" встает сразу за выполняющейся заявкой "a", а не за всеми пятью
+    assert run(scenario()) == ["a", "b", "a", "a", "a", "a"]
+
+
+def test_higher_class_goes_first(run):
+    async def scenario():
+        scheduler = FairScheduler(1, CLASSES)
+        await scheduler.acquire("holder", 0)
+        order = []
+        jobs = [asyncio.create_task(_job(scheduler, order, "background", 2)),
+                asyncio.create_task(_job(scheduler, order, "analysis", 1)),
+                asyncio.create_task(_job(scheduler, order, "interactive", 0))]
+        await asyncio.sleep(0)
+        scheduler.release(0)
+        await asyncio.gather(*jobs)
+        return order
+
+    assert run(scenario()) == ["interactive", "analysis", "background"]
+
+
+def test_reserved_slots_are_kept_for_interactive_calls(run):
+    async def scenario():
+        scheduler = FairScheduler(2, CLASSES, reserved=1)
+        await scheduler.acquire("u1", 2)
+        queued = asyncio.create_task(scheduler.acquire("u2", 2))
+        await asyncio.sleep(0)
+        assert not queued.done()  # второй слот - только для класса 0
+        assert await asyncio.wait_for(scheduler.acquire("u3", 0), 1) >= 0
+        scheduler.release(0)
+        scheduler.release(2)
+        await asyncio.wait_for(queued, 1)
+        scheduler.release(2)
+        assert scheduler.active == 0
+
+    run(scenario())
+
+
+def test_cancelled_waiter_does_not_leak_a_slot(run):
+    async def scenario():
+        scheduler = FairScheduler(1, CLASSES)
+        await scheduler.acquire("u1", 1)
+        waiter = asyncio.create_task(scheduler.acquire("u2", 1))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        scheduler.release(1)
+        assert scheduler.active == 0 and scheduler.queued() == 0
+        assert await asyncio.wait_for(scheduler.acquire("u3", 1), 1) >= 0
+        scheduler.release(1)
+
+    run(scenario())
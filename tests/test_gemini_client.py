@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from config import settings
+from services import gemini_client
+
+
+class _Chunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _Stream:
+    def __init__(self, gaps):
+        self.gaps = gaps
+
+    async def __aiter__(self):
+        for gap in self.gaps:
+            await asyncio.sleep(gap)
+            yield _Chunk("x")
+
+
+class _StreamingModel:
+    """Stand-in model: the stream sends a chunk after each of `gaps` seconds."""
+
+    def __init__(self, gaps):
+        self.gaps = gaps
+
+    async def generate_content_async(self, contents, *, stream=False, request_options=None, **kwargs):
+        return _Stream(self.gaps)
+
+
+@pytest.fixture(autouse=True)
+def fresh_breaker(monkeypatch):
+    monkeypatch.setattr(gemini_client, "_breaker", gemini_client.CircuitBreaker(100, 1))
+    monkeypatch.setattr(settings, "GEMINI_STREAM_IDLE_TIMEOUT_SEC", 0.15)
+
+
+async def _collect(gaps, timeout):
+    return [chunk.text async for chunk in gemini_client.generate_stream(_StreamingModel(gaps), "привет", timeout=timeout)]
+
+
+def test_stream_may_outlast_the_request_deadline():
+    # Весь ответ идет 0.45 с при дедлайне 0.2 с, но паузы между фрагментами короче 0.15 с
+    chunks = asyncio.run(_collect([0.05, 0.1, 0.1, 0.1, 0.1], timeout=0.2))
+    assert chunks == ["x"] * 5
+
+
+def test_stalled_stream_times_out():
+    with pytest.raises(gemini_client.GeminiTimeoutError, match="no new chunk"):
+        asyncio.run(_collect([0.01, 0.5], timeout=5))
+
+
+def test_first_chunk_is_bound_by_the_request_deadline():
+    with pytest.raises(gemini_client.GeminiTimeoutError, match="deadline"):
+        asyncio.run(_collect([0.5], timeout=0.1))
+
+
+def test_stream_is_capped_by_max_duration(monkeypatch):
+    monkeypatch.setattr(settings, "GEMINI_STREAM_MAX_SEC", 0.25)
+    with pytest.raises(gemini_client.GeminiTimeoutError, match="longer than"):
+        asyncio.run(_collect([0.1] * 10, timeout=5))
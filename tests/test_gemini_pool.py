@@ -0,0 +1,57 @@
+from config import settings
+from services.gemini_pool import ApiKey, GeminiPool, ModelTemplate
+
+
+def _pool(fallback_model=None, keys=2) -> GeminiPool:
+    api_keys = [ApiKey(index, f"key-{index}", 1) for index in range(keys)]
+    for api_key in api_keys:
+        api_key._client = object()  # клиент ключа без сети
+    return GeminiPool(api_keys, fallback_model)
+
+
+def test_per_key_models_are_built_from_template_arguments(run):
+    pool = _pool()
+    template = ModelTemplate("gemini-test", system_instruction="Отвечай кратко.")
+    assert template.model_name == "models/gemini-test"
+
+    first, _ = run(pool.acquire(template, 10))
+    second, _ = run(pool.acquire(template, 10))
+    assert first.api_key is not second.api_key
+    assert first.model_name == second.model_name == "models/gemini-test"
+    for lease in (first, second):
+        assert lease.model.model_name == "models/gemini-test"
+        assert lease.model._async_client is lease.api_key.async_client()
+    assert "Отвечай кратко." in str(first.model)
+
+    again, _ = run(pool.acquire(template, 10))
+    assert again.model is first.model  # копия на (ключ, модель) строится один раз
+
+
+def test_ejected_model_fails_over_to_fallback(run, monkeypatch):
+    monkeypatch.setattr(settings, "GEMINI_EJECT_AFTER_ERRORS", 1)
+    pool = _pool("gemini-fallback")
+    template = ModelTemplate("gemini-primary")
+
+    lease, _ = run(pool.acquire(template, 10))
+    pool.report_failure(lease, RuntimeError("503"))
+    lease, _ = run(pool.acquire(template, 10))
+    assert lease.model_name == "models/gemini-fallback"
+    assert lease.model.model_name == "models/gemini-fallback"
+
+
+def test_test_doubles_pass_through(run):
+    pool = _pool()
+    double = object()
+    lease, _ = run(pool.acquire(double, 10))
+    assert lease.model is double and lease.model_name is None
+
+
+def test_quota_error_ejects_only_the_key(run):
+    pool = _pool()
+    template = ModelTemplate("gemini-test")
+    lease, _ = run(pool.acquire(template, 10))
+    pool.report_failure(lease, RuntimeError("429"), quota_exhausted=True)
+    for _ in range(3):
+        other, _ = run(pool.acquire(template, 10))
+        assert other.api_key is not lease.api_key
+    assert "models/gemini-test" not in pool.model_health  # 429 - квота ключа, а не перегрузка модели
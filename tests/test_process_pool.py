@@ -0,0 +1,68 @@
+import os
+import time
+
+import pytest
+
+from config import settings
+from services import cpu_pool
+from utils.process_pool import JobTimeoutError, ProcessPool
+
+
+def test_job_over_deadline_kills_its_worker(run):
+    async def scenario():
+        pool = ProcessPool(1)
+        try:
+            first_pid = await pool.run(os.getpid)
+            with pytest.raises(JobTimeoutError):
+                await pool.run(time.sleep, 10, timeout=0.5)
+            # Убитый воркер заменяется новым при следующей задаче
+            assert await pool.run(os.getpid) != first_pid
+            assert pool.stats()["timeouts"] == 1 and pool.spawned == 2
+        finally:
+            await pool.close()
+
+    run(scenario())
+
+
+def test_worker_is_recycled_after_max_jobs(run):
+    async def scenario():
+        pool = ProcessPool(1, max_jobs_per_worker=2)
+        pids = [await pool.run(os.getpid) for _ in range(3)]
+        retired = next(iter(pool._exiting), None)
+        await pool.close()
+        assert pids[0] == pids[1] != pids[2]
+        assert pool.recycled == 1
+        assert retired is None or retired.process.returncode is not None
+
+    run(scenario())
+
+
+def test_job_errors_are_reraised(run):
+    async def scenario():
+        pool = ProcessPool(1)
+        try:
+            with pytest.raises(ValueError):
+                await pool.run(int, "не число")
+            assert await pool.run(int, "42") == 42  # воркер после ошибки задачи жив
+            assert pool.spawned == 1
+        finally:
+            await pool.close()
+
+    run(scenario())
+
+
+def test_close_waits_for_workers(run):
+    async def scenario():
+        pool = ProcessPool(2)
+        await pool.run(os.getpid)
+        workers = list(pool._idle)
+        await pool.close()
+        assert all(worker.process.returncode is not None for worker in workers)
+
+    run(scenario())
+
+
+def test_thread_mode_honours_the_timeout(run, monkeypatch):
+    monkeypatch.setattr(settings, "CPU_POOL_WORKERS", 0)
+    with pytest.raises(JobTimeoutError):
+        run(cpu_pool.run(time.sleep, 1, timeout=0.1))
@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+import pytest
+
+from services.gemini_client import CircuitBreaker, GeminiUnavailableError
+from services.gemini_pool import TokenBucket
+
+
+def test_token_bucket_waits_for_refill(run):
+    bucket = TokenBucket(600)  # 10 токенов в секунду
+    bucket.tokens = 0
+    waited = run(bucket.acquire(2))
+    assert waited == pytest.approx(0.2, abs=0.1)
+    assert not bucket.available(2)
+
+
+def test_token_bucket_serves_waiters_in_order(run):
+    async def scenario():
+        bucket = TokenBucket(600)
+        bucket.tokens = 0
+        order = []
+
+        async def take(name, amount):
+            await bucket.acquire(amount)
+            order.append(name)
+
+        await asyncio.gather(take("большой", 3), take("малый", 1))
+        return order
+
+    # Маленькая заявка не обгоняет ту, что пришла раньше
+    assert run(scenario()) == ["большой", "малый"]
+
+
+def test_token_bucket_limits(run):
+    assert run(TokenBucket(0).acquire(10 ** 6)) == 0.0  # лимит выключен
+    bucket = TokenBucket(60)
+    # Заявка больше ведра берет все ведро, а не ждет вечно
+    assert run(bucket.acquire(1000)) == pytest.approx(0.0, abs=0.05)
+
+
+def test_breaker_opens_after_threshold_and_fails_fast():
+    breaker = CircuitBreaker(2, 60)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(GeminiUnavailableError) as error:
+        breaker.before_call()
+    assert 0 < error.value.retry_after <= 60
+
+
+def test_breaker_half_open_lets_one_probe_through():
+    breaker = CircuitBreaker(1, 0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.before_call()
+    assert breaker.state == "half-open"
+    with pytest.raises(GeminiUnavailableError):
+        breaker.before_call()  # проба уже идет
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.before_call()
+
+
+def test_failed_probe_reopens_and_released_probe_frees_the_slot():
+    breaker = CircuitBreaker(5, 0.05)
+    for _ in range(5):
+        breaker.record_failure()
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_failure()  # одной неудачной пробы достаточно
+    assert breaker.state == "open"
+
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.release_probe()  # вызов закончился без вердикта (отмена, 400)
+    breaker.before_call()
+    assert breaker.state == "half-open"
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from utils.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_job(run):
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+
+        async def job():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "результат"
+
+        results = await asyncio.gather(*(flight.do("file", job) for _ in range(5)))
+        assert results == ["результат"] * 5
+        assert calls == 1
+        assert flight.stats() == {"in_flight": 0, "started": 1, "coalesced": 4}
+        await flight.do("file", job)  # ключ освобожден - новая задача
+        assert calls == 2
+
+    run(scenario())
+
+
+def test_errors_reach_every_waiter(run):
+    async def scenario():
+        flight = SingleFlight()
+
+        async def job():
+            await asyncio.sleep(0.01)
+            raise ValueError("битый файл")
+
+        results = await asyncio.gather(*(flight.do("file", job) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert len(flight) == 0
+
+    run(scenario())
+
+
+def test_cancelled_waiter_does_not_cancel_the_job(run):
+    async def scenario():
+        flight = SingleFlight()
+        finished = asyncio.Event()
+
+        async def job():
+            await asyncio.sleep(0.02)
+            finished.set()
+            return 42
+
+        first = asyncio.create_task(flight.do("file", job))
+        second = asyncio.create_task(flight.do("file", job))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        assert await second == 42
+        assert finished.is_set()
+
+    run(scenario())
@@ -0,0 +1,91 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from services.table_profiler import HyperLogLog, TableProfiler
+
+
+def _profile(csv_text: str, chunksize: int = 0) -> TableProfiler:
+    profiler = TableProfiler()
+    if chunksize:
+        for chunk in pd.read_csv(io.StringIO(csv_text), chunksize=chunksize):
+            profiler.add(chunk)
+    else:
+        profiler.add(pd.read_csv(io.StringIO(csv_text)))
+    return profiler
+
+
+def _kinds(profiler: TableProfiler) -> dict:
+    return {column.name: column.kind for column in profiler.columns}
+
+
+def test_kind_detection():
+    profiler = _profile(
+        "Сумма,Цена,Дата,Город,Флаг\n"
+        '10,"1,5",2024-01-31,Москва,true\n'
+        '20,"2,25",2024-02-29,Казань,\n'
+        '30,"3,0",2024-03-31,Москва,false\n'
+    )
+    assert _kinds(profiler) == {"Сумма": "number", "Цена": "number", "Дата": "date",
+                                "Город": "text", "Флаг": "bool"}
+    price = profiler.columns[1]
+    assert price.decimal_comma
+    assert price.min == 1.5 and price.max == 3.0
+    dates = profiler.columns[2]
+    assert dates.min == pd.Timestamp("2024-01-31") and dates.max == pd.Timestamp("2024-03-31")
+    assert profiler.columns[3].counts == {"Москва": 2, "Казань": 1}
+
+
+def test_mostly_numbers_keep_number_kind_and_count_mismatches():
+    rows = "\n".join(["n"] + [str(i) for i in range(19)] + ["н/д"])
+    column = _profile(rows).columns[0]
+    assert column.kind == "number"
+    assert column.mismatched == 1
+    assert column.count == 19
+
+
+def test_true_false_column_with_blanks_is_bool():
+    # С пустой ячейкой pandas отдает колонку как object, а не bool
+    flag = _profile("Флаг,n\ntrue,1\n,2\nfalse,3\nTrue,4\n").columns[0]
+    assert flag.kind == "bool"
+    assert flag.nulls == 1
+    assert flag.mismatched == 0
+    assert flag.counts == {True: 2, False: 1}
+
+
+def test_bool_like_words_are_bool():
+    answer = _profile("Ответ\nда\nНет\nyes\nno\n\n").columns[0]
+    assert answer.kind == "bool"
+    assert answer.counts == {True: 2, False: 2}
+
+
+def test_zero_one_column_stays_number():
+    assert _profile("n\n0\n1\n1\n").columns[0].kind == "number"
+
+
+def test_chunked_statistics_match_whole_column():
+    values = np.random.default_rng(1).normal(100, 15, 1000).round(3)
+    csv_text = "x\n" + "\n".join(map(str, values))
+    column = _profile(csv_text, chunksize=97).columns[0]
+    assert column.count == len(values)
+    assert column.mean == pytest.approx(values.mean())
+    assert column.std == pytest.approx(values.std(ddof=1))
+    assert (column.min, column.max) == (values.min(), values.max())
+
+
+@pytest.mark.parametrize("distinct", [10, 1000, 50000])
+def test_hyperloglog_estimate(distinct):
+    hll = HyperLogLog()
+    values = pd.Series(np.arange(distinct).repeat(3))
+    hll.add_hashes(pd.util.hash_pandas_object(values, index=False).to_numpy())
+    # 2^12 регистров: стандартная ошибка около 1.6%
+    assert hll.estimate() == pytest.approx(distinct, rel=0.05)
+
+
+def test_distinct_counts_across_chunks():
+    csv_text = "id\n" + "\n".join(f"u{i % 3000}" for i in range(9000))
+    column = _profile(csv_text, chunksize=1000).columns[0]
+    assert column.kind == "text"
+    assert column.distinct.estimate() == pytest.approx(3000, rel=0.05)
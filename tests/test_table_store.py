@@ -0,0 +1,46 @@
+import io
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from services import table_store
+from services.table_profiler import TableProfiler
+
+
+def _store(tmp_path, csv_text: str):
+    path = tmp_path / "table.arrow"
+    writer = table_store.TableWriter(path)
+    profiler = TableProfiler(sink=writer)
+    profiler.add(pd.read_csv(io.StringIO(csv_text)))
+    assert writer.close("table.csv")
+    return path
+
+
+def test_bool_like_column_is_stored_as_bool(tmp_path):
+    path = _store(tmp_path, "Флаг,n\nда,1\nнет,2\n,3\nДа,4\n")
+    assert table_store.read_meta(path)["columns"][0] == ["Флаг", "bool"]
+    result = table_store.run_query(path, {"filter": [["Флаг", "==", "да"]], "aggregate": [["n", "sum"]]})
+    assert result.splitlines()[-1].strip() == "5"
+
+
+def test_median_is_exact(tmp_path):
+    path = _store(tmp_path, "g,v\na,1.5\na,3\nb,5\nb,\nb,1\nc,\n")
+    assert table_store.run_query(path, {"filter": [["g", "==", "a"]], "aggregate": [["v", "median"]]}).splitlines()[-1].strip() == "2.25"
+    result = table_store.run_query(path, {"group_by": "g", "aggregate": [["v", "median"]], "order_by": "g"})
+    assert [line.split() for line in result.splitlines()[2:]] == [["a", "2.25"], ["b", "3"], ["c", "NaN"]]
+
+
+@pytest.mark.parametrize("order_by", [[{"x": 1}], [[]], [["g", "desc", "x"]], [5], {"g": "desc"}, [["g", "up"]], [["нет", "asc"]]])
+def test_malformed_order_by_is_query_error(tmp_path, order_by):
+    path = _store(tmp_path, "g,v\na,1\nb,2\n")
+    with pytest.raises(table_store.QueryError):
+        table_store.run_query(path, {"order_by": order_by})
+
+
+def test_order_by_forms(tmp_path):
+    path = _store(tmp_path, "g,v\na,1\nb,3\nc,2\n")
+    for order_by in (["v", "desc"], [["v", "desc"]], [["v", "desc"], "g"]):
+        result = table_store.run_query(path, {"columns": ["g", "v"], "order_by": order_by, "limit": 2})
+        assert [line.split()[0] for line in result.splitlines()[2:]] == ["b", "c"]
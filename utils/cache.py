@@ -0,0 +1,96 @@
+# /home/telegram_gemini_bot/utils/cache.py
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class LRUCache:
+    """
+    Простой LRU-кэш в памяти процесса на основе OrderedDict.
+
+    Не потокобезопасен: рассчитан на использование из одного event loop.
+    Считает попадания и промахи для метрик. Если задан max_weight, записи
+    вытесняются также по суммарному "весу" (например, байтам в памяти).
+    """
+
+    def __init__(self, maxsize: int, max_weight: Optional[int] = None):
+        self.maxsize = max(1, maxsize)
+        self.max_weight = max_weight
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._weights: Dict[Hashable, int] = {}
+        self.total_weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the cached value (marking it recently used) or default on a miss."""
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the cached value without touching LRU order or counters."""
+        return self._data.get(key, default)
+
+    def put(self, key: Hashable, value: Any, weight: int = 0) -> None:
+        """Stores a value, evicting least recently used entries over maxsize/max_weight."""
+        self.total_weight += weight - self._weights.get(key, 0)
+        self._weights[key] = weight
+        self._data[key] = value
+        self._data.move_to_end(key)
+        self._evict()
+
+    def add_weight(self, key: Hashable, delta: int) -> None:
+        """Adjusts the weight of an entry mutated in place (e.g. a growing deque)."""
+        if key not in self._data:
+            return
+        self._weights[key] += delta
+        self.total_weight += delta
+        self._data.move_to_end(key)
+        self._evict()
+
+    def _evict(self) -> None:
+        # Последнюю (самую свежую) запись не вытесняем, даже если она одна тяжелее бюджета
+        while len(self._data) > 1 and (
+            len(self._data) > self.maxsize
+            or (self.max_weight is not None and self.total_weight > self.max_weight)
+        ):
+            key, _ = self._data.popitem(last=False)
+            self.total_weight -= self._weights.pop(key, 0)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        self.total_weight -= self._weights.pop(key, 0)
+        return self._data.pop(key, default)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._weights.clear()
+        self.total_weight = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns size and hit/miss counters."""
+        total = self.hits + self.misses
+        hit_rate: Optional[float] = (self.hits / total) if total else None
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": hit_rate,
+            "weight": self.total_weight,
+            "max_weight": self.max_weight,
+        }
@@ -0,0 +1,139 @@
+# /home/telegram_gemini_bot/utils/fair_scheduler.py
+
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Hashable, List, Sequence
+
+
+class _Waiter:
+    __slots__ = ("flow", "priority", "future", "enqueued", "cancelled")
+
+    def __init__(self, flow: Hashable, priority: int, future: asyncio.Future):
+        self.flow = flow
+        self.priority = priority
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.cancelled = False
+
+
+class FairScheduler:
+    """
+    Ограничивает число одновременно выполняемых задач и решает, кто получит
+    освободившийся слот.
+
+    Классы приоритета обслуживаются строго по порядку (0 - самый срочный); внутри
+    класса слоты делятся между потоками (пользователями) по start-time fair queuing:
+    каждая заявка получает метку max(виртуальное время, конец предыдущей заявки
+    потока) и продвигает поток на cost / weight. Поэтому пользователь с двадцатью
+    заявками не занимает все слоты - заявка другого пользователя встает в очередь
+    сразу за той, что выполняется сейчас.
+
+    reserved слотов доступны только классу 0: даже когда низшие классы заняли все,
+    что могли, срочной заявке не приходится ждать окончания длинной задачи.
+    Не потокобезопасен: рассчитан на использование из одного event loop.
+    """
+
+    def __init__(self, limit: int, classes: Sequence[str], reserved: int = 0, window: int = 512):
+        self.limit = max(1, limit)
+        self.reserved = min(max(0, reserved), self.limit - 1)
+        self.classes = list(classes)
+        self.active = 0
+        self._queues: List[List[tuple]] = [[] for _ in self.classes]  # куча (метка, номер, заявка)
+        self._virtual_time = [0.0 for _ in self.classes]
+        self._last_tag: List[Dict[Hashable, float]] = [{} for _ in self.classes]
+        self._seq = itertools.count()
+        self._queued = [0 for _ in self.classes]
+        self._running = [0 for _ in self.classes]
+        self._dispatched = [0 for _ in self.classes]
+        self._max_wait = [0.0 for _ in self.classes]
+        self._waits: List[Deque[float]] = [deque(maxlen=window) for _ in self.classes]
+
+    async def acquire(self, flow: Hashable, priority: int, cost: float = 1.0, weight: float = 1.0) -> float:
+        """
+        Waits for a slot in the given priority class. Returns the time spent queued.
+        The slot must be given back with release(priority).
+        """
+        priority = min(max(0, priority), len(self.classes) - 1)
+        last_tags = self._last_tag[priority]
+        start_tag = max(self._virtual_time[priority], last_tags.get(flow, 0.0))
+        last_tags[flow] = start_tag + max(cost, 1.0) / max(weight, 1e-6)
+
+        waiter = _Waiter(flow, priority, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queues[priority], (start_tag, next(self._seq), waiter))
+        self._queued[priority] += 1
+        self._dispatch()
+        try:
+            return await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Слот уже выдан, но забрать его некому
+                self.release(priority)
+            elif not waiter.cancelled:
+                waiter.cancelled = True
+                self._queued[priority] -= 1
+            raise
+
+    def release(self, priority: int):
+        """Returns a slot taken by acquire() and hands it to the next waiter."""
+        priority = min(max(0, priority), len(self.classes) - 1)
+        self.active -= 1
+        self._running[priority] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.active < self.limit:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            wait = time.monotonic() - waiter.enqueued
+            priority = waiter.priority
+            self.active += 1
+            self._queued[priority] -= 1
+            self._running[priority] += 1
+            self._dispatched[priority] += 1
+            self._waits[priority].append(wait)
+            self._max_wait[priority] = max(self._max_wait[priority], wait)
+            waiter.future.set_result(wait)
+
+    def _next_waiter(self):
+        for priority, queue in enumerate(self._queues):
+            # Низшие классы не трогают слоты, зарезервированные за классом 0
+            if priority > 0 and self.active >= self.limit - self.reserved:
+                return None
+            while queue:
+                start_tag, _, waiter = heapq.heappop(queue)
+                if waiter.cancelled or waiter.future.done():
+                    continue
+                self._virtual_time[priority] = start_tag
+                self._forget_idle_flows(priority)
+                return waiter
+        return None
+
+    def _forget_idle_flows(self, priority: int):
+        # Поток, чья метка уже позади виртуального времени, ничем не отличается от нового
+        last_tags = self._last_tag[priority]
+        if len(last_tags) > 1024:
+            now = self._virtual_time[priority]
+            for flow in [flow for flow, tag in last_tags.items() if tag <= now]:
+                del last_tags[flow]
+
+    def queued(self) -> int:
+        return sum(self._queued)
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-class queue depth, running slots and wait times (average / p95 over recent dispatches, max)."""
+        per_class = {}
+        for priority, name in enumerate(self.classes):
+            waits = sorted(self._waits[priority])
+            per_class[name] = {
+                "queued": self._queued[priority],
+                "running": self._running[priority],
+                "dispatched": self._dispatched[priority],
+                "wait_avg": (sum(waits) / len(waits)) if waits else 0.0,
+                "wait_p95": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0,
+                "wait_max": self._max_wait[priority],
+            }
+        return {"limit": self.limit, "reserved": self.reserved, "active": self.active, "classes": per_class}
@@ -2,6 +2,7 @@
 
 import os
 import uuid
+import hashlib
 import asyncio
 from pathlib import Path
 from loguru import logger
@@ -9,7 +10,7 @@ import re
 import html # Добавлен импорт html
 
 # Импортируем typing для Optional
-from typing import Optional
+from typing import List, Optional, Tuple
 
 from config import settings
 
@@ -28,6 +29,14 @@ def get_temp_filepath(extension: str) -> Path:
     filename = f"{uuid.uuid4()}.{clean_extension}"
     return settings.TEMP_DIR / filename
 
+def compute_file_hash(file_path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """Returns the sha256 hex digest of a file, read in chunks (blocking, run in a thread)."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 def escape_markdown_v2(text: str) -> str:
     """Escapes characters for Telegram MarkdownV2."""
     if not isinstance(text, str):
@@ -43,6 +52,53 @@ def get_current_datetime_str() -> str:
     now = datetime.now()
     return now.strftime("%d %B %Y, %H:%M")
 
+def estimate_tokens(text: Optional[str]) -> int:
+    """
+    Approximate token count without calling the remote count_tokens API.
+    ~4 bytes of UTF-8 per token: ~4 chars for Latin text, ~2 chars for Cyrillic.
+    """
+    if not text:
+        return 0
+    return max(1, (len(text.encode("utf-8", errors="ignore")) + 3) // 4)
+
+# Разделитель страниц в извлеченном тексте (PDF): по нему документ режется на части в первую очередь
+PAGE_BREAK = "\f"
+
+def split_text_chunks(text: str, max_chars: int) -> List[str]:
+    """
+    Splits text into chunks of at most max_chars, cutting on page breaks first,
+    then on blank lines (paragraphs), then on line ends and only then mid-line.
+    Consecutive small pieces are packed together up to the limit.
+    """
+    max_chars = max(1, max_chars)
+    separators = (PAGE_BREAK, "\n\n", "\n", " ")
+
+    def pieces(fragment: str, level: int, joiner: str) -> List[Tuple[str, str]]:
+        # (кусок, чем склеивать его с предыдущим) - склеиваем тем же, по чему резали
+        if len(fragment) <= max_chars:
+            return [(fragment, joiner)]
+        if level >= len(separators):
+            return [(fragment[i:i + max_chars], "") for i in range(0, len(fragment), max_chars)]
+        separator = separators[level]
+        result: List[Tuple[str, str]] = []
+        for part in fragment.split(separator):
+            result.extend(pieces(part, level + 1, "\n\n" if separator == PAGE_BREAK else separator))
+        return result
+
+    chunks: List[str] = []
+    current = ""
+    for piece, joiner in pieces(text, 0, ""):
+        piece = piece.strip()
+        if not piece:
+            continue
+        if current and len(current) + len(joiner) + len(piece) > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}{joiner}{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
 def is_ocr_potentially_useful(text: Optional[str], min_chars: int = 5, min_alnum_ratio: float = 0.4) -> bool:
     """Checks if OCR text is potentially useful."""
     if not text or not isinstance(text, str): return False
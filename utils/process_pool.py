@@ -0,0 +1,298 @@
+# /home/telegram_gemini_bot/utils/process_pool.py
+
+import asyncio
+import contextlib
+import itertools
+import os
+import pickle
+import signal
+import struct
+import sys
+import time
+from collections import deque
+from pathlib import Path
+from loguru import logger
+from typing import Any, BinaryIO, Callable, Deque, Dict, List, Optional, Set
+
+
+class ProcessPoolError(Exception):
+    """Base class for errors of the pool itself (not of the job)."""
+
+
+class JobTimeoutError(ProcessPoolError):
+    """The job did not finish before its deadline; its worker was killed."""
+
+
+class PoolOverloadedError(ProcessPoolError):
+    """Too many jobs are already waiting for a worker."""
+
+
+class WorkerCrashedError(ProcessPoolError):
+    """The worker process died while running the job (segfault, OOM killer, ...)."""
+
+
+_HEADER = struct.Struct(">Q")  # длина кадра pickle
+
+# Воркер - отдельный интерпретатор (python -c), а не multiprocessing: тот при запуске
+# процесса заново импортирует __main__ бота, а с ним config/settings и логирование в файл.
+_BOOTSTRAP = (
+    "import sys\n"
+    "sys.path.insert(0, sys.argv[1])\n"
+    "from utils.process_pool import _worker_main\n"
+    "_worker_main(sys.argv[2])\n"
+)
+_PROJECT_ROOT = str(Path(__file__).resolve().parent.parent)
+
+
+def _read_frame(stream: BinaryIO) -> Optional[bytes]:
+    header = stream.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    return stream.read(_HEADER.unpack(header)[0])
+
+
+def _worker_main(log_level: str):
+    """Worker process loop: reads pickled (fn, args, kwargs) from stdin, writes ("ok"|"error", value) to stdout."""
+    # Канал задач - копия stdout; сам stdout (print, вывод C-библиотек) уходит в stderr
+    channel = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    # Логи воркера - в stderr бота
+    logger.remove()
+    logger.add(sys.stderr, level=log_level,
+               format="{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | worker {process} | {name}:{function}:{line} - {message}")
+    # Ctrl+C получает вся группа процессов - остановкой воркеров управляет родитель
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        frame = _read_frame(sys.stdin.buffer)
+        if frame is None:
+            break  # родитель закрыл канал - завершаемся
+        try:
+            fn, args, kwargs = pickle.loads(frame)
+        except Exception as unpickle_err:
+            reply = ("error", RuntimeError(f"Не удалось принять задачу: {unpickle_err!r}"))
+        else:
+            try:
+                reply = ("ok", fn(*args, **kwargs))
+            except Exception as job_err:
+                reply = ("error", job_err)
+        try:
+            data = pickle.dumps(reply, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as dump_err:
+            # Результат или исключение не сериализуются
+            data = pickle.dumps(("error", RuntimeError(f"Не удалось передать результат задачи: {dump_err!r}")))
+        channel.write(_HEADER.pack(len(data)) + data)
+        channel.flush()
+
+
+class _Worker:
+    __slots__ = ("process", "name", "jobs")
+
+    def __init__(self, process: asyncio.subprocess.Process, name: str):
+        self.process = process
+        self.name = name
+        self.jobs = 0
+
+
+class ProcessPool:
+    """
+    Пул процессов для CPU-тяжелых задач (разбор PDF/DOCX, pandas, PIL, OCR), чтобы они
+    не делили GIL с event loop.
+
+    Каждый воркер выполняет по одной задаче; задача получает дедлайн, и если не
+    успевает (зависла на битом файле), воркер убивается и заменяется новым при
+    следующей задаче - в отличие от ProcessPoolExecutor, который не умеет прервать
+    одну задачу. После max_jobs_per_worker задач воркер завершается, чтобы не копить
+    память. Ожидающих свободного воркера не больше max_queue, дальше -
+    PoolOverloadedError.
+
+    Воркеры запускаются по требованию; функции задач должны быть объявлены на уровне
+    модуля (воркер импортирует их по имени), аргументы и результат - сериализуемы
+    pickle. Не потокобезопасен: рассчитан на один event loop.
+    """
+
+    def __init__(self, workers: int, max_jobs_per_worker: int = 0, max_queue: int = 0,
+                 default_timeout: Optional[float] = None, log_level: str = "INFO", window: int = 512):
+        self.workers = max(1, workers)
+        self.max_jobs_per_worker = max(0, max_jobs_per_worker)
+        self.max_queue = max(0, max_queue)
+        self.default_timeout = default_timeout
+        self.log_level = log_level
+        self._slots = asyncio.Semaphore(self.workers)
+        self._idle: List[_Worker] = []
+        self._busy: List[_Worker] = []
+        self._queued = 0
+        self._names = itertools.count(1)
+        self._exiting: Set[_Worker] = set()  # выведенные воркеры, еще не завершившиеся
+        self._closed = False
+        self.spawned = 0
+        self.recycled = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.crashed = 0
+        self.rejected = 0
+        self.max_wait = 0.0
+        self._waits: Deque[float] = deque(maxlen=window)
+        self._runs: Deque[float] = deque(maxlen=window)
+
+    async def run(self, fn: Callable[..., Any], *args: Any, timeout: Optional[float] = None, **kwargs: Any) -> Any:
+        """
+        Runs fn(*args, **kwargs) in a worker process and returns its result or re-raises its exception.
+        Raises JobTimeoutError after timeout seconds (default_timeout if None), PoolOverloadedError
+        if the queue is full, WorkerCrashedError if the worker died.
+        """
+        if self._closed:
+            raise ProcessPoolError("Пул процессов остановлен")
+        if self.max_queue and self._queued >= self.max_queue and self._slots.locked():
+            self.rejected += 1
+            raise PoolOverloadedError(f"В очереди уже {self._queued} задач")
+        # Сериализуем до очереди: ошибка в аргументах не должна занимать воркер
+        frame = pickle.dumps((fn, args, kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+        enqueued = time.monotonic()
+        self._queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._queued -= 1
+        try:
+            wait = time.monotonic() - enqueued
+            self._waits.append(wait)
+            self.max_wait = max(self.max_wait, wait)
+            worker = self._take_idle() or await self._spawn()
+            return await self._execute(worker, getattr(fn, "__name__", repr(fn)), frame,
+                                       self.default_timeout if timeout is None else timeout)
+        finally:
+            self._slots.release()
+
+    def _take_idle(self) -> Optional[_Worker]:
+        while self._idle:
+            worker = self._idle.pop()
+            if worker.process.returncode is None:
+                return worker
+            # Воркер умер без задачи (OOM killer и т.п.)
+            logger.warning(f"Process pool: idle {worker.name} exited with code {worker.process.returncode}.")
+        return None
+
+    async def _spawn(self) -> _Worker:
+        name = f"cpu-worker-{next(self._names)}"
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", _BOOTSTRAP, _PROJECT_ROOT, self.log_level,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        )
+        self.spawned += 1
+        logger.debug(f"Process pool: started {name} (pid {process.pid}).")
+        return _Worker(process, name)
+
+    async def _execute(self, worker: _Worker, job_name: str, frame: bytes, timeout: Optional[float]) -> Any:
+        process = worker.process
+        self._busy.append(worker)
+        started = time.monotonic()
+        try:
+            try:
+                data = await asyncio.wait_for(self._exchange(process, frame), timeout)
+            finally:
+                self._busy.remove(worker)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.warning(f"Process pool: {job_name} exceeded {timeout}s, killing {worker.name}.")
+            await self._kill(worker)
+            raise JobTimeoutError(f"Задача не завершилась за {timeout} с") from None
+        except (asyncio.IncompleteReadError, ConnectionError, BrokenPipeError):
+            self.crashed += 1
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(process.wait(), 1)  # код выхода - для лога
+            await self._kill(worker)
+            logger.error(f"Process pool: {worker.name} died running {job_name} (exit code {process.returncode}).")
+            raise WorkerCrashedError(f"Процесс обработки завершился аварийно (код {process.returncode})") from None
+        except BaseException:
+            # Результат никому не нужен (отмена) - воркер занят, проще его убить
+            await self._kill(worker)
+            raise
+        self._runs.append(time.monotonic() - started)
+
+        worker.jobs += 1
+        if self.max_jobs_per_worker and worker.jobs >= self.max_jobs_per_worker:
+            self._retire(worker)
+        else:
+            self._idle.append(worker)
+
+        try:
+            status, value = pickle.loads(data)
+        except Exception as load_err:
+            self.failed += 1
+            raise ProcessPoolError(f"Не удалось прочитать результат задачи: {load_err!r}") from load_err
+        if status == "error":
+            self.failed += 1
+            raise value
+        self.completed += 1
+        return value
+
+    @staticmethod
+    async def _exchange(process: asyncio.subprocess.Process, frame: bytes) -> bytes:
+        process.stdin.write(_HEADER.pack(len(frame)) + frame)
+        await process.stdin.drain()
+        header = await process.stdout.readexactly(_HEADER.size)
+        return await process.stdout.readexactly(_HEADER.unpack(header)[0])
+
+    def _retire(self, worker: _Worker):
+        # Закрытый stdin - сигнал воркеру завершиться
+        self.recycled += 1
+        logger.debug(f"Process pool: recycling {worker.name} after {worker.jobs} jobs.")
+        worker.process.stdin.close()
+        # Код выхода забираем в фоне, чтобы процесс не остался зомби
+        self._exiting.add(worker)
+        exiting = asyncio.ensure_future(worker.process.wait())
+        exiting.add_done_callback(lambda _: self._exiting.discard(worker))
+
+    @staticmethod
+    async def _kill(worker: _Worker):
+        if worker.process.returncode is None:
+            try:
+                worker.process.kill()
+            except ProcessLookupError:
+                pass
+        # Без wait() процесс остается зомби, а его транспорт закрывается уже после event loop
+        await worker.process.wait()
+
+    async def close(self, timeout: float = 5.0):
+        """Stops all workers: idle ones are asked to exit (killed after timeout seconds), busy ones are killed."""
+        self._closed = True
+        for worker in self._idle:
+            worker.process.stdin.close()
+        workers = self._idle + self._busy + list(self._exiting)
+        self._idle = []
+        for worker in self._busy:
+            with contextlib.suppress(ProcessLookupError):
+                worker.process.kill()
+        if not workers:
+            return
+        _, pending = await asyncio.wait([asyncio.ensure_future(worker.process.wait()) for worker in workers],
+                                        timeout=timeout)
+        if pending:
+            logger.warning(f"Process pool: {len(pending)} worker(s) did not exit in {timeout}s, killing.")
+            for worker in workers:
+                await self._kill(worker)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns worker, queue and job counters; wait/run times are in seconds."""
+        waits = list(self._waits)
+        runs = list(self._runs)
+        return {
+            "workers": self.workers,
+            "alive": len(self._idle) + len(self._busy),
+            "busy": len(self._busy),
+            "queued": self._queued,
+            "max_queue": self.max_queue,
+            "spawned": self.spawned,
+            "recycled": self.recycled,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "crashed": self.crashed,
+            "rejected": self.rejected,
+            "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+            "wait_max": self.max_wait,
+            "run_avg": sum(runs) / len(runs) if runs else 0.0,
+            "run_max": max(runs) if runs else 0.0,
+        }
@@ -0,0 +1,46 @@
+# /home/telegram_gemini_bot/utils/singleflight.py
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные одинаковые операции: первый вызов do() с ключом запускает
+    задачу, остальные ждут ее же результат (или исключение).
+
+    Задача не отменяется, если отменен кто-то из ожидающих (asyncio.shield) - она
+    доработает для остальных, а результат обычно сохраняется в кэш/БД. После завершения
+    ключ освобождается, следующий вызов запустит новую задачу.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Awaits the in-flight job for key, starting factory() if there is none."""
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._tasks[key] = task
+            self.started += 1
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # Если все ожидающие были отменены, исключение никто не заберет - гасим предупреждение
+        if not task.cancelled():
+            task.exception()
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns in-flight, started and coalesced counters."""
+        return {"in_flight": len(self._tasks), "started": self.started, "coalesced": self.coalesced}